@@ -1,19 +1,101 @@
+import abc
+import asyncio
+import base64
+import bisect
+import contextvars
 import datetime
-from typing import List, Optional
+import email.utils
+import functools
+import hashlib
+import heapq
+import hmac
+import http.client
+import importlib
+import io
+import ipaddress
+import itertools
+import json
+import math
+import operator
+import os
+import random
+import re
+import socket
+import sys
+import threading
+import time
+import typing
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Annotated, Dict, List, Literal, Optional, Union
 
-from fastapi import FastAPI, HTTPException, status, Response, Depends, Header
+from fastapi import FastAPI, HTTPException, status, Request, Response, Depends, Header, Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field, EmailStr
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from starlette.datastructures import MutableHeaders
+from starlette.middleware import Middleware
+from starlette.routing import Match
+from pydantic import BaseModel, Field, EmailStr, TypeAdapter, ValidationError, field_validator
+import orjson
 import firebase_admin
-from firebase_admin import credentials, firestore, auth
+from firebase_admin import credentials, firestore, firestore_async, auth
+from google.api_core.exceptions import Aborted, AlreadyExists, FailedPrecondition
 from google.cloud.firestore import DELETE_FIELD
+from google.cloud.firestore_v1.async_transaction import async_transactional
+from google.cloud.firestore_v1.base_query import FieldFilter, Or
+from google.cloud.firestore_v1.bulk_writer import BulkWriterOptions
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Startup/shutdown hooks for background resources owned by the API process.
+    """
+    background_tasks = []
+    if firebase_admin._apps:
+        background_tasks.append(asyncio.create_task(run_token_cert_refresh()))
+    if product_catalog is not None and db is not None:
+        # The catalog listener feeds the search and facet indexes; on_snapshot only exists on the synchronous client
+        product_catalog.listeners.extend((search_index, facet_index))
+        await run_blocking(product_catalog.subscribe, firestore.client().collection('products'))
+        background_tasks.append(asyncio.create_task(run_catalog_watchdog()))
+    elif db is not None:
+        background_tasks.append(asyncio.create_task(run_search_index_refresh()))
+    if db is not None:
+        background_tasks.append(asyncio.create_task(run_view_flush()))
+    if db is not None:
+        background_tasks.extend(asyncio.create_task(job_runner.run()) for _ in range(JOB_WORKERS))
+        if ORPHAN_CLEANUP_HOURS > 0:
+            background_tasks.append(asyncio.create_task(run_orphan_cleanup_schedule()))
+    if db is not None and image_executor is not None:
+        await run_blocking(image_store.scan)
+        background_tasks.extend(asyncio.create_task(run_thumbnail_worker()) for _ in range(IMAGE_WORKERS))
+    yield
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if db is not None:
+        # Write out views buffered since the last periodic flush before the process exits
+        try:
+            await view_counter.flush()
+        except Exception as e:
+            print(f"Error flushing product views on shutdown: {e}")
+    if product_catalog is not None:
+        product_catalog.unsubscribe()
+    blocking_executor.shutdown(wait=False)
+    if image_executor is not None:
+        image_executor.shutdown(wait=False, cancel_futures=True)
+
 
 app = FastAPI(
     title = "Barely Used Bytes",
     description= "Backend api for managing used hardware parts listings.",
     version = "0.1.0",
+    lifespan=lifespan,
 )
 
 # Add CORS middleware
@@ -23,23 +105,67 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified", "Location"],
 )
 
-
+# Compress responses larger than COMPRESSION_MIN_BYTES. Brotli is preferred when the
+# client accepts it and brotli-asgi is installed; otherwise (or as its fallback) gzip.
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
 try:
-    if not firebase_admin._apps:
-        cred = credentials.Certificate("serviceAccountKey.json")
-        firebase_admin.initialize_app(cred)
-    db = firestore.client()
-    print("Firebase firestore initialized successfully.")
-except Exception as e:
-    print(f"Error initializing Firebase Firestore: {e}")
-    db = None
+    from brotli_asgi import BrotliMiddleware
+    app.add_middleware(BrotliMiddleware, minimum_size=COMPRESSION_MIN_BYTES, gzip_fallback=True)
+except ImportError:
+    app.add_middleware(GZipMiddleware, minimum_size=COMPRESSION_MIN_BYTES)
+
+
+# Storage is pluggable: STORAGE_BACKEND=memory swaps Firestore and Firebase Auth for the
+# in-memory stand-ins in memory_store/ (accepting "test:<uid>" bearer tokens), so the API can be
+# load-tested without a Firebase project. MEMORY_STORE_LATENCY_MS emulates the Firestore round
+# trip and MEMORY_SEED_PRODUCTS preloads a generated marketplace of that many products.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "firestore")  # "firestore" or "memory"
+verify_id_token = auth.verify_id_token
+delete_auth_user = auth.delete_user
+
+if STORAGE_BACKEND == "memory":
+    from memory_store import datagen, fake_auth
+    from memory_store.fake_firestore import FakeFirestore
+    db = FakeFirestore(latency=float(os.getenv("MEMORY_STORE_LATENCY_MS", "0")) / 1000)
+    verify_id_token = fake_auth.verify_id_token
+    delete_auth_user = fake_auth.delete_user
+    if int(os.getenv("MEMORY_SEED_PRODUCTS", "0")):
+        datagen.seed(db, products=int(os.getenv("MEMORY_SEED_PRODUCTS")))
+    print("In-memory storage initialized (STORAGE_BACKEND=memory).")
+else:
+    try:
+        if not firebase_admin._apps:
+            cred = credentials.Certificate("serviceAccountKey.json")
+            firebase_admin.initialize_app(cred)
+        # Handlers are async, so they talk to Firestore through the AsyncClient and never block the event loop
+        db = firestore_async.client()
+        print("Firebase firestore initialized successfully.")
+    except Exception as e:
+        print(f"Error initializing Firebase Firestore: {e}")
+        db = None
+
+# Bounded pool for the few calls that only exist in blocking form (e.g. token verification).
+# Keeping it small stops a slow dependency from spawning unbounded threads under load.
+BLOCKING_IO_WORKERS = int(os.getenv("BLOCKING_IO_WORKERS", "16"))
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_IO_WORKERS, thread_name_prefix="blocking-io")
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a synchronous function on the bounded blocking-IO pool and awaits its result.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(blocking_executor, functools.partial(func, *args, **kwargs))
 
-async def get_current_user(authorization: str = Header(...)):
+
+async def get_current_user(request: Request, authorization: str = Header(...)):
     """
     Dependency to verify Firebase ID token from the Authorization header.
     Returns the decoded token payload which includes user info.
+    Requests over the user's rate limit are refused with 429.
     """
     if not authorization.startswith("Bearer "):
         raise HTTPException(
@@ -48,11 +174,29 @@ async def get_current_user(authorization: str = Header(...)):
         )
     
     token = authorization.split("Bearer ")[1]
-    
-    try:
-        # Verify the token against the Firebase project
-        decoded_token = auth.verify_id_token(token)
+
+    decoded_token = request.scope.get("cached_token")
+    if decoded_token is not None:
+        # Found in the token cache and charged to the uid's bucket by AdmissionControlMiddleware
+        return decoded_token
+
+    # Tokens are reused for up to an hour, so a verified one is cached (keyed by its hash) until it expires
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    decoded_token = token_cache.get(cache_key)
+    if decoded_token is not None and decoded_token['exp'] > time.time():
+        await enforce_user_rate_limit(request, decoded_token['uid'])
         return decoded_token
+
+    try:
+        # Verify the token against the Firebase project, off the event loop
+        started = time.perf_counter()
+        decoded_token = await run_blocking(verify_id_token, token)
+        token_verification_stats.record(time.perf_counter() - started)
+        record_auth(time.perf_counter() - started)
+
+        ttl = min(decoded_token['exp'] - time.time(), TOKEN_CACHE_MAX_TTL_SECONDS)
+        if ttl > 0:
+            token_cache.set(cache_key, decoded_token, ttl=ttl)
     except auth.InvalidIdTokenError:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -63,11 +207,20 @@ async def get_current_user(authorization: str = Header(...)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"An error occurred: {e}",
         )
-        
-        
+    await enforce_user_rate_limit(request, decoded_token['uid'])
+    return decoded_token
+
+
 class Location(BaseModel):
     city: str
     country: str
+
+class ImageVariants(BaseModel):
+    # Resized copies of one entry of `images`, served from GET /images. The URLs end in .webp;
+    # the same path ending in .jpg holds a JPEG for clients without WebP support.
+    source: str
+    thumb: str
+    card: str
     
 class ProductBase(BaseModel):
     name: str = Field(..., min_length=3, max_length=100)
@@ -92,23 +245,31 @@ class ProductCreate(ProductBase):
     pass
 
 class ProductUpdate(BaseModel):
-    # Model for updating an existing product (all fields optional for partial updates)
-    name: Optional[str] = None
-    category: Optional[str] = None
-    subcategory: Optional[str] = None
-    description: Optional[str] = None
-    price: Optional[float] = None
-    currency: Optional[str] = None
-    condition: Optional[str] = None
-    images: Optional[List[str]] = None
-    sellerId: Optional[str] = None
-    sellerName: Optional[str] = None
+    # Model for updating an existing product (all fields optional for partial updates, same limits as ProductBase)
+    name: Optional[str] = Field(None, min_length=3, max_length=100)
+    category: Optional[str] = Field(None, min_length=2, max_length=50)
+    subcategory: Optional[str] = Field(None, min_length=2, max_length=50)
+    description: Optional[str] = Field(None, min_length=10, max_length=1000)
+    price: Optional[float] = Field(None, gt=0)
+    currency: Optional[str] = Field(None, max_length=5)
+    condition: Optional[str] = Field(None, max_length=50)
+    images: Optional[List[str]] = Field(None, min_length=1)
+    sellerId: Optional[str] = Field(None, min_length=5)
+    sellerName: Optional[str] = Field(None, min_length=3, max_length=100)
     location: Optional[Location] = None
-    status: Optional[str] = None
-    specifications: Optional[str] = None
-    yearsUsed: Optional[int] = None
+    status: Optional[str] = Field(None, max_length=20)
+    specifications: Optional[str] = Field(None, max_length=1000)
+    yearsUsed: Optional[int] = Field(None, ge=0)
     negotiable: Optional[bool] = None
-    shippingOptions: Optional[List[str]] = None
+    shippingOptions: Optional[List[str]] = Field(None, min_length=1)
+
+    @field_validator('*', mode='before')
+    @classmethod
+    def reject_null(cls, value):
+        # Omitting a field leaves it unchanged; every stored product field is required, so null is never valid
+        if value is None:
+            raise ValueError("may be omitted but not null")
+        return value
 
 
 class Product(ProductBase):
@@ -116,8 +277,9 @@ class Product(ProductBase):
     postedAt: datetime.datetime
     updatedAt: datetime.datetime
     views: int
-     
-     
+    # Filled in by the thumbnail worker after a write; empty until then (or when Pillow is missing)
+    thumbnails: List[ImageVariants] = []
+
 # --- Pydantic Models for User Data ---
 
 class Address(BaseModel):
@@ -165,6 +327,7 @@ class User(UserBase):
     createdAt: datetime.datetime
     lastLoginAt: datetime.datetime
 
+
 #--------------------------------------------------
 
 # --- Pydantic Models for Order Data ---
@@ -216,6 +379,7 @@ class Order(OrderBase):
     orderedAt: datetime.datetime
     shippedAt: Optional[datetime.datetime] = None
     deliveredAt: Optional[datetime.datetime] = None
+
 # ===================================
 
 # --- Pydantic Models for Review Data ---
@@ -240,85 +404,3347 @@ class ReviewCreate(ReviewBase):
 
 class ReviewUpdate(BaseModel):
     # Model for updating an existing review (all fields optional for partial updates)
-    rating: Optional[int] = None
-    comment: Optional[str] = None
+    rating: Optional[int] = Field(None, ge=1, le=5)
+    comment: Optional[str] = Field(None, min_length=10, max_length=1000)
     isApproved: Optional[bool] = None
-    helpfulVotes: Optional[int] = None
+    helpfulVotes: Optional[int] = Field(None, ge=0)
     # Other fields like IDs and names should not be updated after creation
 
 class Review(ReviewBase):
     # Full Review model including fields managed by the backend/Firestore
     reviewId: str
     reviewedAt: datetime.datetime
+    updatedAt: Optional[datetime.datetime] = None # Set when the review is edited
+
+
+# --- Firestore document -> API model decoding ---
+
+FIRESTORE_TRUSTED_DECODE = os.getenv("FIRESTORE_TRUSTED_DECODE", "1") != "0"
+
+
+class DocumentCodec:
+    """
+    Turns Firestore document snapshots into API models.
+
+    Firestore already hands back native datetimes, so they pass straight through
+    TypeAdapter validation instead of being formatted to strings and parsed back.
+    Pydantic's compiled validator is usually faster than model_construct, so
+    `trusted` is only worth enabling for models with expensive Python-side
+    validators (EmailStr on User). A trusted codec builds the model with
+    model_construct when every required field is present, and validates otherwise.
+    FIRESTORE_TRUSTED_DECODE=0 turns trusted decoding off everywhere.
+    See benchmarks/bench_codec.py.
+    """
+
+    def __init__(self, model, id_field: str, trusted: bool = False):
+        self.model = model
+        self.id_field = id_field
+        self.trusted = trusted and FIRESTORE_TRUSTED_DECODE
+        self.adapter = TypeAdapter(model)
+        self.list_adapter = TypeAdapter(List[model])
+        self._required = frozenset(name for name, field in model.model_fields.items() if field.is_required())
+        self._nested = _nested_models(model)
+
+    def decode(self, doc):
+        return self.decode_data(doc.id, doc.to_dict())
+
+    def decode_data(self, doc_id: str, data: dict):
+        started = time.perf_counter()
+        data[self.id_field] = doc_id
+        try:
+            if self.trusted and self._required <= data.keys():
+                return _construct(self.model, self._nested, data)
+            return self.adapter.validate_python(data)
+        finally:
+            record_decode(time.perf_counter() - started)
+
+    def decode_many(self, docs) -> list:
+        """
+        Decodes a page of snapshots; validation happens in a single TypeAdapter call.
+        """
+        started = time.perf_counter()
+        items = []
+        for doc in docs:
+            data = doc.to_dict()
+            data[self.id_field] = doc.id
+            items.append(data)
+        try:
+            if self.trusted and all(self._required <= data.keys() for data in items):
+                return [_construct(self.model, self._nested, data) for data in items]
+            return self.list_adapter.validate_python(items)
+        finally:
+            record_decode(time.perf_counter() - started)
+
+
+def _nested_models(model) -> dict:
+    """
+    Maps field name -> (model class, its own nested map) for fields typed as a model or Optional[model].
+    """
+    nested = {}
+    for name, field in model.model_fields.items():
+        for candidate in typing.get_args(field.annotation) or (field.annotation,):
+            if isinstance(candidate, type) and issubclass(candidate, BaseModel):
+                nested[name] = (candidate, _nested_models(candidate))
+                break
+    return nested
+
+
+def _construct(model, nested: dict, data: dict):
+    values = {name: data[name] for name in model.model_fields if name in data}
+    for name, (nested_model, nested_nested) in nested.items():
+        if isinstance(values.get(name), dict):
+            values[name] = _construct(nested_model, nested_nested, values[name])
+    return model.model_construct(**values)
+
+
+product_codec = DocumentCodec(Product, 'productId')
+user_codec = DocumentCodec(User, 'userId', trusted=True)
+order_codec = DocumentCodec(Order, 'orderId')
+review_codec = DocumentCodec(Review, 'reviewId')
 
 #==================================
-@app.get("/")
-async def read_root():
-    
-    if db: 
-        return {"message": "Welcome to Barely Used Bytes API!"}
-    else:
-        return {"message": "Database not found :("}
-    
-    
-""" Product Enpoints """
-    
-@app.get("/products", response_model=List[Product], summary="Get all products")
-async def get_all_products():
+
+# --- Read-through cache for product and review reads ---
+
+class TTLCache:
     """
-    Retrieves a list of all products from the Firestore 'products' collection.
+    Small in-process LRU cache whose entries also expire after `ttl` seconds.
+
+    Writers call invalidate()/clear(), which bump `generation`; a reader that
+    started before the write passes the generation it saw to set() and its
+    (possibly stale) result is dropped instead of cached.
     """
-    if db is None:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
-    products_ref = db.collection('products')
+
+    def __init__(self, name: str, max_entries: int, ttl: float):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: Optional[int] = None, ttl: Optional[float] = None):
+        if generation is not None and generation != self.generation:
+            return
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self.generation += 1
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self.generation += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "maxEntries": self.max_entries,
+            "ttlSeconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "2048"))
+
+product_cache = TTLCache("products", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+product_list_cache = TTLCache("product_lists", CACHE_MAX_ENTRIES // 4, CACHE_TTL_SECONDS)
+review_cache = TTLCache("reviews", CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS)
+review_list_cache = TTLCache("review_lists", CACHE_MAX_ENTRIES // 4, CACHE_TTL_SECONDS)
+
+
+class LatencyStats:
+    """
+    Running count/total/max of an operation's duration in seconds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, seconds: float):
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def stats(self) -> dict:
+        return {
+            "count": self.count,
+            "avgMs": round(self.total_seconds / self.count * 1000, 3) if self.count else 0.0,
+            "maxMs": round(self.max_seconds * 1000, 3),
+        }
+
+
+# Verified ID tokens, keyed by SHA-256 of the token and kept no longer than the token's own `exp`
+TOKEN_CACHE_MAX_ENTRIES = int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000"))
+TOKEN_CACHE_MAX_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_MAX_TTL_SECONDS", "3600"))
+TOKEN_CERT_REFRESH_SECONDS = float(os.getenv("TOKEN_CERT_REFRESH_SECONDS", "300"))
+token_cache = TTLCache("tokens", TOKEN_CACHE_MAX_ENTRIES, TOKEN_CACHE_MAX_TTL_SECONDS)
+token_verification_stats = LatencyStats()
+
+
+def prefetch_token_certs():
+    """
+    Fetches Google's ID-token signing certificates through firebase_admin's own
+    cache-control'd HTTP session, so verify_id_token finds them already cached.
+    firebase_admin has no public hook for this, hence the private attributes.
+    """
+    verifier = auth._get_client(None)._token_verifier
+    verifier.request(url=verifier.id_token_verifier.cert_url)
+
+
+async def run_token_cert_refresh():
+    """
+    Keeps the signing certificates warm. Cached responses are reused while fresh,
+    so a refetch only happens here, in the background, once they go stale.
+    """
+    while True:
+        try:
+            await run_blocking(prefetch_token_certs)
+        except Exception as e:
+            print(f"Error prefetching token certificates: {e}")
+        await asyncio.sleep(TOKEN_CERT_REFRESH_SECONDS)
+
+
+# --- Request metrics (GET /metrics and the Server-Timing header) ---
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Counter:
+    """
+    Monotonic counter with one series per label-value tuple, rendered in Prometheus text format.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, labels: tuple = (), amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _series(self, labels: tuple, extra: str = "") -> str:
+        pairs = [f'{name}="{_label_value(value)}"' for name, value in zip(self.labels, labels)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for labels, value in self.values.items():
+            yield f"{self.name}{self._series(labels)} {value}"
+
+    def render(self, openmetrics: bool) -> list:
+        # OpenMetrics names the counter family without its _total suffix
+        family = self.name[:-len("_total")] if openmetrics and self.name.endswith("_total") else self.name
+        return [f"# HELP {family} {self.help}", f"# TYPE {family} {self.kind}", *self.samples()]
+
+
+class Histogram(Counter):
+    """
+    Cumulative-bucket histogram per label-value tuple.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, labels: tuple, value: float):
+        series = self.values.get(labels)
+        if series is None:
+            # One slot per bucket plus +Inf, then the running sum
+            series = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def samples(self):
+        for labels, series in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{self._series(labels, le)} {cumulative}"
+            yield f"{self.name}_count{self._series(labels)} {cumulative}"
+            yield f"{self.name}_sum{self._series(labels)} {round(series[-1], 6)}"
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, by route template.", ("method", "route", "status"))
+firestore_reads = Counter(
+    "firestore_document_reads_total", "Billable Firestore document reads (a query returning nothing counts one).", ("route",))
+firestore_writes = Counter("firestore_document_writes_total", "Firestore document writes committed.", ("route",))
+firestore_queries = Counter("firestore_queries_total", "Firestore queries run.", ("route",))
+firestore_streamed = Counter("firestore_documents_streamed_total", "Documents returned by queries and batch gets.", ("route",))
+firestore_wait = Counter("firestore_wait_seconds_total", "Time spent awaiting Firestore calls (summed across concurrent calls).", ("route",))
+firestore_reads_per_request = Histogram(
+    "firestore_reads_per_request", "Firestore document reads per request.", ("route",), COUNT_BUCKETS)
+decode_time = Counter("document_decode_seconds_total", "Time spent validating Firestore documents into models.", ("route",))
+auth_time = Histogram("auth_verification_seconds", "Time verifying ID tokens on token cache misses.", ("route",))
+admission_rejected = Counter(
+    "http_admission_rejected_total", "Requests shed by admission control (queue_full or timeout).", ("route", "reason"))
+admission_wait = Histogram("http_admission_wait_seconds", "Time admitted requests waited for a concurrency slot.", ("route",))
+rate_limited = Counter("http_rate_limited_total", "Requests refused by a rate limit, by bucket kind (ip or user).", ("route", "kind"))
+invalid_documents = Counter(
+    "firestore_invalid_documents_total", "Stored documents left out of an in-process index because they failed validation.", ("index",))
+METRICS = (http_request_duration, firestore_reads, firestore_writes, firestore_queries, firestore_streamed,
+           firestore_wait, firestore_reads_per_request, decode_time, auth_time, admission_rejected, admission_wait,
+           rate_limited, invalid_documents)
+
+# Work done outside any request (background refreshes and flushes) is attributed to this route label
+BACKGROUND_ROUTE = "background"
+
+
+class RequestMetrics:
+    """
+    Tallies for one request, shared with everything it awaits through current_request_metrics.
+    """
+
+    __slots__ = ("reads", "writes", "queries", "streamed", "firestore_seconds", "decode_seconds", "auth_seconds")
+
+    def __init__(self):
+        self.reads = self.writes = self.queries = self.streamed = 0
+        self.firestore_seconds = self.decode_seconds = self.auth_seconds = 0.0
+
+    def server_timing(self, elapsed: float) -> str:
+        parts = [
+            f"app;dur={elapsed * 1000:.1f}",
+            f'firestore;dur={self.firestore_seconds * 1000:.1f};desc="{self.reads} reads, {self.writes} writes, {self.queries} queries"',
+        ]
+        if self.decode_seconds:
+            parts.append(f"decode;dur={self.decode_seconds * 1000:.1f}")
+        if self.auth_seconds:
+            parts.append(f"auth;dur={self.auth_seconds * 1000:.1f}")
+        return ", ".join(parts)
+
+    def publish(self, route: str):
+        labels = (route,)
+        firestore_reads.inc(labels, self.reads)
+        firestore_writes.inc(labels, self.writes)
+        firestore_queries.inc(labels, self.queries)
+        firestore_streamed.inc(labels, self.streamed)
+        firestore_wait.inc(labels, self.firestore_seconds)
+        decode_time.inc(labels, self.decode_seconds)
+
+
+current_request_metrics: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar(
+    "current_request_metrics", default=None)
+
+
+def record_firestore(seconds: float, reads: int = 0, writes: int = 0, queries: int = 0, streamed: int = 0):
+    metrics = current_request_metrics.get()
+    if metrics is None:
+        # No request to attribute it to, so it goes straight to the background series
+        metrics = RequestMetrics()
+        metrics.reads, metrics.writes, metrics.queries, metrics.streamed = reads, writes, queries, streamed
+        metrics.firestore_seconds = seconds
+        metrics.publish(BACKGROUND_ROUTE)
+        return
+    metrics.reads += reads
+    metrics.writes += writes
+    metrics.queries += queries
+    metrics.streamed += streamed
+    metrics.firestore_seconds += seconds
+
+
+def record_decode(seconds: float):
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.decode_seconds += seconds
+
+
+def record_auth(seconds: float):
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.auth_seconds += seconds
+
+
+def route_label(scope) -> str:
+    """
+    "METHOD /path/{param}" for the matched route; unmatched paths share one label to bound cardinality.
+    """
+    route = scope.get("route")
+    path = getattr(route, "path", None)
+    return f"{scope['method']} {path}" if path else "unmatched"
+
+
+class RequestMetricsMiddleware:
+    """
+    Pure ASGI middleware: collects a RequestMetrics for each HTTP request, adds a
+    Server-Timing header as the response starts, and publishes per-route series
+    once the response (including any streamed body) is complete.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        metrics = RequestMetrics()
+        token = current_request_metrics.set(metrics)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                MutableHeaders(raw=message["headers"]).append(
+                    "Server-Timing", metrics.server_timing(time.perf_counter() - started))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_request_metrics.reset(token)
+            route = route_label(scope)
+            metrics.publish(route)
+            firestore_reads_per_request.observe((route,), metrics.reads)
+            if metrics.auth_seconds:
+                auth_time.observe((route,), metrics.auth_seconds)
+            http_request_duration.observe((scope["method"], route, status_code), time.perf_counter() - started)
+
+
+# Outermost middleware, so the measured time includes compression
+app.add_middleware(RequestMetricsMiddleware)
+
+
+# --- Admission control and rate limiting ---
+
+# Each route gets at most its concurrency limit of requests in flight, plus a bounded queue of
+# requests waiting up to ADMISSION_QUEUE_TIMEOUT_SECONDS for a slot. Anything past that is shed with
+# 503 and Retry-After, so under overload latency stays near the limit's service time instead of
+# growing with the backlog, and one hot route cannot take every worker and all the Firestore quota.
+# Rate limits are token buckets: per client IP on public routes (checked here) and per Firebase uid
+# on authenticated ones (checked in get_current_user). A rate of 0 turns that limit off.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "64"))
+ADMISSION_QUEUE = int(os.getenv("ADMISSION_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "1"))
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv("ADMISSION_RETRY_AFTER_SECONDS", "1"))
+# Tighter limits for routes that scan or fan out; ADMISSION_ROUTE_LIMITS="GET /products=16,GET /users=4" overrides
+ADMISSION_ROUTE_LIMITS = {
+    "GET /products": 32,
+    "GET /users": 8,
+    "GET /reviews": 8,
+    "GET /orders": 16,
+    "POST /checkout": 16,
+    "POST /products:batchWrite": 4,
+}
+ADMISSION_ROUTE_LIMITS.update(
+    (route.strip(), int(limit)) for route, _, limit in
+    (item.rpartition("=") for item in os.getenv("ADMISSION_ROUTE_LIMITS", "").split(",") if item.strip())
+)
+# Cheap and needed to diagnose overload, so never queued or shed (still subject to the per-IP rate limit)
+ADMISSION_EXEMPT = frozenset({"GET /", "GET /metrics", "GET /cache/stats"})
+
+RATE_LIMIT_IP_PER_SECOND = float(os.getenv("RATE_LIMIT_IP_PER_SECOND", "20"))
+RATE_LIMIT_IP_BURST = float(os.getenv("RATE_LIMIT_IP_BURST", "40"))
+RATE_LIMIT_USER_PER_SECOND = float(os.getenv("RATE_LIMIT_USER_PER_SECOND", "10"))
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "30"))
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Proxies (load balancer, CDN) in front of the API that append to X-Forwarded-For. With 0 the
+# per-IP bucket is keyed on the connecting address, which behind a proxy is the proxy's own.
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv("RATE_LIMIT_TRUSTED_PROXIES", "0"))
+# "memory" keeps buckets per process; "package.module:factory" loads a shared RateLimitStore
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+
+
+class AdmissionGate:
+    """
+    Concurrency limit for one route with a bounded FIFO queue in front of it.
+    """
+
+    def __init__(self, limit: int, queue: int, timeout: float):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self._slots = asyncio.Semaphore(limit)
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+
+    async def acquire(self) -> Optional[str]:
+        """
+        Waits for a slot; returns None once admitted, or why the request was shed.
+        """
+        if not self._slots.locked():
+            # A free slot is taken without suspending, so the next request already sees it in use
+            await self._slots.acquire()
+            self.admitted += 1
+            return None
+        if self.waiting >= self.queue:
+            self.rejected += 1
+            return "queue_full"
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return "timeout"
+        finally:
+            self.waiting -= 1
+        self.admitted += 1
+        return None
+
+    def release(self):
+        self._slots.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "inFlight": self.limit - self._slots._value,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+class RateLimitStore(abc.ABC):
+    """
+    Holds token buckets. The in-memory store limits each process on its own; a store shared by
+    every process (e.g. Redis) subclasses this and makes take() atomic there.
+    """
+
+    @abc.abstractmethod
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """
+        Takes a token from `key`'s bucket, which refills at `rate` per second up to `burst`.
+        Returns 0 when one was taken, otherwise the seconds until one will be available.
+        """
+
+    def stats(self) -> dict:
+        return {}
+
+
+class MemoryRateLimitStore(RateLimitStore):
+    """
+    Buckets in a dict, dropping the least recently used past `max_keys`. A dropped bucket has
+    been idle the longest, so it has usually refilled to full anyway.
+    """
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, time.monotonic() of last update)
+        self.limited = 0
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / rate
+            self.limited += 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def stats(self) -> dict:
+        return {"store": "memory", "keys": len(self._buckets), "maxKeys": self.max_keys, "limited": self.limited}
+
+
+if RATE_LIMIT_STORE == "memory":
+    rate_limit_store = MemoryRateLimitStore(RATE_LIMIT_MAX_KEYS)
+else:
+    module_name, _, factory = RATE_LIMIT_STORE.partition(":")
+    rate_limit_store = getattr(importlib.import_module(module_name), factory)()
+
+
+async def rate_limit_retry_after(key: str, rate: float, burst: float) -> Optional[int]:
+    """
+    Whole seconds to put in Retry-After when `key` is over its rate, or None when the request may go ahead.
+    """
+    if rate <= 0:
+        return None
+    wait = await rate_limit_store.take(key, rate, burst)
+    return max(1, math.ceil(wait)) if wait else None
+
+
+async def enforce_user_rate_limit(request: Request, uid: str):
+    """
+    Refuses the request with 429 once `uid` is over its rate; called by get_current_user after verifying
+    a token the middleware did not find in the cache (or when admission control is off).
+    """
+    retry_after = await rate_limit_retry_after(f"user:{uid}", RATE_LIMIT_USER_PER_SECOND, RATE_LIMIT_USER_BURST)
+    if retry_after is not None:
+        rate_limited.inc((route_label(request.scope), "user"))
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests.",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+def client_address(scope) -> Optional[str]:
+    """
+    The address the per-IP bucket is keyed on: the connecting address, or with
+    RATE_LIMIT_TRUSTED_PROXIES hops, the X-Forwarded-For entry added by the outermost of them.
+    Entries further left are set by the client and cannot be trusted.
+    """
+    if RATE_LIMIT_TRUSTED_PROXIES:
+        forwarded = [address.strip() for name, value in scope["headers"] if name == b"x-forwarded-for"
+                     for address in value.decode("latin-1").split(",")]
+        if len(forwarded) >= RATE_LIMIT_TRUSTED_PROXIES:
+            return forwarded[-RATE_LIMIT_TRUSTED_PROXIES]
+    return scope["client"][0] if scope.get("client") else None
+
+
+def cached_token(scope) -> Optional[dict]:
+    """
+    The decoded token for the request's bearer token when it is in the token cache and unexpired;
+    never verifies a token.
+    """
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            value = value.decode("latin-1")
+            if not value.startswith("Bearer "):
+                return None
+            decoded_token = token_cache.get(hashlib.sha256(value.split("Bearer ")[1].encode()).hexdigest())
+            if decoded_token is not None and decoded_token['exp'] > time.time():
+                return decoded_token
+            return None
+    return None
+
+
+def overloaded_response(status_code: int, detail: str, retry_after: int) -> JSONResponse:
+    return JSONResponse({"detail": detail}, status_code=status_code, headers={"Retry-After": str(retry_after)})
+
+
+# Route label -> (label, AdmissionGate or None when exempt, whether it calls get_current_user), built on first request
+admission_policies = {}
+
+
+class AdmissionControlMiddleware:
+    """
+    Pure ASGI middleware that resolves the route itself (routing happens further in), applies
+    the rate limit, then waits for the route's gate, so a client over its limit never holds a slot.
+    Authenticated routes whose token is in the token cache are limited per uid; other requests,
+    including ones with a token not verified yet, per client IP. Exempt routes skip the gate.
+    It records the route on the scope, so shed requests are labelled in the request metrics.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def policy(scope, route) -> tuple:
+        label = route_label(scope)
+        policy = admission_policies.get(label)
+        if policy is None:
+            dependant = getattr(route, "dependant", None)
+            authenticated = dependant is not None and any(
+                dependency.call is get_current_user for dependency in dependant.dependencies)
+            gate = None
+            if label not in ADMISSION_EXEMPT:
+                gate = AdmissionGate(ADMISSION_ROUTE_LIMITS.get(label, ADMISSION_CONCURRENCY),
+                                     ADMISSION_QUEUE, ADMISSION_QUEUE_TIMEOUT_SECONDS)
+            policy = admission_policies[label] = (label, gate, authenticated)
+        return policy
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+        route = next((route for route in app.router.routes if route.matches(scope)[0] == Match.FULL), None)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        scope["route"] = route
+        label, gate, authenticated = self.policy(scope, route)
+
+        bucket = None
+        decoded_token = cached_token(scope) if authenticated else None
+        if decoded_token is not None:
+            # get_current_user takes the token from the scope and skips its own uid check
+            scope["cached_token"] = decoded_token
+            bucket = ("user", f"user:{decoded_token['uid']}", RATE_LIMIT_USER_PER_SECOND, RATE_LIMIT_USER_BURST)
+        else:
+            address = client_address(scope)
+            if address is not None:
+                bucket = ("ip", f"ip:{address}", RATE_LIMIT_IP_PER_SECOND, RATE_LIMIT_IP_BURST)
+        if bucket is not None:
+            kind, key, rate, burst = bucket
+            retry_after = await rate_limit_retry_after(key, rate, burst)
+            if retry_after is not None:
+                rate_limited.inc((label, kind))
+                await overloaded_response(status.HTTP_429_TOO_MANY_REQUESTS, "Too many requests.", retry_after)(scope, receive, send)
+                return
+        if gate is None:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        reason = await gate.acquire()
+        if reason is not None:
+            admission_rejected.inc((label, reason))
+            await overloaded_response(status.HTTP_503_SERVICE_UNAVAILABLE, "Server is busy, try again shortly.",
+                                      ADMISSION_RETRY_AFTER_SECONDS)(scope, receive, send)
+            return
+        admission_wait.observe((label,), time.perf_counter() - started)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+
+# Innermost middleware (add_middleware would make it outermost), so shed requests still get
+# CORS headers and show up in the request metrics
+app.user_middleware.append(Middleware(AdmissionControlMiddleware))
+
+
+def _unwrap(reference):
+    return getattr(reference, "_target", reference)
+
+
+class _Timed:
+    """
+    Measures one awaited Firestore call and records it against the current request.
+    """
+
+    __slots__ = ("counts", "started")
+
+    def __init__(self, **counts):
+        self.counts = counts
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record_firestore(time.perf_counter() - self.started, **self.counts)
+
+
+async def _instrumented_stream(documents, query: bool):
+    """
+    Re-yields a document stream, timing only the waits on Firestore (not the consumer)
+    and counting what came back. An empty query is still billed one read.
+    """
+    count = 0
+    seconds = 0.0
+    started = time.perf_counter()
+    try:
+        async for doc in documents:
+            seconds += time.perf_counter() - started
+            count += 1
+            yield doc
+            started = time.perf_counter()
+        seconds += time.perf_counter() - started
+    finally:
+        # Batch gets record their reads up front, one per requested document
+        reads = max(count, 1) if query else 0
+        record_firestore(seconds, reads=reads, queries=int(query), streamed=count)
+
+
+class _InstrumentedQuery:
+    """
+    Wraps a collection or query; builder methods return wrapped queries and stream() is counted.
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def where(self, *args, **kwargs):
+        return _InstrumentedQuery(self._target.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return _InstrumentedQuery(self._target.order_by(*args, **kwargs))
+
+    def start_after(self, *args, **kwargs):
+        return _InstrumentedQuery(self._target.start_after(*args, **kwargs))
+
+    def limit(self, count):
+        return _InstrumentedQuery(self._target.limit(count))
+
+    def select(self, field_paths):
+        return _InstrumentedQuery(self._target.select(field_paths))
+
+    def document(self, *args):
+        return _InstrumentedDocument(self._target.document(*args))
+
+    def stream(self, *args, **kwargs):
+        return _instrumented_stream(self._target.stream(*args, **kwargs), query=True)
+
+    async def add(self, data, **kwargs):
+        with _Timed(writes=1):
+            update_time, doc_ref = await self._target.add(data, **kwargs)
+        return update_time, _InstrumentedDocument(doc_ref)
+
+
+class _InstrumentedDocument:
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def collection(self, name):
+        return _InstrumentedQuery(self._target.collection(name))
+
+    async def get(self, *args, transaction=None, **kwargs):
+        with _Timed(reads=1):
+            return await self._target.get(*args, transaction=_unwrap(transaction), **kwargs)
+
+    async def set(self, *args, **kwargs):
+        with _Timed(writes=1):
+            return await self._target.set(*args, **kwargs)
+
+    async def create(self, *args, **kwargs):
+        with _Timed(writes=1):
+            return await self._target.create(*args, **kwargs)
+
+    async def update(self, *args, **kwargs):
+        with _Timed(writes=1):
+            return await self._target.update(*args, **kwargs)
+
+    async def delete(self, *args, **kwargs):
+        with _Timed(writes=1):
+            return await self._target.delete(*args, **kwargs)
+
+
+class _InstrumentedWriteBatch:
+    """
+    Counts staged writes and records them when the batch commits.
+    """
+
+    def __init__(self, target):
+        self._target = target
+        self._staged = 0
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def _stage(self, method, reference, *args, **kwargs):
+        self._staged += 1
+        return method(_unwrap(reference), *args, **kwargs)
+
+    def create(self, reference, *args, **kwargs):
+        return self._stage(self._target.create, reference, *args, **kwargs)
+
+    def set(self, reference, *args, **kwargs):
+        return self._stage(self._target.set, reference, *args, **kwargs)
+
+    def update(self, reference, *args, **kwargs):
+        return self._stage(self._target.update, reference, *args, **kwargs)
+
+    def delete(self, reference, *args, **kwargs):
+        return self._stage(self._target.delete, reference, *args, **kwargs)
+
+    async def commit(self, *args, **kwargs):
+        with _Timed(writes=self._staged):
+            return await self._target.commit(*args, **kwargs)
+
+
+class _InstrumentedTransaction(_InstrumentedWriteBatch):
+    """
+    async_transactional drives the transaction through its private begin/commit hooks,
+    so those are where an attempt's staged writes are reset and recorded.
+    """
+
+    async def _begin(self, *args, **kwargs):
+        self._staged = 0
+        return await self._target._begin(*args, **kwargs)
+
+    async def _commit(self, *args, **kwargs):
+        with _Timed(writes=self._staged):
+            return await self._target._commit(*args, **kwargs)
+
+
+class InstrumentedFirestore:
+    """
+    Thin wrapper over the Firestore AsyncClient (or the in-memory stand-in) that
+    counts document reads, writes, queries and streamed documents, and the time
+    spent awaiting them, against the current request. Anything it does not wrap
+    passes straight through.
+    """
+
+    def __init__(self, client):
+        self._target = client
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def collection(self, *path):
+        return _InstrumentedQuery(self._target.collection(*path))
+
+    def batch(self):
+        return _InstrumentedWriteBatch(self._target.batch())
+
+    def transaction(self, **kwargs):
+        return _InstrumentedTransaction(self._target.transaction(**kwargs))
+
+    def get_all(self, references, **kwargs):
+        references = [_unwrap(reference) for reference in references]
+        if "transaction" in kwargs:
+            kwargs["transaction"] = _unwrap(kwargs["transaction"])
+        # Firestore bills one read per requested document, found or not
+        record_firestore(0.0, reads=len(references))
+        return _instrumented_stream(self._target.get_all(references, **kwargs), query=False)
+
+
+# All Firestore traffic from the handlers below goes through the metrics wrapper
+if db is not None:
+    db = InstrumentedFirestore(db)
+
+
+def invalidate_product(product_id: Optional[str] = None):
+    """
+    Drops a product (if given) and every cached product listing page.
+    """
+    if product_id is not None:
+        product_cache.invalidate(product_id)
+    product_list_cache.clear()
+
+
+def invalidate_review(review_id: Optional[str] = None):
+    """
+    Drops a review (if given) and the cached review listing.
+    """
+    if review_id is not None:
+        review_cache.invalidate(review_id)
+    review_list_cache.clear()
+
+
+# --- Optional live product catalog (PRODUCT_CATALOG_MODE=snapshot) ---
+
+class ProductCatalog:
+    """
+    In-memory copy of the 'products' collection kept current by a Firestore
+    on_snapshot listener, with secondary indexes for the equality filters used
+    by GET /products. Listener callbacks run on the Firestore watch thread, so
+    all state is guarded by a lock.
+    """
+
+    INDEXED_FIELDS = ("category", "subcategory", "sellerId", "status")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._products = {}  # productId -> Product
+        self._sizes = {}  # productId -> approximate encoded size in bytes
+        self._indexes = {field: {} for field in self.INDEXED_FIELDS}  # field -> value -> set(productId)
+        self._watch = None
+        self._fresh_subscription = False
+        self.listeners = []  # objects with add(product)/remove(product_id)/clear(), e.g. the search index
+        self.ready = False
+        self.approx_bytes = 0
+        self.resyncs = 0
+        self.last_snapshot_at = None
+
+    # -- listener plumbing --
+
+    def subscribe(self, collection_ref):
+        """
+        Starts (or restarts) the listener. The first snapshot of every subscription
+        is applied as a full rebuild, so a reconnect can never leave stale entries behind.
+        """
+        with self._lock:
+            self.ready = False
+            self._fresh_subscription = True
+        self._watch = collection_ref.on_snapshot(self._on_snapshot)
+
+    def unsubscribe(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+        self.ready = False
+
+    @property
+    def listening(self) -> bool:
+        return self._watch is not None and self._watch.is_active
+
+    def _on_snapshot(self, docs, changes, read_time):
+        with self._lock:
+            if self._fresh_subscription:
+                self._rebuild(docs)
+                self._fresh_subscription = False
+                self.ready = True
+            else:
+                for change in changes:
+                    if change.type.name == "REMOVED":
+                        self._remove(change.document.id)
+                    else:
+                        self._upsert_snapshot(change.document)
+            self.last_snapshot_at = read_time
+
+    def _rebuild(self, docs):
+        self._products.clear()
+        self._sizes.clear()
+        for index in self._indexes.values():
+            index.clear()
+        self.approx_bytes = 0
+        for listener in self.listeners:
+            listener.clear()
+        for doc in docs:
+            self._upsert_snapshot(doc)
+
+    def _upsert_snapshot(self, doc):
+        try:
+            self._upsert(product_codec.decode(doc))
+        except Exception as e:
+            # A malformed document must not kill the listener thread; it just stays out of the catalog
+            print(f"Skipping product {doc.id} in catalog: {e}")
+            invalid_documents.inc(("catalog",))
+            self._remove(doc.id)
+
+    # -- state mutation (caller holds the lock) --
+
+    def _upsert(self, product: "Product"):
+        current = self._products.get(product.productId)
+        if current is not None:
+            if current.updatedAt > product.updatedAt:
+                return  # A local write already applied a newer version
+            self._remove(product.productId)
+        self._products[product.productId] = product
+        size = len(product.model_dump_json())
+        self._sizes[product.productId] = size
+        self.approx_bytes += size
+        for field in self.INDEXED_FIELDS:
+            self._indexes[field].setdefault(getattr(product, field), set()).add(product.productId)
+        for listener in self.listeners:
+            listener.add(product)
+
+    def _remove(self, product_id: str):
+        product = self._products.pop(product_id, None)
+        if product is None:
+            return
+        self.approx_bytes -= self._sizes.pop(product_id, 0)
+        for field in self.INDEXED_FIELDS:
+            ids = self._indexes[field].get(getattr(product, field))
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self._indexes[field][getattr(product, field)]
+        for listener in self.listeners:
+            listener.remove(product_id)
+
+    # -- local writes, so a client reads its own write before the listener catches up --
+
+    def apply_local(self, product: "Product"):
+        with self._lock:
+            self._upsert(product)
+
+    def remove_local(self, product_id: str):
+        with self._lock:
+            self._remove(product_id)
+
+    # -- reads --
+
+    def get(self, product_id: str) -> Optional["Product"]:
+        return self._products.get(product_id)
+
+    def query(self, filters: dict, min_price, max_price, sort: str, limit: int, cursor: Optional[dict]) -> List["Product"]:
+        """
+        Answers a GET /products page from memory with the same ordering and cursor
+        semantics as the Firestore query (sort field, then document ID).
+        """
+        sort_field, direction = PRODUCT_SORTS[sort]
+        descending = direction == firestore.Query.DESCENDING
+        with self._lock:
+            candidates = None
+            for field, value in filters.items():
+                if value is None:
+                    continue
+                if field in self._indexes:
+                    ids = self._indexes[field].get(value, set())
+                    candidates = set(ids) if candidates is None else candidates & ids
+            if candidates is None:
+                products = list(self._products.values())
+            else:
+                products = [self._products[product_id] for product_id in candidates]
+
+        def matches(product):
+            for field, value in filters.items():
+                if value is not None and getattr(product, field) != value:
+                    return False
+            if min_price is not None and product.price < min_price:
+                return False
+            if max_price is not None and product.price > max_price:
+                return False
+            return True
+
+        def key(product):
+            return (getattr(product, sort_field), product.productId)
+
+        products = [product for product in products if matches(product)]
+        if cursor is not None:
+            bound = (cursor[sort_field], cursor["__name__"])
+            products = [product for product in products if (key(product) < bound if descending else key(product) > bound)]
+        return heapq.nlargest(limit, products, key=key) if descending else heapq.nsmallest(limit, products, key=key)
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.ready,
+            "listening": self.listening,
+            "documents": len(self._products),
+            "approxBytes": self.approx_bytes,
+            "indexKeys": {field: len(index) for field, index in self._indexes.items()},
+            "resyncs": self.resyncs,
+            "lastSnapshotAt": self.last_snapshot_at.isoformat() if self.last_snapshot_at else None,
+        }
+
+
+PRODUCT_CATALOG_MODE = os.getenv("PRODUCT_CATALOG_MODE", "firestore")  # "firestore" or "snapshot"
+CATALOG_WATCHDOG_SECONDS = float(os.getenv("CATALOG_WATCHDOG_SECONDS", "10"))
+# The snapshot listener needs the real synchronous client, so the in-memory store always reads through
+product_catalog = ProductCatalog() if PRODUCT_CATALOG_MODE == "snapshot" and STORAGE_BACKEND == "firestore" else None
+
+
+def catalog_ready() -> bool:
+    return product_catalog is not None and product_catalog.ready
+
+
+async def run_catalog_watchdog():
+    """
+    Re-subscribes the catalog listener whenever its stream has stopped for good.
+    Reads fall back to Firestore until the new subscription delivers its first snapshot.
+    """
+    while True:
+        await asyncio.sleep(CATALOG_WATCHDOG_SECONDS)
+        if not product_catalog.listening:
+            print("Product catalog listener stopped; resubscribing.")
+            product_catalog.resyncs += 1
+            await run_blocking(product_catalog.unsubscribe)
+            await run_blocking(product_catalog.subscribe, firestore.client().collection('products'))
+
+
+# --- Full-text search index for product listings ---
+
+class SearchIndex:
+    """
+    In-process inverted index over the text fields of every product.
+
+    Tokens are lowercase alphanumeric runs. Each (token, product) posting carries
+    a weight summed from the fields the token appears in, so a hit in the name
+    outranks one buried in the description. Query terms also match as prefixes
+    of indexed tokens (search-as-you-type) at a discount, every query term must
+    match, and results are ranked by weight * idf.
+    """
+
+    FIELD_WEIGHTS = {"name": 3.0, "category": 2.0, "subcategory": 2.0, "specifications": 1.0, "description": 1.0}
+    PREFIX_DISCOUNT = 0.5
+    MAX_PREFIX_EXPANSIONS = 50
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}  # token -> {productId: weight}
+        self._doc_tokens = {}  # productId -> set(token), needed to unindex on update/delete
+        self._products = {}  # productId -> Product, so results need no Firestore reads
+        self._vocabulary = []  # sorted tokens, for prefix lookups
+        self.ready = False
+
+    @staticmethod
+    def tokenize(text: str) -> List[str]:
+        return TOKEN_PATTERN.findall(text.lower())
+
+    def add(self, product: "Product"):
+        weights = {}
+        for field, field_weight in self.FIELD_WEIGHTS.items():
+            for token in self.tokenize(getattr(product, field) or ""):
+                weights[token] = weights.get(token, 0.0) + field_weight
+        with self._lock:
+            self._unindex(product.productId)
+            self._products[product.productId] = product
+            self._doc_tokens[product.productId] = set(weights)
+            for token, weight in weights.items():
+                postings = self._postings.get(token)
+                if postings is None:
+                    postings = self._postings[token] = {}
+                    bisect.insort(self._vocabulary, token)
+                postings[product.productId] = weight
+
+    def remove(self, product_id: str):
+        with self._lock:
+            self._unindex(product_id)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._doc_tokens.clear()
+            self._products.clear()
+            self._vocabulary.clear()
+
+    def rebuild(self, products):
+        self.clear()
+        for product in products:
+            self.add(product)
+        self.ready = True
+
+    def _unindex(self, product_id: str):
+        self._products.pop(product_id, None)
+        for token in self._doc_tokens.pop(product_id, ()):
+            postings = self._postings.get(token)
+            if postings is None:
+                continue
+            postings.pop(product_id, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+
+    def _expand(self, term: str) -> List[tuple]:
+        """
+        Returns (token, discount) pairs for an exact match plus tokens the term is a prefix of.
+        """
+        matches = []
+        start = bisect.bisect_left(self._vocabulary, term)
+        for token in itertools.islice(self._vocabulary, start, start + self.MAX_PREFIX_EXPANSIONS):
+            if not token.startswith(term):
+                break
+            matches.append((token, 1.0 if token == term else self.PREFIX_DISCOUNT))
+        return matches
+
+    def search(self, query: str, limit: int, category: Optional[str] = None) -> List["Product"]:
+        terms = list(dict.fromkeys(self.tokenize(query)))
+        if not terms:
+            return []
+        with self._lock:
+            total = len(self._products) or 1
+            scores = None
+            for term in terms:
+                term_scores = {}
+                for token, discount in self._expand(term):
+                    postings = self._postings[token]
+                    idf = math.log(1 + total / len(postings))
+                    for product_id, weight in postings.items():
+                        score = weight * idf * discount
+                        if score > term_scores.get(product_id, 0.0):
+                            term_scores[product_id] = score
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {product_id: scores[product_id] + score for product_id, score in term_scores.items() if product_id in scores}
+                if not scores:
+                    return []
+            ranked = ((score, product_id) for product_id, score in scores.items()
+                      if category is None or self._products[product_id].category == category)
+            top = heapq.nlargest(limit, ranked, key=lambda item: (item[0], item[1]))
+            return [self._products[product_id] for _, product_id in top]
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "documents": len(self._products), "tokens": len(self._postings)}
+
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+# Without the snapshot catalog, each worker keeps its indexes current by reading only what changed
+# every SEARCH_REFRESH_SECONDS; the full re-read every SEARCH_REBUILD_SECONDS (0: startup only) is a safety net
+SEARCH_REFRESH_SECONDS = float(os.getenv("SEARCH_REFRESH_SECONDS", "30"))
+SEARCH_REBUILD_SECONDS = float(os.getenv("SEARCH_REBUILD_SECONDS", str(24 * 3600)))
+# Changes are re-read this far back, for writers whose clocks lag or whose commits land late
+SEARCH_REFRESH_OVERLAP_SECONDS = float(os.getenv("SEARCH_REFRESH_OVERLAP_SECONDS", "60"))
+# A deleted product leaves a tombstone in 'productDeletions' so other workers can unindex it;
+# Firestore's TTL policy on expireAt (see firestore.indexes.json) removes it after this many days
+PRODUCT_TOMBSTONE_DAYS = float(os.getenv("PRODUCT_TOMBSTONE_DAYS", "7"))
+search_index = SearchIndex()
+
+
+def product_tombstone(now: datetime.datetime) -> dict:
+    return {'deletedAt': now, 'expireAt': now + datetime.timedelta(days=PRODUCT_TOMBSTONE_DAYS)}
+
+
+# --- Product facets (GET /products/facets) ---
+
+FACET_FIELDS = ("category", "subcategory", "condition", "status")
+# Upper bounds of the price buckets; the last bucket is open-ended
+FACET_PRICE_BUCKETS = tuple(float(bound) for bound in os.getenv("FACET_PRICE_BUCKETS", "1000,5000,10000,25000,50000,100000").split(","))
+
+
+class FacetIndex:
+    """
+    Incrementally maintained counts behind GET /products/facets.
+
+    Products are grouped by their (category, subcategory, condition, status)
+    combination and each group keeps its prices sorted. There are only a few
+    hundred combinations however large the catalogue, so a scoped facet query
+    sums over groups, bisecting prices for a price range, instead of touching
+    products. It is kept current through the same add/remove/clear hooks as the
+    search index.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._groups = {}  # (category, subcategory, condition, status) -> sorted prices
+        self._entries = {}  # productId -> (group key, price), needed to remove on update/delete
+        self.ready = False
+
+    def add(self, product: "Product"):
+        key = tuple(getattr(product, field) for field in FACET_FIELDS)
+        with self._lock:
+            self._remove(product.productId)
+            bisect.insort(self._groups.setdefault(key, []), product.price)
+            self._entries[product.productId] = (key, product.price)
+
+    def remove(self, product_id: str):
+        with self._lock:
+            self._remove(product_id)
+
+    def clear(self):
+        with self._lock:
+            self._groups.clear()
+            self._entries.clear()
+
+    def rebuild(self, products):
+        self.clear()
+        for product in products:
+            self.add(product)
+        self.ready = True
+
+    def _remove(self, product_id: str):
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        key, price = entry
+        prices = self._groups[key]
+        del prices[bisect.bisect_left(prices, price)]
+        if not prices:
+            del self._groups[key]
+
+    def facets(self, filters: dict, min_price: Optional[float] = None, max_price: Optional[float] = None) -> dict:
+        """
+        Counts per value of each facet field and per price bucket. Each facet applies
+        every filter except its own (price buckets ignore the price range), so its
+        counts show what picking a different value would return; `total` applies them all.
+        """
+        wanted = [filters.get(field) for field in FACET_FIELDS]
+        counts = {field: {} for field in FACET_FIELDS}
+        price_counts = [0] * (len(FACET_PRICE_BUCKETS) + 1)
+        total = 0
+        with self._lock:
+            for key, prices in self._groups.items():
+                mismatched = [i for i, value in enumerate(wanted) if value is not None and key[i] != value]
+                if len(mismatched) > 1:
+                    continue
+                low = 0 if min_price is None else bisect.bisect_left(prices, min_price)
+                high = len(prices) if max_price is None else bisect.bisect_right(prices, max_price)
+                in_range = max(high - low, 0)
+                if in_range:
+                    for i, field in enumerate(FACET_FIELDS):
+                        if not mismatched or mismatched == [i]:
+                            counts[field][key[i]] = counts[field].get(key[i], 0) + in_range
+                if mismatched:
+                    continue
+                total += in_range
+                edges = [0, *(bisect.bisect_left(prices, bound) for bound in FACET_PRICE_BUCKETS), len(prices)]
+                for i in range(len(price_counts)):
+                    price_counts[i] += edges[i + 1] - edges[i]
+        lower_bounds = (0.0,) + FACET_PRICE_BUCKETS
+        upper_bounds = FACET_PRICE_BUCKETS + (None,)
+        return {
+            "total": total,
+            **{field: dict(sorted(values.items())) for field, values in counts.items()},
+            "price": [
+                {"min": low, "max": high, "count": count}
+                for low, high, count in zip(lower_bounds, upper_bounds, price_counts)
+            ],
+        }
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "documents": len(self._entries), "groups": len(self._groups)}
+
+
+facet_index = FacetIndex()
+
+
+def index_product(product: "Product"):
+    """
+    Adds or replaces a product in the in-process search and facet indexes.
+    """
+    search_index.add(product)
+    facet_index.add(product)
+
+
+def unindex_product(product_id: str):
+    search_index.remove(product_id)
+    facet_index.remove(product_id)
+
+
+def decode_indexable(docs) -> list:
+    """
+    Decodes product snapshots one by one for the search and facet indexes. A document that fails
+    validation is logged, counted and dropped from the indexes instead of failing the whole pass.
+    """
+    products = []
+    for doc in docs:
+        try:
+            products.append(product_codec.decode(doc))
+        except Exception as e:
+            print(f"Skipping product {doc.id} in search index: {e}")
+            invalid_documents.inc(("search",))
+            unindex_product(doc.id)
+    return products
+
+
+async def run_search_index_refresh():
+    """
+    Builds the search and facet indexes from a full read of 'products'. Every SEARCH_REFRESH_SECONDS
+    after that, it applies writes made by other workers: products whose updatedAt is newer than the
+    last pass, and tombstones of products deleted since, so the reads scale with the changes rather
+    than the catalog. Writes that skip the API or the tombstone are picked up by the full
+    rebuild every SEARCH_REBUILD_SECONDS.
+    Not used in snapshot catalog mode, where the listener keeps the indexes current.
+    """
+    since = None
+    rebuilt_at = 0.0
+    # Bad documents are skipped rather than failing the pass, so `since` keeps advancing; a fixed
+    # document gets a new updatedAt and is picked up by the next pass
+    while True:
+        started = datetime.datetime.now(datetime.timezone.utc)
+        try:
+            if since is None or (SEARCH_REBUILD_SECONDS and time.monotonic() - rebuilt_at >= SEARCH_REBUILD_SECONDS):
+                products = decode_indexable([doc async for doc in db.collection('products').stream()])
+                await run_blocking(search_index.rebuild, products)
+                await run_blocking(facet_index.rebuild, products)
+                rebuilt_at = time.monotonic()
+            else:
+                horizon = since - datetime.timedelta(seconds=SEARCH_REFRESH_OVERLAP_SECONDS)
+                changed = db.collection('products').where(filter=FieldFilter('updatedAt', '>', horizon))
+                for product in decode_indexable([doc async for doc in changed.stream()]):
+                    index_product(product)
+                deleted = db.collection('productDeletions').where(filter=FieldFilter('deletedAt', '>', horizon)).select([])
+                async for doc in deleted.stream():
+                    unindex_product(doc.id)
+            since = started
+        except Exception as e:
+            print(f"Error refreshing search index: {e}")
+        await asyncio.sleep(SEARCH_REFRESH_SECONDS)
+
+
+# Bearer token for GET /metrics and GET /cache/stats; without one they only answer loopback clients
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+
+async def require_metrics_access(request: Request, authorization: Optional[str] = Header(None)):
+    """
+    Dependency for the diagnostics routes, which expose gate, bucket and Firestore usage details.
+    Checks METRICS_TOKEN when it is set, otherwise that the request comes straight from this host.
+    """
+    if METRICS_TOKEN:
+        presented = (authorization or "").removeprefix("Bearer ")
+        if hmac.compare_digest(presented.encode(), METRICS_TOKEN.encode()):
+            return
+    elif "x-forwarded-for" not in request.headers and "forwarded" not in request.headers:
+        # A request relayed by a proxy on this host also connects from loopback, so forwarded ones are refused
+        host = request.client.host if request.client else None
+        try:
+            if host is not None and ipaddress.ip_address(host).is_loopback:
+                return
+        except ValueError:
+            pass
+    raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not allowed to read diagnostics.")
+
+
+@app.get("/cache/stats", summary="Read cache counters", dependencies=[Depends(require_metrics_access)])
+async def get_cache_stats():
+    """
+    Returns hit/miss/eviction counters for each in-process read cache,
+    plus document and memory counts for the live catalog when it is enabled.
+    """
+    stats = {cache.name: cache.stats() for cache in (product_cache, product_list_cache, review_cache, review_list_cache)}
+    if product_catalog is not None:
+        stats["catalog"] = product_catalog.stats()
+    stats["search"] = search_index.stats()
+    stats["facets"] = facet_index.stats()
+    stats["tokens"] = token_cache.stats()
+    stats["tokenVerification"] = token_verification_stats.stats()
+    stats["views"] = view_counter.stats()
+    stats["images"] = image_store.stats()
+    stats["jobs"] = job_runner.stats()
+    stats["admission"] = {label: gate.stats() for label, gate, _ in admission_policies.values() if gate is not None}
+    stats["rateLimits"] = rate_limit_store.stats()
+    return stats
+
+
+OPENMETRICS_MEDIA_TYPE = "application/openmetrics-text"
+
+
+@app.get("/metrics", summary="Prometheus metrics", include_in_schema=False, dependencies=[Depends(require_metrics_access)])
+async def get_metrics(request: Request):
+    """
+    Per-route request latency, Firestore reads/writes/queries/streamed documents,
+    document decode time and token verification time, plus the read cache counters.
+    Served as OpenMetrics when the scraper asks for it, Prometheus text format otherwise.
+    """
+    openmetrics = OPENMETRICS_MEDIA_TYPE in request.headers.get("accept", "")
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render(openmetrics))
+    caches = (product_cache, product_list_cache, review_cache, review_list_cache, token_cache, image_store)
+    for attribute in ("hits", "misses", "evictions"):
+        counter = Counter(f"cache_{attribute}_total", f"In-process cache {attribute}.", ("cache",))
+        for cache in caches:
+            counter.inc((cache.name,), getattr(cache, attribute))
+        lines.extend(counter.render(openmetrics))
+    if openmetrics:
+        lines.append("# EOF")
+        media_type = f"{OPENMETRICS_MEDIA_TYPE}; version=1.0.0; charset=utf-8"
+    else:
+        media_type = "text/plain; version=0.0.4; charset=utf-8"
+    return Response("\n".join(lines) + "\n", media_type=media_type)
+
+#==================================
+@app.get("/")
+async def read_root():
+    
+    if db: 
+        return {"message": "Welcome to Barely Used Bytes API!"}
+    else:
+        return {"message": "Database not found :("}
+    
+    
+# --- NDJSON streaming for bulk reads ---
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request: Request, stream: bool) -> bool:
+    """
+    A collection endpoint streams when asked via `?stream=1` or `Accept: application/x-ndjson`.
+    """
+    return stream or NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+async def ndjson_stream(docs, to_model):
+    """
+    Encodes documents from a Firestore stream() one line at a time as they arrive, so
+    memory stays flat and the first bytes leave before the last document is read.
+    The status line has already been sent by the time a mid-stream error happens,
+    so it is reported as a final {"error": ...} line.
+    """
+    try:
+        async for doc in docs:
+            yield to_model(doc).model_dump_json() + "\n"
+    except Exception as e:
+        yield json.dumps({"error": f"Stream aborted: {e}"}) + "\n"
+
+
+async def ndjson_lines(models):
+    for model in models:
+        yield model.model_dump_json() + "\n"
+
+
+# --- Sparse fieldsets ---
+
+class FastJSONResponse(JSONResponse):
+    """
+    JSON rendered with orjson, for payloads that skip response_model serialization.
+    """
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
+
+FIELD_SPEC = re.compile(r"^(\w+)(?:\[(\d+)\])?$")
+
+
+def parse_fields(fields: Optional[str], model) -> Optional[list]:
+    """
+    Parses `fields=productId,name,images[0]` into [(field, index or None), ...].
+    `name[i]` keeps only element i of a list field. Unknown fields are a 400.
+    """
+    if not fields:
+        return None
+    spec = []
+    for part in fields.split(","):
+        match = FIELD_SPEC.match(part.strip())
+        if match is None or match.group(1) not in model.model_fields:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown field in fields=: {part.strip()}")
+        index = match.group(2)
+        spec.append((match.group(1), int(index) if index is not None else None))
+    return spec
+
+
+def project(item: BaseModel, spec: list) -> dict:
+    data = {}
+    for name, index in spec:
+        value = getattr(item, name)
+        if index is not None and isinstance(value, list):
+            value = value[index:index + 1]
+        if isinstance(value, BaseModel):
+            value = value.model_dump()
+        elif isinstance(value, list):
+            value = [element.model_dump() if isinstance(element, BaseModel) else element for element in value]
+        data[name] = value
+    return data
+
+
+def sparse_response(items: list, spec: Optional[list], response: Response):
+    """
+    Returns the models unchanged without a fieldset; otherwise an orjson response
+    holding only the requested fields of each, carrying over the headers already set.
+    """
+    if spec is None:
+        return items
+    headers = {name: value for name, value in response.headers.items() if name != "content-length"}
+    return FastJSONResponse([project(item, spec) for item in items], headers=headers)
+
+
+# --- HTTP conditional requests ---
+
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", "30"))
+# Public reads may be cached by browsers and a CDN, which revalidate with the ETag once stale
+PUBLIC_CACHE_CONTROL = f"public, max-age={HTTP_CACHE_MAX_AGE}, stale-while-revalidate={HTTP_CACHE_MAX_AGE * 2}"
+
+
+def entity_etag(item: BaseModel) -> str:
+    """
+    Strong ETag for a single resource: a hash of exactly the JSON body that is sent.
+    """
+    return '"' + hashlib.sha256(item.model_dump_json().encode()).hexdigest()[:32] + '"'
+
+
+def collection_etag(items: list, version, *extra) -> str:
+    """
+    ETag for a page of a collection, from each item's `version(item)` (its ID and last
+    write timestamp) plus anything else that shapes the body, like the fieldset and next
+    cursor, so it costs no serialization. Writes through this API always move the timestamp.
+    """
+    digest = hashlib.sha256()
+    for item in items:
+        digest.update(repr(version(item)).encode())
+    digest.update(repr(extra).encode())
+    return '"' + digest.hexdigest()[:32] + '"'
+
+
+product_version = operator.attrgetter('productId', 'updatedAt')
+
+
+def review_version(review: "Review"):
+    return review.reviewId, review.updatedAt or review.reviewedAt
+
+
+def not_modified(request: Request, response: Response, etag: str, last_modified: Optional[datetime.datetime] = None):
+    """
+    Sets ETag, Last-Modified and Cache-Control on `response`. Returns a 304 response when the
+    client's If-None-Match (or, without one, If-Modified-Since) shows its copy is current,
+    otherwise None.
+    """
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = PUBLIC_CACHE_CONTROL
+    if last_modified is not None:
+        response.headers["Last-Modified"] = email.utils.format_datetime(last_modified.astimezone(datetime.timezone.utc), usegmt=True)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        current = "*" in tags or etag in tags
+    elif last_modified is not None and request.headers.get("if-modified-since"):
+        try:
+            since = email.utils.parsedate_to_datetime(request.headers["if-modified-since"])
+            current = last_modified.replace(microsecond=0) <= since
+        except (TypeError, ValueError):
+            current = False
+    else:
+        current = False
+    if not current:
+        return None
+    headers = {name: value for name, value in response.headers.items() if name in ("etag", "cache-control", "last-modified")}
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+# --- Transactional read-modify-write ---
+
+async def update_in_transaction(doc_ref, update_data: dict, not_found: str, authorize=None, related=None) -> dict:
+    """
+    Reads a document, runs `authorize(data)` on it and applies `update_data`, all in one
+    transaction, so the ownership check and the write see the same version of the document.
+    `authorize` raises HTTPException to refuse; the transaction is then rolled back.
+    `related(transaction, data)` may read and write other documents in the same transaction
+    (reads are issued before any write is queued, as Firestore requires).
+    Returns the document as it is after the update, built locally instead of read back.
+    """
+    @async_transactional
+    async def read_check_write(transaction):
+        snapshot = await doc_ref.get(transaction=transaction)
+        if not snapshot.exists:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=not_found)
+        data = snapshot.to_dict()
+        if authorize is not None:
+            authorize(data)
+        if related is not None:
+            await related(transaction, data)
+        transaction.update(doc_ref, update_data)
+        return data
+
+    data = await read_check_write(db.transaction())
+    for field, value in update_data.items():
+        if value is DELETE_FIELD:
+            data.pop(field, None)
+        else:
+            data[field] = value
+    return data
+
+
+# --- Batch reads ---
+
+BATCH_GET_MAX_IDS = int(os.getenv("BATCH_GET_MAX_IDS", "300"))
+
+
+class BatchGetRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=BATCH_GET_MAX_IDS)
+
+
+class ProductBatch(BaseModel):
+    items: List[Product]
+    missing: List[str]
+
+
+class OrderBatch(BaseModel):
+    items: List[Order]
+    missing: List[str]
+
+
+class ReviewBatch(BaseModel):
+    items: List[Review]
+    missing: List[str]
+
+
+async def batch_get(collection: str, ids: List[str], codec, known: Optional[dict] = None, allow=None):
+    """
+    Fetches every ID not already in `known` with a single get_all() round trip.
+    Returns (id -> model for found documents, IDs that do not exist or fail `allow(data)`),
+    both in request order with duplicates dropped.
+    """
+    ids = list(dict.fromkeys(ids))
+    found = dict(known or {})
+    wanted = [doc_id for doc_id in ids if doc_id not in found]
+    if wanted:
+        collection_ref = db.collection(collection)
+        async for doc in db.get_all([collection_ref.document(doc_id) for doc_id in wanted]):
+            if not doc.exists:
+                continue
+            data = doc.to_dict()
+            if allow is None or allow(data):
+                found[doc.id] = codec.decode_data(doc.id, data)
+    items = {doc_id: found[doc_id] for doc_id in ids if doc_id in found}
+    return items, [doc_id for doc_id in ids if doc_id not in found]
+
+
+# --- Bulk listing writes ---
+
+BULK_WRITE_MAX_OPERATIONS = int(os.getenv("BULK_WRITE_MAX_OPERATIONS", "1000"))
+# Firestore accepts at most 500 writes per batch commit
+BULK_WRITE_CHUNK_SIZE = 500
+
+
+class ProductCreateOperation(BaseModel):
+    op: Literal["create"]
+    product: ProductCreate
+
+
+class ProductUpdateOperation(BaseModel):
+    op: Literal["update"]
+    productId: str = Field(..., min_length=1)
+    product: ProductUpdate
+
+
+class ProductDeleteOperation(BaseModel):
+    op: Literal["delete"]
+    productId: str = Field(..., min_length=1)
+
+
+ProductWriteOperation = Annotated[
+    Union[ProductCreateOperation, ProductUpdateOperation, ProductDeleteOperation],
+    Field(discriminator="op"),
+]
+
+
+class ProductBulkWrite(BaseModel):
+    operations: List[ProductWriteOperation] = Field(..., min_length=1, max_length=BULK_WRITE_MAX_OPERATIONS)
+
+
+class ProductWriteResult(BaseModel):
+    # One entry per operation, in request order; status is the HTTP status the single-item endpoint would return
+    index: int
+    op: str
+    productId: Optional[str] = None
+    status: int
+    error: Optional[str] = None
+    product: Optional[Product] = None
+
+
+# --- Sharded product view counters ---
+
+VIEW_SHARDS = int(os.getenv("VIEW_SHARDS", "10"))
+VIEW_FLUSH_SECONDS = float(os.getenv("VIEW_FLUSH_SECONDS", "10"))
+VIEW_TOTAL_TTL_SECONDS = float(os.getenv("VIEW_TOTAL_TTL_SECONDS", "60"))
+
+
+class ViewCounter:
+    """
+    Counts product views without putting a Firestore write on the read path.
+
+    record() only bumps an in-memory counter. flush() writes the buffered counts as
+    Increment()s into one random shard of products/{id}/view_shards each, so workers
+    spread their writes over VIEW_SHARDS documents instead of contending on one.
+    A product's total is the sum of its shards (cached for VIEW_TOTAL_TTL_SECONDS)
+    plus whatever this process has not flushed yet.
+    """
+
+    def __init__(self, shards: int, total_ttl: float):
+        self.shards = shards
+        self.pending = {}  # product_id -> views not yet written
+        self.totals = TTLCache("view_totals", CACHE_MAX_ENTRIES, total_ttl)
+        self.flushed = 0
+        self.flush_errors = 0
+
+    def record(self, product_id: str):
+        self.pending[product_id] = self.pending.get(product_id, 0) + 1
+
+    def discard(self, product_id: str):
+        self.pending.pop(product_id, None)
+        self.totals.invalidate(product_id)
+
+    def _shards(self, product_id: str):
+        return db.collection('products').document(product_id).collection('view_shards')
+
+    async def total(self, product_id: str, include_pending: bool = True) -> int:
+        flushed = self.totals.get(product_id)
+        if flushed is None:
+            generation = self.totals.generation
+            flushed = 0
+            async for shard in self._shards(product_id).stream():
+                flushed += shard.to_dict().get('count', 0)
+            self.totals.set(product_id, flushed, generation)
+        return flushed + (self.pending.get(product_id, 0) if include_pending else 0)
+
+    async def flush(self):
+        """
+        Writes every buffered count in WriteBatches of up to 500 shard increments.
+        Counts from a batch that fails (or is cancelled mid-commit) go back into the buffer.
+        """
+        pending, self.pending = self.pending, {}
+        items = list(pending.items())
+        for start in range(0, len(items), BULK_WRITE_CHUNK_SIZE):
+            chunk = items[start:start + BULK_WRITE_CHUNK_SIZE]
+            batch = db.batch()
+            for product_id, count in chunk:
+                shard_ref = self._shards(product_id).document(str(random.randrange(self.shards)))
+                batch.set(shard_ref, {'count': firestore.Increment(count)}, merge=True)
+            try:
+                await batch.commit()
+            except BaseException:
+                self.flush_errors += 1
+                for product_id, count in items[start:]:
+                    self.pending[product_id] = self.pending.get(product_id, 0) + count
+                raise
+            for product_id, count in chunk:
+                self.totals.invalidate(product_id)
+            self.flushed += sum(count for _, count in chunk)
+
+    def stats(self) -> dict:
+        return {
+            "shards": self.shards,
+            "pendingProducts": len(self.pending),
+            "pendingViews": sum(self.pending.values()),
+            "flushedViews": self.flushed,
+            "flushErrors": self.flush_errors,
+            "totals": self.totals.stats(),
+        }
+
+
+view_counter = ViewCounter(VIEW_SHARDS, VIEW_TOTAL_TTL_SECONDS)
+
+
+async def run_view_flush():
+    """
+    Flushes buffered product views every VIEW_FLUSH_SECONDS.
+    """
+    while True:
+        await asyncio.sleep(VIEW_FLUSH_SECONDS)
+        try:
+            await view_counter.flush()
+        except Exception as e:
+            print(f"Error flushing product views: {e}")
+
+
+async def with_views(product: "Product") -> "Product":
+    """
+    Counts a view of `product` and returns a copy carrying its flushed view total.
+    Unflushed views are left out so the body (and its ETag) only changes when the
+    cached shard total does, not on every request.
+    """
+    view_counter.record(product.productId)
+    flushed = await view_counter.total(product.productId, include_pending=False)
+    return product.model_copy(update={'views': product.views + flushed})
+
+
+# --- Product image thumbnails ---
+
+# Listing images are arbitrary seller URLs, often multi-megabyte photos. The thumbnail worker
+# downloads each one after a product write, renders fixed-size variants in a process pool and
+# stores them on local disk under the SHA-256 of the source bytes; Product.thumbnails then points
+# at GET /images/{digest}/{variant}, which is immutable and cached by browsers for a year.
+# Sources are only fetched from public addresses (see connect_public), since sellers choose the URLs.
+# Pillow is optional: without it products keep only their original URLs.
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".image-cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_MAX_SOURCE_BYTES = int(os.getenv("IMAGE_MAX_SOURCE_BYTES", str(10 * 1024 * 1024)))
+IMAGE_FETCH_TIMEOUT_SECONDS = float(os.getenv("IMAGE_FETCH_TIMEOUT_SECONDS", "10"))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_QUEUE_SIZE = int(os.getenv("IMAGE_QUEUE_SIZE", "1000"))
+IMAGE_MAX_REDIRECTS = int(os.getenv("IMAGE_MAX_REDIRECTS", "3"))
+# Uploaded originals are the only copy of their image, so instead of being evicted they are capped:
+# per user (tracked in Firestore, so it holds across processes) and on this node's disk
+IMAGE_UPLOAD_QUOTA_BYTES = int(os.getenv("IMAGE_UPLOAD_QUOTA_BYTES", str(100 * 1024 * 1024)))
+IMAGE_ORIGINALS_MAX_BYTES = int(os.getenv("IMAGE_ORIGINALS_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Prefix for the variant URLs stored on products; empty keeps them relative to the API origin
+IMAGE_BASE_URL = os.getenv("IMAGE_BASE_URL", "").rstrip("/")
+
+# variant -> (bounding box, crop to fill it). The card box matches the 200px ProductCard image at 2x.
+IMAGE_VARIANTS = {"thumb": ((160, 160), True), "card": ((400, 400), False)}
+IMAGE_FORMATS = {"webp": ("WEBP", "image/webp"), "jpg": ("JPEG", "image/jpeg")}
+IMAGE_FILES = frozenset(f"{variant}.{extension}" for variant in IMAGE_VARIANTS for extension in IMAGE_FORMATS)
+IMAGE_ORIGINAL = "original"
+IMAGE_DIGEST = re.compile(r"^[0-9a-f]{64}$")
+IMAGE_ORIGINAL_PATH = re.compile(r"/images/([0-9a-f]{64})/original$")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def render_variants(source: bytes) -> dict:
+    """
+    Decodes an image and returns {"thumb.webp": bytes, "thumb.jpg": bytes, "card.webp": ...}.
+    Runs in the image process pool, so it only takes and returns picklable values.
+    """
+    largest = max(box for box, _ in IMAGE_VARIANTS.values())
+    rendered = {}
+    with Image.open(io.BytesIO(source)) as image:
+        # JPEG sources can be decoded at a reduced scale directly, which is far cheaper than a full decode
+        image.draft("RGB", largest)
+        image = ImageOps.exif_transpose(image).convert("RGB")
+        for variant, (box, crop) in IMAGE_VARIANTS.items():
+            resized = ImageOps.fit(image, box, Image.Resampling.LANCZOS) if crop else ImageOps.contain(image, box, Image.Resampling.LANCZOS)
+            for extension, (image_format, _) in IMAGE_FORMATS.items():
+                out = io.BytesIO()
+                resized.save(out, image_format, quality=IMAGE_QUALITY)
+                rendered[f"{variant}.{extension}"] = out.getvalue()
+    return rendered
+
+
+class ImageStore:
+    """
+    Content-addressed image files under `root`: <root>/<digest[:2]>/<digest>/<name>.
+    Rendered variants are evicted least-recently-served first once they add up to more
+    than `max_bytes`; they can always be rendered again from the source. Uploaded originals
+    are the only copy of their image, so they are never evicted; once they add up to
+    `max_original_bytes`, further originals are refused instead.
+    Methods touch the disk and are called through run_blocking.
+    """
+
+    def __init__(self, root: str, max_bytes: int, max_original_bytes: int):
+        self.name = "images"
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_original_bytes = max_original_bytes
+        self._sizes = OrderedDict()  # variant path -> size, least recently served first
+        self._bytes = 0
+        self._original_bytes = 0
+        self._originals_writing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, digest: str, name: str) -> str:
+        return os.path.join(self.root, digest[:2], digest, name)
+
+    def scan(self):
+        """
+        Picks up variants left by a previous run, oldest access first.
+        """
+        found = []
+        originals = 0
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name in IMAGE_FILES:
+                    stat = os.stat(os.path.join(directory, name))
+                    found.append((stat.st_atime, os.path.join(directory, name), stat.st_size))
+                elif name == IMAGE_ORIGINAL:
+                    originals += os.path.getsize(os.path.join(directory, name))
+        with self._lock:
+            self._original_bytes += originals
+            for _, path, size in sorted(found):
+                self._sizes[path] = size
+                self._bytes += size
+        self._evict()
+
+    def get(self, digest: str, name: str) -> Optional[str]:
+        path = self.path(digest, name)
+        with self._lock:
+            if path in self._sizes:
+                self._sizes.move_to_end(path)
+                self.hits += 1
+                return path
+            if name == IMAGE_ORIGINAL and os.path.exists(path):
+                return path
+            self.misses += 1
+            return None
+
+    def has_variants(self, digest: str) -> bool:
+        with self._lock:
+            return all(self.path(digest, name) in self._sizes for name in IMAGE_FILES)
+
+    def read_original(self, digest: str) -> Optional[bytes]:
+        try:
+            with open(self.path(digest, IMAGE_ORIGINAL), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_original(self, digest: str, data: bytes) -> bool:
+        """
+        Stores an uploaded original; False when that would take originals past `max_original_bytes`.
+        An original already stored (or being stored) is kept as it is and counted once.
+        """
+        path = self.path(digest, IMAGE_ORIGINAL)
+        with self._lock:
+            if digest in self._originals_writing or os.path.exists(path):
+                return True
+            if self._original_bytes + len(data) > self.max_original_bytes:
+                return False
+            self._original_bytes += len(data)
+            self._originals_writing.add(digest)
+        try:
+            self._write(path, data)
+        except BaseException:
+            with self._lock:
+                self._original_bytes -= len(data)
+            raise
+        finally:
+            with self._lock:
+                self._originals_writing.discard(digest)
+        return True
+
+    def put(self, digest: str, files: dict):
+        for name, data in files.items():
+            path = self.path(digest, name)
+            self._write(path, data)
+            with self._lock:
+                self._bytes += len(data) - self._sizes.pop(path, 0)
+                self._sizes[path] = len(data)
+        self._evict()
+
+    def _write(self, path: str, data: bytes):
+        # Written under a temporary name and renamed, so a concurrent reader never sees a partial file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def _evict(self):
+        while True:
+            with self._lock:
+                if self._bytes <= self.max_bytes or not self._sizes:
+                    return
+                path, size = self._sizes.popitem(last=False)
+                self._bytes -= size
+                self.evictions += 1
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                # Other variants (or a pinned original) still live in the directory
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": Image is not None,
+                "files": len(self._sizes),
+                "bytes": self._bytes,
+                "maxBytes": self.max_bytes,
+                "originalBytes": self._original_bytes,
+                "maxOriginalBytes": self.max_original_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+image_store = ImageStore(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, IMAGE_ORIGINALS_MAX_BYTES)
+# Resizing is CPU-bound, so it runs in worker processes instead of competing with the event loop for the GIL
+image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS) if Image is not None else None
+thumbnail_queue: asyncio.Queue = asyncio.Queue(maxsize=IMAGE_QUEUE_SIZE)
+thumbnail_pending = set()
+
+
+def image_variants(digest: str, source: str) -> "ImageVariants":
+    base = f"{IMAGE_BASE_URL}/images/{digest}"
+    return ImageVariants(source=source, thumb=f"{base}/thumb.webp", card=f"{base}/card.webp")
+
+
+def is_public_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None, **kwargs):
+    """
+    socket.create_connection that resolves the host once and refuses it unless every address
+    is public, then connects to the checked address, so a second lookup cannot swap in another.
+    Keeps seller-supplied image URLs away from loopback, private networks and the metadata server.
+    """
+    host, port = address
+    addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    refused = [sockaddr[0] for *_, sockaddr in addresses if not is_public_address(sockaddr[0])]
+    if refused or not addresses:
+        raise ValueError(f"Refusing to fetch images from {host} ({', '.join(refused) or 'no address'})")
+    return socket.create_connection(addresses[0][4][:2], timeout, source_address)
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = connect_public
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req, context=self._context)
+
+
+class ImageRedirectHandler(urllib.request.HTTPRedirectHandler):
+    max_redirections = IMAGE_MAX_REDIRECTS
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if urllib.parse.urlsplit(newurl).scheme not in ("http", "https"):
+            raise ValueError(f"Refusing image redirect to {newurl}")
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+# Only http(s), no proxies, and every hop (redirects included) connects through connect_public
+image_opener = urllib.request.OpenerDirector()
+for handler in (PublicHTTPHandler(), PublicHTTPSHandler(), ImageRedirectHandler(),
+                urllib.request.HTTPDefaultErrorHandler(), urllib.request.HTTPErrorProcessor()):
+    image_opener.add_handler(handler)
+
+
+def fetch_image(url: str) -> bytes:
+    """
+    Downloads a source image, refusing anything but http(s) to public addresses and bodies over IMAGE_MAX_SOURCE_BYTES.
+    """
+    if urllib.parse.urlsplit(url).scheme not in ("http", "https"):
+        raise ValueError(f"Unsupported image URL: {url}")
+    with image_opener.open(url, timeout=IMAGE_FETCH_TIMEOUT_SECONDS) as response:
+        data = response.read(IMAGE_MAX_SOURCE_BYTES + 1)
+    if len(data) > IMAGE_MAX_SOURCE_BYTES:
+        raise ValueError(f"Image larger than {IMAGE_MAX_SOURCE_BYTES} bytes: {url}")
+    return data
+
+
+async def load_image_source(url: str) -> bytes:
+    # Images uploaded to this API are read from disk instead of over HTTP
+    match = IMAGE_ORIGINAL_PATH.search(urllib.parse.urlsplit(url).path)
+    if match is not None:
+        data = await run_blocking(image_store.read_original, match.group(1))
+        if data is not None:
+            return data
+    return await run_blocking(fetch_image, url)
+
+
+async def generate_variants(source: str, data: Optional[bytes] = None) -> "ImageVariants":
+    """
+    Renders and stores the variants of one image unless they are already cached, and records
+    digest -> source URL in 'images' so another worker (or this one after eviction) can re-render them.
+    """
+    if data is None:
+        data = await load_image_source(source)
+    digest = hashlib.sha256(data).hexdigest()
+    if not await run_blocking(image_store.has_variants, digest):
+        rendered = await asyncio.get_running_loop().run_in_executor(image_executor, render_variants, data)
+        await run_blocking(image_store.put, digest, rendered)
+        await db.collection('images').document(digest).set({'sourceUrl': source})
+    return image_variants(digest, source)
+
+
+def schedule_thumbnails(product: "Product"):
+    """
+    Queues a product for the thumbnail worker when its thumbnails do not cover its current images.
+    """
+    if image_executor is None or product.productId in thumbnail_pending:
+        return
+    if [thumbnail.source for thumbnail in product.thumbnails] == product.images:
+        return
+    try:
+        thumbnail_queue.put_nowait(product.productId)
+        thumbnail_pending.add(product.productId)
+    except asyncio.QueueFull:
+        # The listing keeps serving its originals; scripts/backfill_thumbnails.py catches it up later
+        print(f"Thumbnail queue full; skipping product {product.productId}")
+
+
+async def refresh_thumbnails(product_id: str) -> bool:
+    """
+    Renders variants for every image of a product and stores them as its `thumbnails`.
+    Images that cannot be fetched or decoded are left out. The write only goes through if
+    `images` is unchanged since it was read; a newer edit has queued its own refresh.
+    Returns whether the product was updated.
+    """
+    product_ref = db.collection('products').document(product_id)
+    doc = await product_ref.get()
+    if not doc.exists:
+        return False
+    product_data = doc.to_dict()
+    images = product_data.get('images') or []
+    known = {thumbnail['source']: thumbnail for thumbnail in product_data.get('thumbnails') or []}
+    thumbnails = []
+    for source in images:
+        if source in known:
+            thumbnails.append(known[source])
+            continue
+        try:
+            thumbnails.append((await generate_variants(source)).model_dump())
+        except Exception as e:
+            print(f"Error rendering thumbnails for {source}: {e}")
+    if thumbnails == product_data.get('thumbnails'):
+        return False
+
+    def unchanged(data):
+        if data.get('images') != images:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Product images changed while rendering.")
+
+    update_data = {'thumbnails': thumbnails, 'updatedAt': datetime.datetime.now(datetime.timezone.utc)}
+    try:
+        product_data = await update_in_transaction(product_ref, update_data, "Product not found", unchanged)
+    except HTTPException:
+        return False
+    apply_listing_change(product_id, product_data)
+    return True
+
+
+async def run_thumbnail_worker():
+    """
+    Takes product IDs off the thumbnail queue; IMAGE_WORKERS of these run side by side.
+    """
+    while True:
+        product_id = await thumbnail_queue.get()
+        thumbnail_pending.discard(product_id)
+        try:
+            await refresh_thumbnails(product_id)
+        except Exception as e:
+            print(f"Error refreshing thumbnails for product {product_id}: {e}")
+
+
+""" Image Endpoints """
+
+@app.get("/images/{digest}/{name}", summary="Get a resized product image", include_in_schema=False)
+async def get_image(digest: str, name: str):
+    """
+    Serves a variant (thumb/card, .webp or .jpg) or an uploaded original by content digest.
+    The URL changes whenever the image does, so responses are cacheable forever.
+    A variant evicted from this node's cache is rendered again from its recorded source.
+    """
+    if not IMAGE_DIGEST.match(digest) or (name not in IMAGE_FILES and name != IMAGE_ORIGINAL):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    path = await run_blocking(image_store.get, digest, name)
+    if path is None and name != IMAGE_ORIGINAL and image_executor is not None and db is not None:
+        try:
+            doc = await db.collection('images').document(digest).get()
+            if doc.exists:
+                source = doc.to_dict()['sourceUrl']
+                data = await load_image_source(source)
+                # The source may have changed since it was recorded; only its old bytes match this URL
+                if hashlib.sha256(data).hexdigest() == digest:
+                    await generate_variants(source, data)
+                    path = await run_blocking(image_store.get, digest, name)
+        except Exception as e:
+            print(f"Error re-rendering image {digest}: {e}")
+    if path is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    media_type = IMAGE_FORMATS[name.rsplit(".", 1)[1]][1] if name != IMAGE_ORIGINAL else None
+    return FileResponse(path, media_type=media_type, headers={"Cache-Control": IMMUTABLE_CACHE_CONTROL})
+
+
+async def charge_upload_quota(uid: str, digest: str, size: int) -> bool:
+    """
+    Adds an upload to the user's running total in 'imageUploads', refusing it with 403 past
+    IMAGE_UPLOAD_QUOTA_BYTES. Each charged image is recorded under imageUploads/{uid}/images/{digest}
+    and read in the same transaction, so an image the user already uploaded (even concurrently)
+    is not charged twice. Returns whether this call charged the upload.
+    """
+    quota_ref = db.collection('imageUploads').document(uid)
+    upload_ref = quota_ref.collection('images').document(digest)
+
+    @async_transactional
+    async def charge(transaction):
+        upload = await upload_ref.get(transaction=transaction)
+        if upload.exists:
+            return False
+        snapshot = await quota_ref.get(transaction=transaction)
+        total = (snapshot.to_dict().get('bytes', 0) if snapshot.exists else 0) + size
+        if total > IMAGE_UPLOAD_QUOTA_BYTES:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"Upload quota of {IMAGE_UPLOAD_QUOTA_BYTES} bytes used up.",
+            )
+        transaction.set(quota_ref, {'bytes': total, 'uploads': firestore.Increment(1)}, merge=True)
+        transaction.set(upload_ref, {'bytes': size, 'uploadedAt': datetime.datetime.now(datetime.timezone.utc)})
+        return True
+
+    return await charge(db.transaction())
+
+
+async def refund_upload_quota(uid: str, digest: str, size: int):
+    """
+    Takes back a charge made by charge_upload_quota for an upload that was not stored.
+    """
+    quota_ref = db.collection('imageUploads').document(uid)
+    batch = db.batch()
+    batch.update(quota_ref, {'bytes': firestore.Increment(-size), 'uploads': firestore.Increment(-1)})
+    batch.delete(quota_ref.collection('images').document(digest))
+    await batch.commit()
+
+
+@app.post("/images", response_model=ImageVariants, status_code=status.HTTP_201_CREATED, summary="Upload a product image")
+async def upload_image(request: Request, current_user: dict = Depends(get_current_user)):
+    """
+    Stores the raw request body (Content-Type: image/*) as an original and renders its variants.
+    Put the returned `source` URL in a product's `images`; its thumbnails are then found in the cache.
+    """
+    if image_executor is None:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Image processing is not available.")
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    if not request.headers.get("content-type", "").startswith("image/"):
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE, detail="Upload the image bytes with an image/* Content-Type.")
+    data = bytearray()
+    async for chunk in request.stream():
+        data.extend(chunk)
+        if len(data) > IMAGE_MAX_SOURCE_BYTES:
+            raise HTTPException(status_code=status.HTTP_413_CONTENT_TOO_LARGE, detail=f"Images are limited to {IMAGE_MAX_SOURCE_BYTES} bytes.")
+    data = bytes(data)
+    digest = hashlib.sha256(data).hexdigest()
+    source = f"{IMAGE_BASE_URL}/images/{digest}/{IMAGE_ORIGINAL}"
+    # Charged before rendering, so a user past the quota costs no render and evicts no cached variants
+    charged = await charge_upload_quota(current_user['uid'], digest, len(data))
+    try:
+        try:
+            variants = await generate_variants(source, data)
+        except (Image.UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported image: {e}")
+        except Exception as e:
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error processing image: {e}")
+        # Kept only once it decoded, so the originals on disk are real images
+        if not await run_blocking(image_store.put_original, digest, data):
+            raise HTTPException(status_code=status.HTTP_507_INSUFFICIENT_STORAGE, detail="Image storage is full.")
+    except HTTPException:
+        if charged:
+            await refund_upload_quota(current_user['uid'], digest, len(data))
+        raise
+    return variants
+
+
+# --- Background jobs (cascading deletes) ---
+
+# Work too large for a request, like deleting everything a user owns, runs as a job: a document
+# in 'jobs' holding its type, parameters, status and progress, so it survives restarts and any API
+# process can pick it up. Each process runs JOB_WORKERS loops that claim due jobs in a transaction
+# and hold them under a lease, renewed on every progress report; a job whose process died is
+# claimed again once its lease runs out. Failed attempts are retried with exponential backoff up
+# to JOB_MAX_ATTEMPTS times, so handlers must be safe to run again from the start.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_RETRY_SECONDS = float(os.getenv("JOB_RETRY_SECONDS", "10"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "10"))
+JOB_PAGE_SIZE = int(os.getenv("JOB_PAGE_SIZE", "500"))
+# BulkWriter ceiling; it starts at up to 500 writes/s and ramps up from there (Firestore's 500/50/5 rule)
+JOB_BULK_OPS_PER_SECOND = int(os.getenv("JOB_BULK_OPS_PER_SECOND", "500"))
+ORPHAN_CLEANUP_HOURS = float(os.getenv("ORPHAN_CLEANUP_HOURS", "24"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+
+class Job(BaseModel):
+    jobId: str
+    type: str
+    status: str  # queued, running, succeeded or failed
+    params: dict = {}
+    progress: Dict[str, int] = {}  # documents handled so far, per collection
+    attempts: int = 0
+    error: Optional[str] = None  # from the last failed attempt
+    createdBy: Optional[str] = None
+    createdAt: datetime.datetime
+    updatedAt: datetime.datetime
+    runAfter: Optional[datetime.datetime] = None
+    finishedAt: Optional[datetime.datetime] = None
+
+
+job_codec = DocumentCodec(Job, 'jobId')
+
+
+class JobRun:
+    """
+    What a handler gets: the job's parameters, and report() to add to its progress.
+    Reporting also renews the lease, so handlers report at least once per JOB_LEASE_SECONDS.
+    """
+
+    def __init__(self, job_id: str, data: dict):
+        self.id = job_id
+        self.params = data.get('params') or {}
+        self.progress = dict(data.get('progress') or {})
+
+    async def report(self, **counts):
+        for name, count in counts.items():
+            self.progress[name] = self.progress.get(name, 0) + count
+        now = datetime.datetime.now(datetime.timezone.utc)
+        await db.collection('jobs').document(self.id).update({
+            'progress': self.progress,
+            'leaseUntil': now + datetime.timedelta(seconds=JOB_LEASE_SECONDS),
+            'updatedAt': now,
+        })
+
+
+class JobRunner:
+    """
+    In-process workers for the persistent 'jobs' queue. Handlers are registered per job type
+    with @job_runner.handler("type") and receive a JobRun.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.wake = asyncio.Event()
+        self.running = 0
+        self.succeeded = 0
+        self.retried = 0
+        self.failed = 0
+
+    def handler(self, job_type: str):
+        def register(func):
+            self.handlers[job_type] = func
+            return func
+        return register
+
+    async def enqueue(self, job_type: str, params: dict, created_by: Optional[str] = None, job_id: Optional[str] = None,
+                      delay: float = 0, rerun_finished: bool = True, rerun_running: bool = False) -> Job:
+        """
+        Stores a job that becomes due after `delay` seconds and wakes this process's workers.
+        With `job_id`, a job of that ID that is still queued or running is returned instead of
+        queueing a second one (or any existing one, with rerun_finished=False). With
+        rerun_running, a running job is marked to be queued again (after its `delay`) once the
+        current attempt succeeds, for work that must see changes made while it ran.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        data = {
+            'type': job_type, 'params': params, 'status': JOB_QUEUED, 'attempts': 0, 'progress': {},
+            'error': None, 'createdBy': created_by, 'createdAt': now, 'updatedAt': now,
+            'runAfter': now + datetime.timedelta(seconds=delay), 'delaySeconds': delay, 'rerun': False,
+        }
+        jobs_ref = db.collection('jobs')
+        if job_id is None:
+            job_ref = jobs_ref.document()
+            await job_ref.set(data)
+        else:
+            job_ref = jobs_ref.document(job_id)
+
+            @async_transactional
+            async def enqueue_once(transaction):
+                snapshot = await job_ref.get(transaction=transaction)
+                if snapshot.exists:
+                    existing = snapshot.to_dict()
+                    if existing['status'] == JOB_RUNNING and rerun_running and not existing.get('rerun'):
+                        transaction.update(job_ref, {'rerun': True})
+                        return {**existing, 'rerun': True}
+                    if existing['status'] in (JOB_QUEUED, JOB_RUNNING) or not rerun_finished:
+                        return existing
+                transaction.set(job_ref, data)
+                return data
+
+            data = await enqueue_once(db.transaction())
+        self.wake.set()
+        return job_codec.decode_data(job_ref.id, dict(data))
+
+    @staticmethod
+    def _claimable(data: dict, now: datetime.datetime) -> bool:
+        if data.get('status') == JOB_QUEUED:
+            return data['runAfter'] <= now
+        return data.get('status') == JOB_RUNNING and data['leaseUntil'] <= now
+
+    async def claim(self) -> Optional[tuple]:
+        """
+        Takes the longest-waiting due job, or a running one whose lease has expired.
+        Returns (job ID, job data) or None when there is nothing to do.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+        jobs_ref = db.collection('jobs')
+        due = (jobs_ref.where(filter=FieldFilter('status', '==', JOB_QUEUED))
+               .where(filter=FieldFilter('runAfter', '<=', now)).order_by('runAfter').limit(JOB_WORKERS))
+        abandoned = (jobs_ref.where(filter=FieldFilter('status', '==', JOB_RUNNING))
+                     .where(filter=FieldFilter('leaseUntil', '<=', now)).order_by('leaseUntil').limit(JOB_WORKERS))
+        for query in (due, abandoned):
+            async for doc in query.stream():
+                job_ref = jobs_ref.document(doc.id)
+
+                @async_transactional
+                async def take(transaction):
+                    # Another worker may have claimed it since the query ran
+                    snapshot = await job_ref.get(transaction=transaction)
+                    data = snapshot.to_dict() if snapshot.exists else None
+                    if data is None or not self._claimable(data, now):
+                        return None
+                    update = {
+                        'status': JOB_RUNNING,
+                        'attempts': data.get('attempts', 0) + 1,
+                        'leaseUntil': now + datetime.timedelta(seconds=JOB_LEASE_SECONDS),
+                        'updatedAt': now,
+                    }
+                    transaction.update(job_ref, update)
+                    return {**data, **update}
+
+                data = await take(db.transaction())
+                if data is not None:
+                    return doc.id, data
+        return None
+
+    async def execute(self, job_id: str, data: dict):
+        """
+        Runs one claimed attempt and records its outcome on the job document.
+        """
+        run = JobRun(job_id, data)
+        handler = self.handlers.get(data['type'])
+        self.running += 1
+        try:
+            if handler is None:
+                raise ValueError(f"Unknown job type: {data['type']}")
+            await handler(run)
+        except Exception as e:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            update = {'progress': run.progress, 'error': str(e), 'updatedAt': now}
+            if data['attempts'] >= JOB_MAX_ATTEMPTS:
+                update.update(status=JOB_FAILED, finishedAt=now)
+                self.failed += 1
+            else:
+                delay = JOB_RETRY_SECONDS * 2 ** (data['attempts'] - 1)
+                update.update(status=JOB_QUEUED, runAfter=now + datetime.timedelta(seconds=delay))
+                self.retried += 1
+            print(f"Job {job_id} ({data['type']}) attempt {data['attempts']} failed: {e}")
+            await db.collection('jobs').document(job_id).update(update)
+        else:
+            job_ref = db.collection('jobs').document(job_id)
+            now = datetime.datetime.now(datetime.timezone.utc)
+
+            @async_transactional
+            async def finish(transaction):
+                # enqueue(rerun_running=True) may have flagged the job while this attempt ran
+                snapshot = await job_ref.get(transaction=transaction)
+                current = snapshot.to_dict() if snapshot.exists else {}
+                update = {'progress': run.progress, 'error': None, 'updatedAt': now}
+                if current.get('rerun'):
+                    delay = datetime.timedelta(seconds=current.get('delaySeconds', 0))
+                    update.update(status=JOB_QUEUED, rerun=False, attempts=0, runAfter=now + delay)
+                else:
+                    update.update(status=JOB_SUCCEEDED, finishedAt=now)
+                transaction.update(job_ref, update)
+                return update['status']
+
+            if await finish(db.transaction()) == JOB_QUEUED:
+                self.wake.set()
+            self.succeeded += 1
+        finally:
+            self.running -= 1
+
+    async def run(self):
+        """
+        Worker loop: runs due jobs back to back, then waits for enqueue() or JOB_POLL_SECONDS.
+        A job interrupted by shutdown stays 'running' and is claimed again when its lease expires.
+        """
+        while True:
+            self.wake.clear()
+            try:
+                claimed = await self.claim()
+                if claimed is not None:
+                    await self.execute(*claimed)
+                    continue
+            except Exception as e:
+                print(f"Error running background jobs: {e}")
+            # asyncio.wait rather than wait_for: on Python < 3.12, wait_for swallows a cancel that lands
+            # just as the event is set (e.g. by the startup cleanup enqueue), and shutdown then hangs
+            waiter = asyncio.ensure_future(self.wake.wait())
+            try:
+                await asyncio.wait({waiter}, timeout=JOB_POLL_SECONDS)
+            finally:
+                waiter.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "workers": JOB_WORKERS,
+            "types": sorted(self.handlers),
+            "running": self.running,
+            "succeeded": self.succeeded,
+            "retried": self.retried,
+            "failed": self.failed,
+        }
+
+
+job_runner = JobRunner()
+
+
+def bulk_write(operations: list) -> int:
+    """
+    Applies [("set" | "update" | "delete", document path, data)] through a BulkWriter throttled to
+    JOB_BULK_OPS_PER_SECOND, retrying each failed write up to JOB_MAX_ATTEMPTS times, and
+    blocks until all are done. BulkWriter runs its batches on its own threads and only works
+    with the synchronous client, so this goes through firestore.client() rather than `db`.
+    Call it through run_blocking.
+    """
+    client = db._target if STORAGE_BACKEND == "memory" else firestore.client()
+    writer = client.bulk_writer(BulkWriterOptions(
+        initial_ops_per_second=min(JOB_BULK_OPS_PER_SECOND, 500), max_ops_per_second=JOB_BULK_OPS_PER_SECOND))
+    failures = []
+
+    def on_write_error(failure, _writer) -> bool:
+        if failure.attempts < JOB_MAX_ATTEMPTS:
+            return True
+        failures.append(failure)
+        return False
+
+    writer.on_write_error(on_write_error)
+    for kind, path, data in operations:
+        if kind == "delete":
+            writer.delete(client.document(path))
+        elif kind == "set":
+            writer.set(client.document(path), data)
+        else:
+            writer.update(client.document(path), data)
+    writer.close()
+    if failures:
+        raise RuntimeError(f"{len(failures)} of {len(operations)} writes failed, e.g. {failures[0].message}")
+    return len(operations)
+
+
+async def bulk_apply(operations: list):
+    started = time.perf_counter()
+    await run_blocking(bulk_write, operations)
+    record_firestore(time.perf_counter() - started, writes=len(operations))
+
+
+async def purge_where(run: JobRun, collection: str, field: str, value: str, fields: list, prepare=None, done=None):
+    """
+    Deletes every `collection` document whose `field` equals `value`, JOB_PAGE_SIZE at a time,
+    reading only `fields`. `prepare(docs)` may return more operations for the same BulkWriter
+    pass; `done(docs)` runs once a page is written. Progress is reported per page.
+    """
+    query = db.collection(collection).where(filter=FieldFilter(field, '==', value)).select(fields).limit(JOB_PAGE_SIZE)
+    while True:
+        docs = [doc async for doc in query.stream()]
+        if not docs:
+            return
+        operations = list(await prepare(docs)) if prepare is not None else []
+        operations.extend(("delete", f"{collection}/{doc.id}", None) for doc in docs)
+        await bulk_apply(operations)
+        if done is not None:
+            await done(docs)
+        await run.report(**{collection: len(docs)})
+
+
+async def purge_user_documents(run: JobRun, user_id: str):
+    """
+    Deletes a user's listings (with their view shards), orders as buyer or seller, reviews
+    written or received, and finally their profile. Listings reserved by their open orders
+    go back on sale, and sellers they reviewed get their rating recomputed without them.
+    """
+    async def drop_view_shards(docs):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        return [("delete", f"products/{doc.id}/view_shards/{shard}", None) for doc in docs for shard in range(VIEW_SHARDS)] + \
+            [("set", f"productDeletions/{doc.id}", product_tombstone(now)) for doc in docs]
+
+    async def unlist(docs):
+        for doc in docs:
+            invalidate_product(doc.id)
+            view_counter.discard(doc.id)
+            if product_catalog is not None:
+                product_catalog.remove_local(doc.id)
+            else:
+                unindex_product(doc.id)
+
+    released = {}
+
+    async def release_listings(docs):
+        # Orders still in progress hold their listing reserved; deleting them puts it back on sale
+        product_ids = {doc.to_dict().get('productId') for doc in docs
+                       if doc.to_dict().get('orderStatus') not in LISTING_STATUS_AFTER_ORDER}
+        product_ids.discard(None)
+        released.clear()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        products_ref = db.collection('products')
+        async for snapshot in db.get_all([products_ref.document(product_id) for product_id in product_ids]):
+            if snapshot.exists and snapshot.to_dict().get('status') == LISTING_RESERVED:
+                released[snapshot.id] = {**snapshot.to_dict(), 'status': LISTING_AVAILABLE, 'updatedAt': now}
+        return [("update", f"products/{product_id}", {'status': LISTING_AVAILABLE, 'updatedAt': data['updatedAt']})
+                for product_id, data in released.items()]
+
+    async def relist(docs):
+        for product_id, product_data in released.items():
+            apply_listing_change(product_id, product_data)
+
+    async def forget_reviews(docs):
+        for doc in docs:
+            invalidate_review(doc.id)
+
+    async def rerate_sellers(docs):
+        await forget_reviews(docs)
+        for seller_id in {doc.to_dict().get('sellerId') for doc in docs} - {user_id, None}:
+            await recompute_seller_rating(seller_id)
+
+    await purge_where(run, 'products', 'sellerId', user_id, [], prepare=drop_view_shards, done=unlist)
+    await purge_where(run, 'orders', 'buyerId', user_id, ['productId', 'orderStatus'], prepare=release_listings, done=relist)
+    await purge_where(run, 'orders', 'sellerId', user_id, [])
+    await purge_where(run, 'reviews', 'reviewerId', user_id, ['sellerId'], done=rerate_sellers)
+    await purge_where(run, 'reviews', 'sellerId', user_id, [], done=forget_reviews)
+    user_ref = db.collection('users').document(user_id)
+    if (await user_ref.get()).exists:
+        await user_ref.delete()
+        await run.report(users=1)
+
+
+async def recompute_seller_rating(seller_id: str):
+    """
+    Sets a seller's rating aggregates from their remaining reviews, like reconcile_seller_ratings()
+    does for everyone. Used after bulk deletes, which bypass the per-review transactional updates.
+    """
+    rating_sum, total = 0, 0
+    async for doc in db.collection('reviews').where(filter=FieldFilter('sellerId', '==', seller_id)).select(['rating']).stream():
+        rating_sum += doc.to_dict().get('rating', 0)
+        total += 1
+    seller_ref = db.collection('users').document(seller_id)
+    if (await seller_ref.get()).exists:
+        await seller_ref.update(seller_rating_fields(rating_sum, total))
+
+
+@job_runner.handler("deleteUser")
+async def delete_user_job(run: JobRun):
+    """
+    Deletes everything stored under the user's ID. With `deleteAccount` (an explicit opt-in)
+    the Firebase account goes first, so no new sign-in can write as this user.
+    """
+    user_id = run.params['userId']
+    if run.params.get('deleteAccount'):
+        try:
+            await run_blocking(delete_auth_user, user_id)
+        except auth.UserNotFoundError:
+            pass
+    await purge_user_documents(run, user_id)
+
+
+@job_runner.handler("cleanupOrphans")
+async def cleanup_orphans_job(run: JobRun):
+    """
+    Repeats the deleteUser cascade for accounts deleted within the last two cleanup periods.
+    ID tokens issued before an account was deleted stay valid for up to an hour, so a client
+    can still write as that user while (or just after) their deletion job runs. Users who kept
+    their account may sign in and start over, so their new data is left alone.
+    """
+    since = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=2 * ORPHAN_CLEANUP_HOURS)
+    deleted = (db.collection('jobs').where(filter=FieldFilter('type', '==', 'deleteUser'))
+               .where(filter=FieldFilter('status', '==', JOB_SUCCEEDED))
+               .where(filter=FieldFilter('finishedAt', '>=', since)).select(['params']))
+    user_ids = {doc.to_dict()['params']['userId'] async for doc in deleted.stream()
+                if doc.to_dict()['params'].get('deleteAccount')}
+    for user_id in sorted(user_ids):
+        await purge_user_documents(run, user_id)
+    await run.report(usersChecked=len(user_ids))
+
+
+async def run_orphan_cleanup_schedule():
+    """
+    Queues one cleanupOrphans job per ORPHAN_CLEANUP_HOURS period. The job ID is derived from
+    the period, so every API process can run this loop and the cleanup still happens once.
+    """
+    period = ORPHAN_CLEANUP_HOURS * 3600
+    while True:
+        try:
+            await job_runner.enqueue("cleanupOrphans", {}, job_id=f"cleanupOrphans-{int(time.time() // period)}", rerun_finished=False)
+        except Exception as e:
+            print(f"Error scheduling orphan cleanup: {e}")
+        await asyncio.sleep(period - time.time() % period)
+
+
+# --- Denormalized name propagation ---
+
+# Names are copied into the documents that display them: a seller's displayName into their
+# products and reviews, a reviewer's into their reviews, and a product's name into its
+# orders and reviews. A rename queues a propagation job that becomes due after
+# NAME_PROPAGATION_DELAY_SECONDS and rewrites the copies in WriteBatches of up to 500. The job ID
+# is per user or product, so renames within the delay share one run, and the run always
+# writes the name current when it starts. A rename during a run queues one more run.
+NAME_PROPAGATION_DELAY_SECONDS = float(os.getenv("NAME_PROPAGATION_DELAY_SECONDS", "30"))
+
+# source -> (collection holding the name, its name field, [(copy collection, key field, copy field), ...])
+NAME_COPIES = {
+    "user": ('users', 'displayName', [
+        ('products', 'sellerId', 'sellerName'),
+        ('reviews', 'sellerId', 'sellerName'),
+        ('reviews', 'reviewerId', 'reviewerName'),
+    ]),
+    "product": ('products', 'name', [
+        ('orders', 'productId', 'productName'),
+        ('reviews', 'productId', 'productName'),
+    ]),
+}
+
+
+async def schedule_name_propagation(source: str, source_id: str, created_by: str):
+    """
+    Queues (or joins) the propagation job for a renamed user or product. The rename is
+    already committed, so a failure here is only logged.
+    """
+    try:
+        await job_runner.enqueue("propagateName", {'source': source, 'id': source_id}, created_by=created_by,
+                                 job_id=f"propagateName-{source}-{source_id}",
+                                 delay=NAME_PROPAGATION_DELAY_SECONDS, rerun_running=True)
+    except Exception as e:
+        print(f"Error scheduling name propagation for {source} {source_id}: {e}")
+
+
+@job_runner.handler("propagateName")
+async def propagate_name_job(run: JobRun):
+    """
+    Finds the copies with one equality query per copy field, paged by document ID, and
+    rewrites only those that differ. Products and reviews also get a new updatedAt, which
+    their ETags are built from.
+    """
+    source, source_id = run.params['source'], run.params['id']
+    collection, name_field, copies = NAME_COPIES[source]
+    snapshot = await db.collection(collection).document(source_id).get()
+    if not snapshot.exists or not snapshot.to_dict().get(name_field):
+        return
+    name = snapshot.to_dict()[name_field]
+
+    for copy_collection, key_field, copy_field in copies:
+        query = (db.collection(copy_collection).where(filter=FieldFilter(key_field, '==', source_id))
+                 .order_by('__name__').limit(JOB_PAGE_SIZE))
+        if copy_collection != 'products':
+            # Products are re-indexed after the write, so they are read in full
+            query = query.select([copy_field])
+        last_id = None
+        while True:
+            page = query if last_id is None else query.start_after({'__name__': last_id})
+            docs = [doc async for doc in page.stream()]
+            if not docs:
+                break
+            last_id = docs[-1].id
+            stale = [doc for doc in docs if doc.to_dict().get(copy_field) != name]
+            now = datetime.datetime.now(datetime.timezone.utc)
+            update = {copy_field: name} if copy_collection == 'orders' else {copy_field: name, 'updatedAt': now}
+            for start in range(0, len(stale), BULK_WRITE_CHUNK_SIZE):
+                batch = db.batch()
+                for doc in stale[start:start + BULK_WRITE_CHUNK_SIZE]:
+                    batch.update(db.collection(copy_collection).document(doc.id), update)
+                await batch.commit()
+            for doc in stale:
+                if copy_collection == 'products':
+                    apply_listing_change(doc.id, {**doc.to_dict(), **update})
+                elif copy_collection == 'reviews':
+                    invalidate_review(doc.id)
+            # Reported every page, even with nothing rewritten, to keep the lease
+            await run.report(**{copy_collection: len(stale)})
+
+
+""" Job Endpoints """
+
+@app.get("/jobs/{job_id}", response_model=Job, summary="Get the status and progress of a background job")
+async def get_job(job_id: str, current_user: dict = Depends(get_current_user)):
+    """
+    Returns a job started by the authenticated user, e.g. the one behind DELETE /users/{id}.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    try:
+        doc = await db.collection('jobs').document(job_id).get()
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching job: {e}")
+    if not doc.exists or doc.to_dict().get('createdBy') != current_user['uid']:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job_codec.decode(doc)
+
+
+""" Product Enpoints """
+    
+# Sort options for product listings: name -> (field, direction).
+# Every listing query also orders by document ID so cursors are stable when values tie.
+PRODUCT_SORTS = {
+    "newest": ("postedAt", firestore.Query.DESCENDING),
+    "oldest": ("postedAt", firestore.Query.ASCENDING),
+    "price-low": ("price", firestore.Query.ASCENDING),
+    "price-high": ("price", firestore.Query.DESCENDING),
+}
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(sort: str, field: str, value, doc_id: str) -> str:
+    """
+    Builds an opaque pagination cursor from the sort value and ID of the last document of a page.
+    """
+    payload = {"s": sort, "f": field, "v": value, "id": doc_id}
+    if hasattr(value, 'isoformat'):
+        payload["v"] = value.isoformat()
+        payload["d"] = 1
+    return base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: str, sorts: dict = PRODUCT_SORTS) -> dict:
+    """
+    Turns a cursor produced by encode_cursor back into start_after() field values.
+    Raises a 400 if the cursor is malformed or was issued for a different sort order.
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        field = sorts[sort][0]
+        if payload["s"] != sort or payload["f"] != field:
+            raise ValueError("cursor sort mismatch")
+        value = payload["v"]
+        if payload.get("d"):
+            value = datetime.datetime.fromisoformat(value)
+        return {field: value, "__name__": payload["id"]}
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid pagination cursor.")
+
+
+def product_cursor(sort: str, product: "Product") -> str:
+    field = PRODUCT_SORTS[sort][0]
+    return encode_cursor(sort, field, getattr(product, field), product.productId)
+
+
+@app.get("/products", response_model=List[Product], summary="List products")
+async def get_all_products(
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    subcategory: Optional[str] = None,
+    condition: Optional[str] = None,
+    product_status: Optional[str] = Query(None, alias="status"),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    sort: str = "newest",
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = None,
+    stream: bool = False,
+    fields: Optional[str] = None,
+):
+    """
+    Retrieves one page of products from the Firestore 'products' collection.
+    Filters and sorting are pushed down into a single bounded Firestore query.
+    When more results may exist, the cursor for the next page is returned in the
+    X-Next-Cursor response header; pass it back as `start_after`.
+    `fields=productId,name,price,images[0]` returns only those fields of each product.
+
+    With `?stream=1` or `Accept: application/x-ndjson` the matching products are
+    streamed as NDJSON while Firestore yields them, and `limit` defaults to no limit.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    if sort not in PRODUCT_SORTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid sort. Use one of: {', '.join(PRODUCT_SORTS)}")
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="min_price cannot be greater than max_price.")
+    streaming = wants_ndjson(request, stream)
+    if limit is None and not streaming:
+        limit = DEFAULT_PAGE_SIZE
+    spec = parse_fields(fields, Product)
+
+    def respond(products):
+        etag = collection_etag(products, product_version, fields, response.headers.get("X-Next-Cursor"))
+        return not_modified(request, response, etag) or sparse_response(products, spec, response)
+
+    if catalog_ready():
+        filters = {'category': category, 'subcategory': subcategory, 'condition': condition, 'status': product_status}
+        cursor = decode_cursor(start_after, sort) if start_after else None
+        products = product_catalog.query(filters, min_price, max_price, sort, limit or sys.maxsize, cursor)
+        if streaming:
+            return StreamingResponse(ndjson_lines(products), media_type=NDJSON_MEDIA_TYPE)
+        if len(products) == limit:
+            response.headers["X-Next-Cursor"] = product_cursor(sort, products[-1])
+        return respond(products)
+
+    if not streaming:
+        cache_key = (category, subcategory, condition, product_status, min_price, max_price, sort, limit, start_after)
+        cached = product_list_cache.get(cache_key)
+        if cached is not None:
+            products, next_cursor = cached
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return respond(products)
+        generation = product_list_cache.generation
+
+    query = db.collection('products')
+    for field, value in (('category', category), ('subcategory', subcategory), ('condition', condition), ('status', product_status)):
+        if value is not None:
+            query = query.where(filter=FieldFilter(field, '==', value))
+    if min_price is not None:
+        query = query.where(filter=FieldFilter('price', '>=', min_price))
+    if max_price is not None:
+        query = query.where(filter=FieldFilter('price', '<=', max_price))
+
+    sort_field, direction = PRODUCT_SORTS[sort]
+    query = query.order_by(sort_field, direction=direction).order_by('__name__', direction=direction)
+    if start_after:
+        query = query.start_after(decode_cursor(start_after, sort))
+    if limit is not None:
+        query = query.limit(limit)
+    if streaming:
+        return StreamingResponse(ndjson_stream(query.stream(), product_codec.decode), media_type=NDJSON_MEDIA_TYPE)
+
     try:
-        
-        docs = products_ref.stream()
-        products = []
-        for doc in docs:
-            product_data = doc.to_dict()
-            # Convert Firestore Timestamps to datetime objects for Pydantic
-            if 'postedAt' in product_data and hasattr(product_data['postedAt'], 'isoformat'):
-                product_data['postedAt'] = product_data['postedAt'].isoformat()
-            if 'updatedAt' in product_data and hasattr(product_data['updatedAt'], 'isoformat'):
-                product_data['updatedAt'] = product_data['updatedAt'].isoformat()
-            
-            # Ensure productId is included from the document ID
-            product_data['productId'] = doc.id
-            products.append(Product(**product_data))
-        return products
+        products = product_codec.decode_many([doc async for doc in query.stream()])
+
+        # A full page means there may be more; hand the client a cursor for the next one
+        next_cursor = None
+        if products and len(products) == limit:
+            next_cursor = product_cursor(sort, products[-1])
+            response.headers["X-Next-Cursor"] = next_cursor
+        product_list_cache.set(cache_key, (products, next_cursor), generation)
+        return respond(products)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching products: {e}")
 
 
+@app.get("/products/search", response_model=List[Product], summary="Search products")
+async def search_products(
+    request: Request,
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=100),
+    category: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE),
+    fields: Optional[str] = None,
+):
+    """
+    Full-text search over product name, description, specifications, category and subcategory.
+    Served from the in-process search index; the last word may be partial.
+    Accepts the same `fields=` sparse fieldset as GET /products.
+    """
+    spec = parse_fields(fields, Product)
+    if not (search_index.ready or catalog_ready()):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Search index is still being built. Try again shortly.",
+            headers={"Retry-After": "5"},
+        )
+    products = search_index.search(q, limit, category)
+    etag = collection_etag(products, product_version, fields)
+    return not_modified(request, response, etag) or sparse_response(products, spec, response)
+
+
+class PriceBucket(BaseModel):
+    min: float
+    max: Optional[float]  # exclusive; None for the open-ended top bucket
+    count: int
+
+
+class ProductFacets(BaseModel):
+    total: int
+    category: dict[str, int]
+    subcategory: dict[str, int]
+    condition: dict[str, int]
+    status: dict[str, int]
+    price: List[PriceBucket]
+
+
+@app.get("/products/facets", response_model=ProductFacets, summary="Count products per category, subcategory, condition, status and price range")
+async def get_product_facets(
+    request: Request,
+    response: Response,
+    category: Optional[str] = None,
+    subcategory: Optional[str] = None,
+    condition: Optional[str] = None,
+    product_status: Optional[str] = Query(None, alias="status"),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+):
+    """
+    Counts products per category, subcategory, condition, status and price bucket,
+    optionally scoped by the same filters as GET /products. Each facet ignores its
+    own filter so it lists the alternatives; `total` matches all filters.
+    Served from the in-process facet index, so it costs no Firestore reads.
+    """
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="min_price cannot be greater than max_price.")
+    if not (facet_index.ready or catalog_ready()):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Facet index is still being built. Try again shortly.",
+            headers={"Retry-After": "5"},
+        )
+    filters = {'category': category, 'subcategory': subcategory, 'condition': condition, 'status': product_status}
+    facets = ProductFacets(**facet_index.facets(filters, min_price, max_price))
+    return not_modified(request, response, entity_etag(facets)) or facets
+
+
 @app.get("/products/{product_id}", response_model=Product, summary="Get a product by ID")
-async def get_product_by_id(product_id: str):
+async def get_product_by_id(product_id: str, request: Request, response: Response):
     """
     Retrieves a single product by its unique ID from the Firestore 'products' collection.
+    Answers 304 when If-None-Match / If-Modified-Since show the client's copy is current.
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+
+    async def respond(product):
+        product = await with_views(product)
+        return not_modified(request, response, entity_etag(product), product.updatedAt) or product
+
+    if catalog_ready():
+        product = product_catalog.get(product_id)
+        if product is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+        return await respond(product)
+
+    cached = product_cache.get(product_id)
+    if cached is not None:
+        return await respond(cached)
+    generation = product_cache.generation
+
     product_ref = db.collection('products').document(product_id)
     try:
-        doc = product_ref.get()
+        doc = await product_ref.get()
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
         
-        product_data = doc.to_dict()
-        # Convert Firestore Timestamps to datetime objects for Pydantic
-        if 'postedAt' in product_data and hasattr(product_data['postedAt'], 'isoformat'):
-                product_data['postedAt'] = product_data['postedAt'].isoformat()
-        if 'updatedAt' in product_data and hasattr(product_data['updatedAt'], 'isoformat'):
-                product_data['updatedAt'] = product_data['updatedAt'].isoformat()
-
-        # Ensure productId is included from the document ID
-        product_data['productId'] = doc.id
-        return Product(**product_data)
+        product = product_codec.decode(doc)
+        product_cache.set(product_id, product, generation)
+        return await respond(product)
     except HTTPException as e:
         raise e # Re-raise 404
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching product: {e}")
 
+@app.post("/products:batchGet", response_model=ProductBatch, summary="Get several products by ID")
+async def batch_get_products(request: BatchGetRequest):
+    """
+    Retrieves up to BATCH_GET_MAX_IDS products in one Firestore round trip.
+    Products served from the catalog or read cache are not fetched again.
+    IDs with no product are listed under `missing`.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    if catalog_ready():
+        # The catalog holds every product, so anything it lacks does not exist
+        products = {product_id: product_catalog.get(product_id) for product_id in request.ids}
+        return ProductBatch(
+            items=[product for product in products.values() if product is not None],
+            missing=[product_id for product_id, product in products.items() if product is None],
+        )
+
+    known = {}
+    for product_id in request.ids:
+        cached = product_cache.get(product_id)
+        if cached is not None:
+            known[product_id] = cached
+    generation = product_cache.generation
+    try:
+        products, missing = await batch_get('products', request.ids, product_codec, known)
+        for product_id, product in products.items():
+            if product_id not in known:
+                product_cache.set(product_id, product, generation)
+        return ProductBatch(items=list(products.values()), missing=missing)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching products: {e}")
+
+@app.post("/products:batchWrite", response_model=List[ProductWriteResult], summary="Create, update and delete products in bulk")
+async def bulk_write_products(request: ProductBulkWrite, current_user: dict = Depends(get_current_user)):
+    """
+    Applies a list of create/update/delete operations for the authenticated seller.
+    Update and delete targets are read with one get_all() call and checked for ownership
+    like PUT/DELETE /products/{id}; the accepted writes are then committed in WriteBatches
+    of up to 500, each guarded by the update time that was checked, so a listing edited
+    in between is reported as 409 instead of being overwritten.
+    Each operation gets its own result; a failed check only rejects that operation.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    products_ref = db.collection('products')
+    operations = request.operations
+    results = [ProductWriteResult(index=i, op=operation.op, productId=getattr(operation, 'productId', None), status=0)
+               for i, operation in enumerate(operations)]
+
+    def reject(i, code, error):
+        results[i].status = code
+        results[i].error = error
+
+    try:
+        targets = [operation.productId for operation in operations if operation.op != "create"]
+        snapshots = {}
+        if targets:
+            async for doc in db.get_all([products_ref.document(product_id) for product_id in dict.fromkeys(targets)]):
+                snapshots[doc.id] = doc
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error reading products: {e}")
+
+    # (result index, document reference, write data, precondition, product after the write or None for a delete)
+    writes = []
+    seen = set()
+    renamed = set()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for i, operation in enumerate(operations):
+        if operation.op == "create":
+            if operation.product.sellerId != current_user['uid']:
+                reject(i, status.HTTP_403_FORBIDDEN, "Seller ID must match authenticated user.")
+                continue
+            product_data = operation.product.model_dump()
+            product_data['postedAt'] = now
+            product_data['updatedAt'] = now
+            product_data['views'] = 0
+            doc_ref = products_ref.document()
+            results[i].productId = doc_ref.id
+            writes.append((i, doc_ref, product_data, None, product_codec.decode_data(doc_ref.id, dict(product_data))))
+            continue
+
+        product_id = operation.productId
+        if product_id in seen:
+            reject(i, status.HTTP_400_BAD_REQUEST, "Product appears in more than one operation.")
+            continue
+        seen.add(product_id)
+        doc = snapshots.get(product_id)
+        if doc is None or not doc.exists:
+            reject(i, status.HTTP_404_NOT_FOUND, "Product not found")
+            continue
+        product_data = doc.to_dict()
+        if product_data.get('sellerId') != current_user['uid']:
+            reject(i, status.HTTP_403_FORBIDDEN, f"You do not have permission to {operation.op} this product.")
+            continue
+        option = db.write_option(last_update_time=doc.update_time)
+
+        if operation.op == "update":
+            update_data = operation.product.model_dump(exclude_unset=True)
+            if not update_data:
+                reject(i, status.HTTP_400_BAD_REQUEST, "No fields provided for update")
+                continue
+            update_data['updatedAt'] = now
+            if 'images' in update_data:
+                update_data['thumbnails'] = []
+            product_data.update(update_data)
+            try:
+                # Fully validated, not decoded on the trusted path: e.g. an explicit null must not reach the write
+                product = product_codec.adapter.validate_python({**product_data, 'productId': product_id})
+            except ValidationError as e:
+                reject(i, status.HTTP_422_UNPROCESSABLE_CONTENT, "Invalid product after update: " + "; ".join(
+                    f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+                continue
+            if 'name' in update_data and update_data['name'] != doc.to_dict().get('name'):
+                renamed.add(product_id)
+            writes.append((i, doc.reference, update_data, option, product))
+        else:
+            writes.append((i, doc.reference, None, option, None))
+
+    async def commit(chunk):
+        batch = db.batch()
+        for i, doc_ref, data, option, _ in chunk:
+            if operations[i].op == "create":
+                batch.create(doc_ref, data)
+            elif operations[i].op == "update":
+                batch.update(doc_ref, data, option=option)
+            else:
+                batch.delete(doc_ref, option=option)
+                batch.set(db.collection('productDeletions').document(doc_ref.id), product_tombstone(now))
+        await batch.commit()
+
+    # Deletes also write a tombstone, so they count twice towards a batch's writes
+    chunks, chunk, chunk_writes = [], [], 0
+    for write in writes:
+        weight = 2 if operations[write[0]].op == "delete" else 1
+        if chunk and chunk_writes + weight > BULK_WRITE_CHUNK_SIZE:
+            chunks.append(chunk)
+            chunk, chunk_writes = [], 0
+        chunk.append(write)
+        chunk_writes += weight
+    if chunk:
+        chunks.append(chunk)
+    outcomes = await asyncio.gather(*(commit(chunk) for chunk in chunks), return_exceptions=True)
+    if writes:
+        invalidate_product()
+
+    success = {"create": status.HTTP_201_CREATED, "update": status.HTTP_200_OK, "delete": status.HTTP_204_NO_CONTENT}
+    for chunk, outcome in zip(chunks, outcomes):
+        for i, _, _, _, product in chunk:
+            if isinstance(outcome, Exception):
+                # Only committed renames are propagated
+                renamed.discard(results[i].productId)
+            if isinstance(outcome, FailedPrecondition):
+                # A whole batch is atomic, so one listing changed since it was checked rejects its chunk
+                reject(i, status.HTTP_409_CONFLICT, f"A product in this batch changed during the write: {outcome}")
+            elif isinstance(outcome, Exception):
+                reject(i, status.HTTP_500_INTERNAL_SERVER_ERROR, f"Error writing product: {outcome}")
+            else:
+                results[i].status = success[operations[i].op]
+                results[i].product = product
+                product_cache.invalidate(results[i].productId)
+                if product is None:
+                    view_counter.discard(results[i].productId)
+                if product is None and product_catalog is not None:
+                    product_catalog.remove_local(results[i].productId)
+                elif product is None:
+                    unindex_product(results[i].productId)
+                elif product_catalog is not None:
+                    product_catalog.apply_local(product)
+                else:
+                    index_product(product)
+                if product is not None:
+                    schedule_thumbnails(product)
+    await asyncio.gather(*(schedule_name_propagation("product", product_id, current_user['uid']) for product_id in renamed))
+    return results
+
+
 @app.post("/products", response_model=Product, status_code=status.HTTP_201_CREATED, summary="Create a new product")
 async def create_product(product: ProductCreate, current_user: dict = Depends(get_current_user)):
     """
@@ -342,20 +3768,17 @@ async def create_product(product: ProductCreate, current_user: dict = Depends(ge
         product_data['views'] = 0 # Initialize views to 0
 
         
-        update_time, doc_ref = products_ref.add(product_data) 
+        update_time, doc_ref = await products_ref.add(product_data) 
+        invalidate_product()
 
-      
-        new_product_doc = doc_ref.get()
-        new_product_data = new_product_doc.to_dict()
-        new_product_data['productId'] = new_product_doc.id
-        
-        
-        if 'postedAt' in new_product_data and hasattr(new_product_data['postedAt'], 'isoformat'):
-            new_product_data['postedAt'] = new_product_data['postedAt'].isoformat()
-        if 'updatedAt' in new_product_data and hasattr(new_product_data['updatedAt'], 'isoformat'):
-            new_product_data['updatedAt'] = new_product_data['updatedAt'].isoformat()
-
-        return Product(**new_product_data)
+        # Everything stored is already in hand, so the response is built without reading the document back
+        new_product = product_codec.decode_data(doc_ref.id, product_data)
+        if product_catalog is not None:
+            product_catalog.apply_local(new_product)
+        else:
+            index_product(new_product)
+        schedule_thumbnails(new_product)
+        return new_product
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error creating product: {e}")
 
@@ -367,39 +3790,44 @@ async def update_product(product_id: str, product_update: ProductUpdate, current
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
-    product_ref = db.collection('products').document(product_id)
-    try:
-        doc = product_ref.get()
-        if not doc.exists:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-        
-        product_data = doc.to_dict()
+    # Get only the fields that were provided in the request body
+    update_data = product_update.model_dump(exclude_unset=True) # Exclude fields not set in the request
+    if not update_data:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
+
+    previous = {}
+
+    def authorize(product_data):
         if product_data.get('sellerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to update this product.")
+        previous['name'] = product_data.get('name')
+        try:
+            # Validated against the stored document before anything is written, as batchWrite does
+            product_codec.adapter.validate_python({**product_data, **update_data, 'productId': product_id})
+        except ValidationError as e:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_CONTENT, detail="Invalid product after update: " + "; ".join(
+                f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
 
-        # Get only the fields that were provided in the request body
-        update_data = product_update.model_dump(exclude_unset=True) # Exclude fields not set in the request
-        
-        if not update_data:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
-
+    product_ref = db.collection('products').document(product_id)
+    try:
         now = datetime.datetime.now(datetime.timezone.utc)
         update_data['updatedAt'] = now # Update the timestamp on modification
+        if 'images' in update_data:
+            # Thumbnails of the old images are dropped; the worker renders the new ones
+            update_data['thumbnails'] = []
 
-        product_ref.update(update_data) # Synchronous update
-
-        # Fetch the updated document to return the full Product model
-        updated_product_doc = product_ref.get()
-        updated_product_data = updated_product_doc.to_dict()
-        updated_product_data['productId'] = updated_product_doc.id
+        product_data = await update_in_transaction(product_ref, update_data, "Product not found", authorize)
+        invalidate_product(product_id)
 
-        # Convert Firestore Timestamps for the response model
-        if 'postedAt' in updated_product_data and hasattr(updated_product_data['postedAt'], 'isoformat'):
-            updated_product_data['postedAt'] = updated_product_data['postedAt'].isoformat()
-        if 'updatedAt' in updated_product_data and hasattr(updated_product_data['updatedAt'], 'isoformat'):
-            updated_product_data['updatedAt'] = updated_product_data['updatedAt'].isoformat()
-            
-        return Product(**updated_product_data)
+        updated_product = product_codec.decode_data(product_id, product_data)
+        if product_catalog is not None:
+            product_catalog.apply_local(updated_product)
+        else:
+            index_product(updated_product)
+        schedule_thumbnails(updated_product)
+        if 'name' in update_data and update_data['name'] != previous['name']:
+            await schedule_name_propagation("product", product_id, current_user['uid'])
+        return updated_product
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -414,7 +3842,7 @@ async def delete_product(product_id: str, current_user: dict = Depends(get_curre
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
     product_ref = db.collection('products').document(product_id)
     try:
-        doc = product_ref.get()
+        doc = await product_ref.get()
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
         
@@ -422,7 +3850,16 @@ async def delete_product(product_id: str, current_user: dict = Depends(get_curre
         if product_data.get('sellerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this product.")
 
-        product_ref.delete() # Synchronous delete
+        batch = db.batch()
+        batch.delete(product_ref)
+        batch.set(db.collection('productDeletions').document(product_id), product_tombstone(datetime.datetime.now(datetime.timezone.utc)))
+        await batch.commit()
+        invalidate_product(product_id)
+        view_counter.discard(product_id)
+        if product_catalog is not None:
+            product_catalog.remove_local(product_id)
+        else:
+            unindex_product(product_id)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except HTTPException as e:
         raise e
@@ -431,29 +3868,20 @@ async def delete_product(product_id: str, current_user: dict = Depends(get_curre
     
     
 @app.get("/users", response_model=List[User], summary="Get all users")
-async def get_all_users(current_user: dict = Depends(get_current_user)):
+async def get_all_users(request: Request, stream: bool = False, current_user: dict = Depends(get_current_user)):
     """
     Retrieves a list of all user profiles from the Firestore 'users' collection.
+    Streams NDJSON with `?stream=1` or `Accept: application/x-ndjson`.
     NOTE: This endpoint is protected and requires authentication. 
     In a real-world application, this should be restricted to admin users.
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
     users_ref = db.collection('users')
+    if wants_ndjson(request, stream):
+        return StreamingResponse(ndjson_stream(users_ref.stream(), user_codec.decode), media_type=NDJSON_MEDIA_TYPE)
     try:
-        docs = users_ref.stream()
-        users = []
-        for doc in docs:
-            user_data = doc.to_dict()
-            # Convert Firestore Timestamps to datetime objects for Pydantic
-            if 'createdAt' in user_data and hasattr(user_data['createdAt'], 'isoformat'):
-                user_data['createdAt'] = user_data['createdAt'].isoformat()
-            if 'lastLoginAt' in user_data and hasattr(user_data['lastLoginAt'], 'isoformat'):
-                user_data['lastLoginAt'] = user_data['lastLoginAt'].isoformat()
-            
-            user_data['userId'] = doc.id # Ensure userId is included from the document ID
-            users.append(User(**user_data))
-        return users
+        return user_codec.decode_many([doc async for doc in users_ref.stream()])
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching users: {e}")
 
@@ -471,18 +3899,11 @@ async def get_user_by_id(user_id: str, current_user: dict = Depends(get_current_
 
     user_ref = db.collection('users').document(user_id)
     try:
-        doc = user_ref.get()
+        doc = await user_ref.get()
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
         
-        user_data = doc.to_dict()
-        if 'createdAt' in user_data and hasattr(user_data['createdAt'], 'isoformat'):
-            user_data['createdAt'] = user_data['createdAt'].isoformat()
-        if 'lastLoginAt' in user_data and hasattr(user_data['lastLoginAt'], 'isoformat'):
-            user_data['lastLoginAt'] = user_data['lastLoginAt'].isoformat()
-
-        user_data['userId'] = doc.id
-        return User(**user_data)
+        return user_codec.decode(doc)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -502,27 +3923,19 @@ async def create_user(user: UserCreate, current_user: dict = Depends(get_current
     user_ref = db.collection('users').document(user_id)
 
     try:
-        if user_ref.get().exists:
-            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"User profile for UID {user_id} already exists.")
-
         user_data = user.model_dump()
         now = datetime.datetime.now(datetime.timezone.utc)
 
         user_data['createdAt'] = now
         user_data['lastLoginAt'] = now
+        # Rating aggregates are maintained by review writes, never by the client
+        user_data.update(seller_rating_fields(0, 0))
 
-        user_ref.set(user_data)
-
-        new_user_doc = user_ref.get()
-        new_user_data = new_user_doc.to_dict()
-        new_user_data['userId'] = new_user_doc.id
-        
-        if 'createdAt' in new_user_data and hasattr(new_user_data['createdAt'], 'isoformat'):
-            new_user_data['createdAt'] = new_user_data['createdAt'].isoformat()
-        if 'lastLoginAt' in new_user_data and hasattr(new_user_data['lastLoginAt'], 'isoformat'):
-            new_user_data['lastLoginAt'] = new_user_data['lastLoginAt'].isoformat()
-
-        return User(**new_user_data)
+        # create() fails if the document exists, so the existence check costs no extra read and cannot race
+        await user_ref.create(user_data)
+        return user_codec.decode_data(user_id, user_data)
+    except AlreadyExists:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f"User profile for UID {user_id} already exists.")
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -540,44 +3953,45 @@ async def update_user(user_id: str, user_update: UserUpdate, current_user: dict
     if user_id != current_user['uid']:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You can only update your own profile.")
 
+    update_data = user_update.model_dump(exclude_unset=True)
+    if 'createdAt' in update_data:
+        del update_data['createdAt']
+    if 'userId' in update_data:
+        del update_data['userId']
+    for field in ('rating', 'totalReviews'):
+        update_data.pop(field, None)
+    if not update_data:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
+
+    previous = {}
+
+    def remember_name(user_data):
+        previous['displayName'] = user_data.get('displayName')
+
     user_ref = db.collection('users').document(user_id)
     try:
-        doc = user_ref.get()
-        if not doc.exists:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-        
-        update_data = user_update.model_dump(exclude_unset=True)
-        
-        if not update_data:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
-
-        if 'createdAt' in update_data:
-            del update_data['createdAt']
-        if 'userId' in update_data:
-            del update_data['userId']
-
-        user_ref.update(update_data)
-
-        updated_user_doc = user_ref.get()
-        updated_user_data = updated_user_doc.to_dict()
-        updated_user_data['userId'] = updated_user_doc.id
-
-        if 'createdAt' in updated_user_data and hasattr(updated_user_data['createdAt'], 'isoformat'):
-            updated_user_data['createdAt'] = updated_user_data['createdAt'].isoformat()
-        if 'lastLoginAt' in updated_user_data and hasattr(updated_user_data['lastLoginAt'], 'isoformat'):
-            updated_user_data['lastLoginAt'] = updated_user_data['lastLoginAt'].isoformat()
-            
-        return User(**updated_user_data)
+        user_data = await update_in_transaction(user_ref, update_data, "User not found", remember_name)
+        if 'displayName' in update_data and update_data['displayName'] != previous['displayName']:
+            await schedule_name_propagation("user", user_id, current_user['uid'])
+        return user_codec.decode_data(user_id, user_data)
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error updating user: {e}")
 
-@app.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT, summary="Delete a user")
-async def delete_user(user_id: str, current_user: dict = Depends(get_current_user)):
+@app.delete("/users/{user_id}", response_model=Job, status_code=status.HTTP_202_ACCEPTED, summary="Delete a user and everything they own")
+async def delete_user(
+    user_id: str,
+    response: Response,
+    delete_account: bool = Query(False, alias="deleteAccount"),
+    current_user: dict = Depends(get_current_user),
+):
     """
-    Deletes a user profile from the Firestore 'users' collection.
-    Note: In a real app, you'd also want to delete the user from Firebase Authentication.
+    Starts a deleteUser job that removes the user's listings, orders, reviews and finally
+    their profile, and returns it at once; poll GET /jobs/{jobId} (also given in the
+    Location header) for progress. The Firebase sign-in account is kept unless
+    `deleteAccount=true` asks for it to be deleted too, which cannot be undone.
+    Deleting again while a deletion is queued or running returns that job.
     A user can only delete their own profile.
     """
     if db is None:
@@ -588,58 +4002,71 @@ async def delete_user(user_id: str, current_user: dict = Depends(get_current_use
 
     user_ref = db.collection('users').document(user_id)
     try:
-        doc = user_ref.get()
+        doc = await user_ref.get()
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
-        
-        user_ref.delete()
-        return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+        job = await job_runner.enqueue("deleteUser", {'userId': user_id, 'deleteAccount': delete_account},
+                                       created_by=user_id, job_id=f"deleteUser-{user_id}")
+        response.headers["Location"] = f"/jobs/{job.jobId}"
+        return job
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error deleting user: {e}")
 
-@app.get("/orders", response_model=List[Order], summary="Get all orders for the current user")
-async def get_orders(current_user: dict = Depends(get_current_user)):
+ORDER_SORTS = {
+    "newest": ("orderedAt", firestore.Query.DESCENDING),
+    "oldest": ("orderedAt", firestore.Query.ASCENDING),
+}
+
+
+@app.get("/orders", response_model=List[Order], summary="Get orders for the current user")
+async def get_orders(
+    response: Response,
+    role: Optional[str] = None,
+    order_status: Optional[str] = Query(None, alias="orderStatus"),
+    sort: str = "newest",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = None,
+    current_user: dict = Depends(get_current_user),
+):
     """
-    Retrieves a list of all orders from the Firestore 'orders' collection 
-    where the current user is either the buyer or the seller.
+    Retrieves one page of orders from the Firestore 'orders' collection
+    where the current user is the buyer or the seller (or only one of them with
+    `role=buyer|seller`), ordered by `orderedAt`.
+    Both sides are fetched with a single OR query; the next-page cursor is
+    returned in the X-Next-Cursor response header.
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
-    
+    if role not in (None, "buyer", "seller"):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid role. Use 'buyer' or 'seller'.")
+    if sort not in ORDER_SORTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid sort. Use one of: {', '.join(ORDER_SORTS)}")
+
     user_id = current_user['uid']
-    orders_dict = {}
-
-    try:
-        # Query for orders where the user is the buyer
-        buyer_query = db.collection('orders').where('buyerId', '==', user_id).stream()
-        for doc in buyer_query:
-            order_data = doc.to_dict()
-            if 'orderedAt' in order_data and hasattr(order_data['orderedAt'], 'isoformat'):
-                order_data['orderedAt'] = order_data['orderedAt'].isoformat()
-            if 'shippedAt' in order_data and hasattr(order_data['shippedAt'], 'isoformat'):
-                order_data['shippedAt'] = order_data['shippedAt'].isoformat()
-            if 'deliveredAt' in order_data and hasattr(order_data['deliveredAt'], 'isoformat'):
-                order_data['deliveredAt'] = order_data['deliveredAt'].isoformat()
-            order_data['orderId'] = doc.id
-            orders_dict[doc.id] = Order(**order_data)
-
-        # Query for orders where the user is the seller
-        seller_query = db.collection('orders').where('sellerId', '==', user_id).stream()
-        for doc in seller_query:
-            if doc.id not in orders_dict: # Avoid duplicates
-                order_data = doc.to_dict()
-                if 'orderedAt' in order_data and hasattr(order_data['orderedAt'], 'isoformat'):
-                    order_data['orderedAt'] = order_data['orderedAt'].isoformat()
-                if 'shippedAt' in order_data and hasattr(order_data['shippedAt'], 'isoformat'):
-                    order_data['shippedAt'] = order_data['shippedAt'].isoformat()
-                if 'deliveredAt' in order_data and hasattr(order_data['deliveredAt'], 'isoformat'):
-                    order_data['deliveredAt'] = order_data['deliveredAt'].isoformat()
-                order_data['orderId'] = doc.id
-                orders_dict[doc.id] = Order(**order_data)
-
-        return list(orders_dict.values())
+    query = db.collection('orders')
+    if role == "buyer":
+        query = query.where(filter=FieldFilter('buyerId', '==', user_id))
+    elif role == "seller":
+        query = query.where(filter=FieldFilter('sellerId', '==', user_id))
+    else:
+        query = query.where(filter=Or([FieldFilter('buyerId', '==', user_id), FieldFilter('sellerId', '==', user_id)]))
+    if order_status is not None:
+        query = query.where(filter=FieldFilter('orderStatus', '==', order_status))
+
+    sort_field, direction = ORDER_SORTS[sort]
+    query = query.order_by(sort_field, direction=direction).order_by('__name__', direction=direction)
+    if start_after:
+        query = query.start_after(decode_cursor(start_after, sort, ORDER_SORTS))
+    query = query.limit(limit)
+
+    try:
+        orders = order_codec.decode_many([doc async for doc in query.stream()])
+        if orders and len(orders) == limit:
+            response.headers["X-Next-Cursor"] = encode_cursor(sort, sort_field, orders[-1].orderedAt, orders[-1].orderId)
+        return orders
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching orders: {e}")
 
@@ -654,7 +4081,7 @@ async def get_order_by_id(order_id: str, current_user: dict = Depends(get_curren
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
     order_ref = db.collection('orders').document(order_id)
     try:
-        doc = order_ref.get()
+        doc = await order_ref.get()
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
         
@@ -663,25 +4090,203 @@ async def get_order_by_id(order_id: str, current_user: dict = Depends(get_curren
         if order_data.get('buyerId') != current_user['uid'] and order_data.get('sellerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to view this order.")
 
-        if 'orderedAt' in order_data and hasattr(order_data['orderedAt'], 'isoformat'):
-            order_data['orderedAt'] = order_data['orderedAt'].isoformat()
-        if 'shippedAt' in order_data and hasattr(order_data['shippedAt'], 'isoformat'):
-            order_data['shippedAt'] = order_data['shippedAt'].isoformat()
-        if 'deliveredAt' in order_data and hasattr(order_data['deliveredAt'], 'isoformat'):
-            order_data['deliveredAt'] = order_data['deliveredAt'].isoformat()
-
-        order_data['orderId'] = doc.id
-        return Order(**order_data)
+        return order_codec.decode_data(doc.id, order_data)
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching order: {e}")
 
+@app.post("/orders:batchGet", response_model=OrderBatch, summary="Get several orders by ID")
+async def batch_get_orders(request: BatchGetRequest, current_user: dict = Depends(get_current_user)):
+    """
+    Retrieves up to BATCH_GET_MAX_IDS orders in one Firestore round trip.
+    Orders the user is neither buyer nor seller of are reported as missing, like IDs that do not exist.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+
+    def allow(order_data):
+        return current_user['uid'] in (order_data.get('buyerId'), order_data.get('sellerId'))
+
+    try:
+        orders, missing = await batch_get('orders', request.ids, order_codec, allow=allow)
+        return OrderBatch(items=list(orders.values()), missing=missing)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching orders: {e}")
+
+# --- Checkout: orders that reserve their listings ---
+
+CHECKOUT_MAX_ITEMS = int(os.getenv("CHECKOUT_MAX_ITEMS", "50"))
+CHECKOUT_MAX_ATTEMPTS = int(os.getenv("CHECKOUT_MAX_ATTEMPTS", "5"))
+LISTING_AVAILABLE = "available"
+LISTING_RESERVED = "reserved"
+LISTING_SOLD = "sold"
+# Listing status an order moving into one of these states leaves behind
+LISTING_STATUS_AFTER_ORDER = {"cancelled": LISTING_AVAILABLE, "delivered": LISTING_SOLD}
+
+
+class CheckoutItem(BaseModel):
+    productId: str = Field(..., min_length=5)
+    buyerNotes: Optional[str] = None
+
+
+class CheckoutRequest(BaseModel):
+    items: List[CheckoutItem] = Field(..., min_length=1, max_length=CHECKOUT_MAX_ITEMS)
+    paymentMethod: str = Field(..., max_length=50)
+    shippingAddress: ShippingAddress
+
+
+class CheckoutItemResult(BaseModel):
+    productId: str
+    status: int  # 201 ordered, 403 own listing, 404 missing, 409 not available, 424 not ordered because another item failed
+    error: Optional[str] = None
+    order: Optional[Order] = None
+
+
+class CheckoutResult(BaseModel):
+    committed: bool
+    attempts: int
+    items: List[CheckoutItemResult]
+
+
+async def reserve_listings(product_ids: List[str], buyer_id: str, build_order) -> tuple:
+    """
+    In one transaction, reads every listing and checks each is available and not the
+    buyer's own. Only if all of them are does it create an order per listing (from
+    `build_order(product_id, product_data, now)`) and mark each listing reserved.
+    Concurrency is optimistic: a checkout that races another one for the same listing
+    aborts on commit and is retried, up to CHECKOUT_MAX_ATTEMPTS attempts in total,
+    re-reading the listings, so losing the race shows up as a per-item 409.
+    Returns (results, attempts, reserved), where results[i] is
+    (status code, error, order ID, order data) and reserved maps product ID to its data after the write.
+    """
+    products_ref = db.collection('products')
+    orders_ref = db.collection('orders')
+    product_refs = [products_ref.document(product_id) for product_id in product_ids]
+    attempts = 0
+
+    @async_transactional
+    async def reserve(transaction):
+        nonlocal attempts
+        attempts += 1
+        now = datetime.datetime.now(datetime.timezone.utc)
+        snapshots = {doc.id: doc async for doc in db.get_all(product_refs, transaction=transaction)}
+        listings = []
+        results = []
+        for product_id in product_ids:
+            snapshot = snapshots.get(product_id)
+            data = snapshot.to_dict() if snapshot is not None and snapshot.exists else None
+            listings.append(data)
+            if data is None:
+                results.append((status.HTTP_404_NOT_FOUND, "Product not found", None, None))
+            elif data.get('sellerId') == buyer_id:
+                results.append((status.HTTP_403_FORBIDDEN, "You cannot order your own listing.", None, None))
+            elif data.get('status', LISTING_AVAILABLE) != LISTING_AVAILABLE:
+                results.append((status.HTTP_409_CONFLICT, f"Listing is {data.get('status')}.", None, None))
+            else:
+                results.append((status.HTTP_201_CREATED, None, None, None))
+        if any(code != status.HTTP_201_CREATED for code, _, _, _ in results):
+            return results, {}
+
+        results = []
+        reserved = {}
+        for product_id, product_ref, product_data in zip(product_ids, product_refs, listings):
+            order_ref = orders_ref.document()
+            order_data = build_order(product_id, product_data, now)
+            transaction.create(order_ref, order_data)
+            transaction.update(product_ref, {'status': LISTING_RESERVED, 'updatedAt': now})
+            reserved[product_id] = {**product_data, 'status': LISTING_RESERVED, 'updatedAt': now}
+            results.append((status.HTTP_201_CREATED, None, order_ref.id, order_data))
+        return results, reserved
+
+    try:
+        results, reserved = await reserve(db.transaction(max_attempts=CHECKOUT_MAX_ATTEMPTS))
+    except ValueError as e:
+        if isinstance(e.__cause__, Aborted):
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Checkout kept colliding with other orders for these listings ({attempts} attempts). Try again.",
+            )
+        raise
+    for product_id, product_data in reserved.items():
+        apply_listing_change(product_id, product_data)
+    return results, attempts, reserved
+
+
+def apply_listing_change(product_id: str, product_data: dict):
+    """
+    Brings caches and in-process indexes up to date after a listing changed outside the product
+    handlers (a reservation, thumbnails, a propagated seller name).
+    """
+    invalidate_product(product_id)
+    try:
+        product = product_codec.decode_data(product_id, product_data)
+    except Exception as e:
+        # The write is already committed; a malformed listing just waits for the next index rebuild
+        print(f"Skipping index update for product {product_id}: {e}")
+        return
+    if product_catalog is not None:
+        product_catalog.apply_local(product)
+    else:
+        index_product(product)
+
+
+@app.post("/checkout", response_model=CheckoutResult, status_code=status.HTTP_201_CREATED, summary="Order every item in the cart at once")
+async def checkout(request: CheckoutRequest, response: Response, current_user: dict = Depends(get_current_user)):
+    """
+    Creates one order per cart item and marks every listing reserved, all in a single
+    Firestore transaction: either every item is ordered (201) or nothing is written (409),
+    with a per-item status explaining which listings could not be reserved.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    product_ids = [item.productId for item in request.items]
+    if len(set(product_ids)) != len(product_ids):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Each product may appear only once in a checkout.")
+    notes = {item.productId: item.buyerNotes for item in request.items}
+    shipping_address = request.shippingAddress.model_dump()
+
+    def build_order(product_id, product_data, now):
+        # Used parts are one of a kind, so every order is for a single unit at the listed price
+        order_data = OrderCreate(
+            productId=product_id,
+            buyerId=current_user['uid'],
+            sellerId=product_data['sellerId'],
+            productName=product_data['name'],
+            productPrice=product_data['price'],
+            totalAmount=product_data['price'],
+            currency=product_data.get('currency', 'BDT'),
+            paymentMethod=request.paymentMethod,
+            shippingAddress=shipping_address,
+            buyerNotes=notes[product_id],
+        ).model_dump()
+        order_data['orderedAt'] = now
+        return order_data
+
+    try:
+        results, attempts, reserved = await reserve_listings(product_ids, current_user['uid'], build_order)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error checking out: {e}")
+
+    committed = bool(reserved)
+    items = []
+    for product_id, (code, error, order_id, order_data) in zip(product_ids, results):
+        if not committed and code == status.HTTP_201_CREATED:
+            code, error = status.HTTP_424_FAILED_DEPENDENCY, "Not ordered because another item could not be reserved."
+        order = order_codec.decode_data(order_id, order_data) if committed else None
+        items.append(CheckoutItemResult(productId=product_id, status=code, error=error, order=order))
+    if not committed:
+        response.status_code = status.HTTP_409_CONFLICT
+    return CheckoutResult(committed=committed, attempts=attempts, items=items)
+
 @app.post("/orders", response_model=Order, status_code=status.HTTP_201_CREATED, summary="Create a new order")
 async def create_order(order: OrderCreate, current_user: dict = Depends(get_current_user)):
     """
     Creates a new order in the Firestore 'orders' collection.
-    The buyerId must match the authenticated user.
+    The buyerId must match the authenticated user. The listing is reserved in the
+    same transaction, so two buyers cannot both order it (409 for the second).
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
@@ -689,28 +4294,20 @@ async def create_order(order: OrderCreate, current_user: dict = Depends(get_curr
     if order.buyerId != current_user['uid']:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Buyer ID must match authenticated user.")
 
-    orders_ref = db.collection('orders')
-    try:
+    def build_order(product_id, product_data, now):
         order_data = order.model_dump()
-        now = datetime.datetime.now(datetime.timezone.utc)
-
         order_data['orderedAt'] = now
         # shippedAt and deliveredAt are optional and set later
+        return order_data
 
-        update_time, doc_ref = orders_ref.add(order_data) 
-
-        new_order_doc = doc_ref.get() 
-        new_order_data = new_order_doc.to_dict()
-        new_order_data['orderId'] = new_order_doc.id
-        
-        if 'orderedAt' in new_order_data and hasattr(new_order_data['orderedAt'], 'isoformat'):
-            new_order_data['orderedAt'] = new_order_data['orderedAt'].isoformat()
-        if 'shippedAt' in new_order_data and hasattr(new_order_data['shippedAt'], 'isoformat'):
-            new_order_data['shippedAt'] = new_order_data['shippedAt'].isoformat()
-        if 'deliveredAt' in new_order_data and hasattr(new_order_data['deliveredAt'], 'isoformat'):
-            new_order_data['deliveredAt'] = new_order_data['deliveredAt'].isoformat()
-
-        return Order(**new_order_data)
+    try:
+        results, _, _ = await reserve_listings([order.productId], current_user['uid'], build_order)
+        code, error, order_id, order_data = results[0]
+        if code != status.HTTP_201_CREATED:
+            raise HTTPException(status_code=code, detail=error)
+        return order_codec.decode_data(order_id, order_data)
+    except HTTPException as e:
+        raise e
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error creating order: {e}")
 
@@ -721,21 +4318,33 @@ async def update_order(order_id: str, order_update: OrderUpdate, current_user: d
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
-    order_ref = db.collection('orders').document(order_id)
-    try:
-        doc = order_ref.get()
-        if not doc.exists:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
-        
-        order_data = doc.to_dict()
+    update_data = order_update.model_dump(exclude_unset=True)
+    if not update_data:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
+
+    def authorize(order_data):
         if order_data.get('buyerId') != current_user['uid'] and order_data.get('sellerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to update this order.")
 
-        update_data = order_update.model_dump(exclude_unset=True)
-        
-        if not update_data:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
+    listing_status = LISTING_STATUS_AFTER_ORDER.get(update_data.get('orderStatus'))
+    settled = {}
+
+    async def settle_listing(transaction, order_data):
+        # A cancelled order frees its reserved listing; a delivered one marks it sold
+        settled.clear()
+        if order_data.get('orderStatus') == update_data['orderStatus']:
+            return
+        product_ref = db.collection('products').document(order_data['productId'])
+        snapshot = await product_ref.get(transaction=transaction)
+        product_data = snapshot.to_dict() if snapshot.exists else None
+        if product_data is None or product_data.get('status') != LISTING_RESERVED:
+            return
+        now = datetime.datetime.now(datetime.timezone.utc)
+        transaction.update(product_ref, {'status': listing_status, 'updatedAt': now})
+        settled[product_ref.id] = {**product_data, 'status': listing_status, 'updatedAt': now}
 
+    order_ref = db.collection('orders').document(order_id)
+    try:
         # Handle specific timestamp updates if they are provided
         if 'shippedAt' in update_data and update_data['shippedAt'] is None: # Allow setting to null
             update_data['shippedAt'] = DELETE_FIELD
@@ -747,20 +4356,11 @@ async def update_order(order_id: str, order_update: OrderUpdate, current_user: d
         elif 'deliveredAt' in update_data and isinstance(update_data['deliveredAt'], str):
             update_data['deliveredAt'] = datetime.datetime.fromisoformat(update_data['deliveredAt'].replace('Z', '+00:00'))
         
-        order_ref.update(update_data)
-
-        updated_order_doc = order_ref.get()
-        updated_order_data = updated_order_doc.to_dict()
-        updated_order_data['orderId'] = updated_order_doc.id
-
-        if 'orderedAt' in updated_order_data and hasattr(updated_order_data['orderedAt'], 'isoformat'):
-            updated_order_data['orderedAt'] = updated_order_data['orderedAt'].isoformat()
-        if 'shippedAt' in updated_order_data and hasattr(updated_order_data['shippedAt'], 'isoformat'):
-            updated_order_data['shippedAt'] = updated_order_data['shippedAt'].isoformat()
-        if 'deliveredAt' in updated_order_data and hasattr(updated_order_data['deliveredAt'], 'isoformat'):
-            updated_order_data['deliveredAt'] = updated_order_data['deliveredAt'].isoformat()
-            
-        return Order(**updated_order_data)
+        order_data = await update_in_transaction(
+            order_ref, update_data, "Order not found", authorize, settle_listing if listing_status else None)
+        for product_id, product_data in settled.items():
+            apply_listing_change(product_id, product_data)
+        return order_codec.decode_data(order_id, order_data)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -770,20 +4370,36 @@ async def update_order(order_id: str, order_update: OrderUpdate, current_user: d
 async def delete_order(order_id: str, current_user: dict = Depends(get_current_user)):
     """
     Deletes an order. Only the buyer or seller can delete it.
+    An order still in progress releases its reserved listing in the same transaction.
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
     order_ref = db.collection('orders').document(order_id)
-    try:
-        doc = order_ref.get()
+
+    @async_transactional
+    async def delete_and_release(transaction):
+        doc = await order_ref.get(transaction=transaction)
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found")
-        
         order_data = doc.to_dict()
         if order_data.get('buyerId') != current_user['uid'] and order_data.get('sellerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this order.")
 
-        order_ref.delete()
+        released = None
+        if order_data.get('orderStatus') not in LISTING_STATUS_AFTER_ORDER and order_data.get('productId'):
+            product_ref = db.collection('products').document(order_data['productId'])
+            snapshot = await product_ref.get(transaction=transaction)
+            if snapshot.exists and snapshot.to_dict().get('status') == LISTING_RESERVED:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                transaction.update(product_ref, {'status': LISTING_AVAILABLE, 'updatedAt': now})
+                released = (product_ref.id, {**snapshot.to_dict(), 'status': LISTING_AVAILABLE, 'updatedAt': now})
+        transaction.delete(order_ref)
+        return released
+
+    try:
+        released = await delete_and_release(db.transaction())
+        if released is not None:
+            apply_listing_change(*released)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except HTTPException as e:
         raise e
@@ -792,52 +4408,222 @@ async def delete_order(order_id: str, current_user: dict = Depends(get_current_u
 
 # --- Review Endpoints ---
 
+# Seller rating aggregates: every review write adjusts ratingSum/totalReviews/rating on the
+# seller's users document in the same transaction, so profiles never need a reviews scan.
+
+async def adjust_seller_rating(transaction, seller_id: str, sum_delta: float, count_delta: int):
+    """
+    Reads the seller's users document in `transaction` and returns a function that queues the
+    adjusted aggregate write. Reads must precede writes in a transaction, so callers do all
+    their reads first and call the returned function afterwards. Sellers without a profile
+    are skipped; reconcile_seller_ratings() picks them up once the profile exists.
+    """
+    seller_ref = db.collection('users').document(seller_id)
+    snapshot = await seller_ref.get(transaction=transaction)
+
+    def write():
+        if not snapshot.exists or (sum_delta == 0 and count_delta == 0):
+            return
+        seller_data = snapshot.to_dict()
+        total = seller_data.get('totalReviews', 0)
+        rating_sum = seller_data.get('ratingSum', seller_data.get('rating', 0.0) * total)
+        transaction.update(seller_ref, seller_rating_fields(rating_sum + sum_delta, total + count_delta))
+
+    return write
+
+
+def seller_rating_fields(rating_sum: float, total: int) -> dict:
+    total = max(total, 0)
+    rating_sum = max(rating_sum, 0) if total else 0
+    return {'ratingSum': rating_sum, 'totalReviews': total, 'rating': round(rating_sum / total, 2) if total else 0.0}
+
+
+async def reconcile_seller_ratings(dry_run: bool = False) -> dict:
+    """
+    Recomputes every seller's rating aggregates from the reviews collection in one streaming
+    pass, then corrects users documents that disagree, in WriteBatches of up to 500.
+    Meant to run offline (scripts/reconcile_seller_ratings.py): reviews written while it
+    runs can be counted twice or not at all.
+    """
+    totals = {}  # seller_id -> [rating sum, review count]
+    reviews_seen = 0
+    async for doc in db.collection('reviews').select(['sellerId', 'rating']).stream():
+        review_data = doc.to_dict()
+        seller_total = totals.setdefault(review_data.get('sellerId'), [0, 0])
+        seller_total[0] += review_data.get('rating', 0)
+        seller_total[1] += 1
+        reviews_seen += 1
+
+    corrections = []
+    async for doc in db.collection('users').select(['ratingSum', 'totalReviews', 'rating']).stream():
+        rating_sum, total = totals.get(doc.id, (0, 0))
+        expected = seller_rating_fields(rating_sum, total)
+        current = doc.to_dict()
+        if any(current.get(field) != value for field, value in expected.items()):
+            corrections.append((doc.reference, expected))
+
+    if not dry_run:
+        for start in range(0, len(corrections), BULK_WRITE_CHUNK_SIZE):
+            batch = db.batch()
+            for user_ref, fields in corrections[start:start + BULK_WRITE_CHUNK_SIZE]:
+                batch.update(user_ref, fields)
+            await batch.commit()
+    return {"reviews": reviews_seen, "sellers": len(totals), "corrected": len(corrections), "dryRun": dry_run}
+
+
+# Sort options for per-product and per-seller review listings; each needs the matching
+# composite index in firestore.indexes.json (filter field, isApproved, sort field, __name__).
+REVIEW_SORTS = {
+    "newest": ("reviewedAt", firestore.Query.DESCENDING),
+    "helpful": ("helpfulVotes", firestore.Query.DESCENDING),
+}
+
+
+async def list_reviews_page(request: Request, response: Response, field: str, value: str, sort: str, limit: int, start_after: Optional[str]):
+    """
+    Serves one page of approved reviews where `field == value` with a single bounded query,
+    through the review list cache. The next-page cursor goes in the X-Next-Cursor header.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    if sort not in REVIEW_SORTS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid sort. Use one of: {', '.join(REVIEW_SORTS)}")
+
+    cache_key = (field, value, sort, limit, start_after)
+    cached = review_list_cache.get(cache_key)
+    if cached is not None:
+        reviews, next_cursor = cached
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+        return not_modified(request, response, collection_etag(reviews, review_version, next_cursor)) or reviews
+    generation = review_list_cache.generation
+
+    sort_field, direction = REVIEW_SORTS[sort]
+    query = db.collection('reviews').where(filter=FieldFilter(field, '==', value)).where(filter=FieldFilter('isApproved', '==', True))
+    query = query.order_by(sort_field, direction=direction).order_by('__name__', direction=direction)
+    if start_after:
+        query = query.start_after(decode_cursor(start_after, sort, REVIEW_SORTS))
+    query = query.limit(limit)
+
+    try:
+        reviews = review_codec.decode_many([doc async for doc in query.stream()])
+        next_cursor = None
+        if reviews and len(reviews) == limit:
+            last = reviews[-1]
+            next_cursor = encode_cursor(sort, sort_field, getattr(last, sort_field), last.reviewId)
+            response.headers["X-Next-Cursor"] = next_cursor
+        review_list_cache.set(cache_key, (reviews, next_cursor), generation)
+        return not_modified(request, response, collection_etag(reviews, review_version, next_cursor)) or reviews
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching reviews: {e}")
+
+
+@app.get("/products/{product_id}/reviews", response_model=List[Review], summary="List reviews of a product")
+async def get_product_reviews(
+    product_id: str,
+    request: Request,
+    response: Response,
+    sort: str = "newest",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = None,
+):
+    """
+    Retrieves one page of approved reviews for a product, newest first or most helpful first.
+    """
+    return await list_reviews_page(request, response, 'productId', product_id, sort, limit, start_after)
+
+
+@app.get("/users/{user_id}/reviews", response_model=List[Review], summary="List reviews received by a seller")
+async def get_seller_reviews(
+    user_id: str,
+    request: Request,
+    response: Response,
+    sort: str = "newest",
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    start_after: Optional[str] = None,
+):
+    """
+    Retrieves one page of approved reviews left for a seller, newest first or most helpful first.
+    """
+    return await list_reviews_page(request, response, 'sellerId', user_id, sort, limit, start_after)
+
+
 @app.get("/reviews", response_model=List[Review], summary="Get all reviews")
-async def get_all_reviews():
+async def get_all_reviews(request: Request, response: Response, stream: bool = False):
     """
     Retrieves a list of all reviews from the Firestore 'reviews' collection.
+    Streams NDJSON with `?stream=1` or `Accept: application/x-ndjson`.
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    if wants_ndjson(request, stream):
+        return StreamingResponse(ndjson_stream(db.collection('reviews').stream(), review_codec.decode), media_type=NDJSON_MEDIA_TYPE)
+    cached = review_list_cache.get("all")
+    if cached is not None:
+        return not_modified(request, response, collection_etag(cached, review_version)) or cached
+    generation = review_list_cache.generation
+
     reviews_ref = db.collection('reviews')
     try:
-        docs = reviews_ref.stream()
-        reviews = []
-        for doc in docs:
-            review_data = doc.to_dict()
-            if 'reviewedAt' in review_data and hasattr(review_data['reviewedAt'], 'isoformat'):
-                review_data['reviewedAt'] = review_data['reviewedAt'].isoformat()
-            
-            review_data['reviewId'] = doc.id
-            reviews.append(Review(**review_data))
-        return reviews
+        reviews = review_codec.decode_many([doc async for doc in reviews_ref.stream()])
+        review_list_cache.set("all", reviews, generation)
+        return not_modified(request, response, collection_etag(reviews, review_version)) or reviews
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching reviews: {e}")
 
 @app.get("/reviews/{review_id}", response_model=Review, summary="Get a review by ID")
-async def get_review_by_id(review_id: str):
+async def get_review_by_id(review_id: str, request: Request, response: Response):
     """
     Retrieves a single review by its unique ID from the Firestore 'reviews' collection.
+    Answers 304 when If-None-Match / If-Modified-Since show the client's copy is current.
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+
+    def respond(review):
+        return not_modified(request, response, entity_etag(review), review.updatedAt or review.reviewedAt) or review
+
+    cached = review_cache.get(review_id)
+    if cached is not None:
+        return respond(cached)
+    generation = review_cache.generation
+
     review_ref = db.collection('reviews').document(review_id)
     try:
-        doc = review_ref.get()
+        doc = await review_ref.get()
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Review not found")
         
-        review_data = doc.to_dict()
-        if 'reviewedAt' in review_data and hasattr(review_data['reviewedAt'], 'isoformat'):
-            review_data['reviewedAt'] = review_data['reviewedAt'].isoformat()
-
-        review_data['reviewId'] = doc.id
-        return Review(**review_data)
+        review = review_codec.decode(doc)
+        review_cache.set(review_id, review, generation)
+        return respond(review)
     except HTTPException as e:
         raise e
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching review: {e}")
 
+@app.post("/reviews:batchGet", response_model=ReviewBatch, summary="Get several reviews by ID")
+async def batch_get_reviews(request: BatchGetRequest):
+    """
+    Retrieves up to BATCH_GET_MAX_IDS reviews in one Firestore round trip, skipping cached ones.
+    """
+    if db is None:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
+    known = {}
+    for review_id in request.ids:
+        review = review_cache.get(review_id)
+        if review is not None:
+            known[review_id] = review
+    generation = review_cache.generation
+    try:
+        reviews, missing = await batch_get('reviews', request.ids, review_codec, known)
+        for review_id, review in reviews.items():
+            if review_id not in known:
+                review_cache.set(review_id, review, generation)
+        return ReviewBatch(items=list(reviews.values()), missing=missing)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error fetching reviews: {e}")
+
 @app.post("/reviews", response_model=Review, status_code=status.HTTP_201_CREATED, summary="Create a new review")
 async def create_review(review: ReviewCreate, current_user: dict = Depends(get_current_user)):
     """
@@ -856,17 +4642,17 @@ async def create_review(review: ReviewCreate, current_user: dict = Depends(get_c
         now = datetime.datetime.now(datetime.timezone.utc)
 
         review_data['reviewedAt'] = now
+        doc_ref = reviews_ref.document()
 
-        update_time, doc_ref = reviews_ref.add(review_data) 
-
-        new_review_doc = doc_ref.get() 
-        new_review_data = new_review_doc.to_dict()
-        new_review_data['reviewId'] = new_review_doc.id
-        
-        if 'reviewedAt' in new_review_data and hasattr(new_review_data['reviewedAt'], 'isoformat'):
-            new_review_data['reviewedAt'] = new_review_data['reviewedAt'].isoformat()
+        @async_transactional
+        async def write_review(transaction):
+            write_seller_rating = await adjust_seller_rating(transaction, review.sellerId, review.rating, 1)
+            transaction.create(doc_ref, review_data)
+            write_seller_rating()
 
-        return Review(**new_review_data)
+        await write_review(db.transaction())
+        invalidate_review()
+        return review_codec.decode_data(doc_ref.id, review_data)
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Error creating review: {e}")
 
@@ -877,31 +4663,29 @@ async def update_review(review_id: str, review_update: ReviewUpdate, current_use
     """
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
-    review_ref = db.collection('reviews').document(review_id)
-    try:
-        doc = review_ref.get()
-        if not doc.exists:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Review not found")
-        
-        review_data = doc.to_dict()
+    update_data = review_update.model_dump(exclude_unset=True)
+    if not update_data:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
+    if 'rating' in update_data and update_data['rating'] is None:
+        # The rating feeds the seller's aggregate, so it can be changed but not cleared
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Rating cannot be removed")
+
+    def authorize(review_data):
         if review_data.get('reviewerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to update this review.")
 
-        update_data = review_update.model_dump(exclude_unset=True)
-        
-        if not update_data:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="No fields provided for update")
-        
-        review_ref.update(update_data)
+    update_data['updatedAt'] = datetime.datetime.now(datetime.timezone.utc)
 
-        updated_review_doc = review_ref.get()
-        updated_review_data = updated_review_doc.to_dict()
-        updated_review_data['reviewId'] = updated_review_doc.id
+    async def update_seller_rating(transaction, review_data):
+        if 'rating' in update_data:
+            sum_delta = update_data['rating'] - review_data.get('rating', 0)
+            (await adjust_seller_rating(transaction, review_data['sellerId'], sum_delta, 0))()
 
-        if 'reviewedAt' in updated_review_data and hasattr(updated_review_data['reviewedAt'], 'isoformat'):
-            updated_review_data['reviewedAt'] = updated_review_data['reviewedAt'].isoformat()
-            
-        return Review(**updated_review_data)
+    review_ref = db.collection('reviews').document(review_id)
+    try:
+        review_data = await update_in_transaction(review_ref, update_data, "Review not found", authorize, update_seller_rating)
+        invalidate_review(review_id)
+        return review_codec.decode_data(review_id, review_data)
     except HTTPException as e:
         raise e
     except Exception as e:
@@ -915,16 +4699,24 @@ async def delete_review(review_id: str, current_user: dict = Depends(get_current
     if db is None:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Firestore database not initialized.")
     review_ref = db.collection('reviews').document(review_id)
-    try:
-        doc = review_ref.get()
+
+    @async_transactional
+    async def delete_with_rating(transaction):
+        doc = await review_ref.get(transaction=transaction)
         if not doc.exists:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Review not found")
-        
+
         review_data = doc.to_dict()
         if review_data.get('reviewerId') != current_user['uid']:
             raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="You do not have permission to delete this review.")
 
-        review_ref.delete()
+        write_seller_rating = await adjust_seller_rating(transaction, review_data['sellerId'], -review_data.get('rating', 0), -1)
+        transaction.delete(review_ref)
+        write_seller_rating()
+
+    try:
+        await delete_with_rating(db.transaction())
+        invalidate_review(review_id)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except HTTPException as e:
         raise e
@@ -0,0 +1,117 @@
+"""
+Overload benchmark for admission control.
+
+Sends an open-loop stream of GET /products requests, faster than the simulated
+Firestore can serve them, to the in-process app twice: with admission control
+off (every request waits for the store) and on (requests past the route's
+concurrency limit and queue are shed with 503 + Retry-After). The store serves
+at most --capacity round trips at a time, like a project at its quota, so the
+backlog builds up when nothing in front of it says no. For each mode the script
+reports served and shed requests and the latency of served requests.
+
+Usage (from the repository root, needs `pip install httpx`):
+
+    python benchmarks/bench_admission.py --rate 300 --seconds 5 --capacity 8 --latency 10
+"""
+import argparse
+import asyncio
+import collections
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def percentile(ordered, pct):
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def limit_capacity(db, capacity):
+    """
+    Lets at most `capacity` simulated round trips run at once; the rest wait their turn.
+    """
+    slots = asyncio.Semaphore(capacity)
+    round_trip = db._round_trip
+
+    async def limited():
+        async with slots:
+            await round_trip()
+
+    db._round_trip = limited
+
+
+async def run_mode(client, args):
+    latencies = []
+    statuses = collections.Counter()
+
+    async def request():
+        started = time.perf_counter()
+        response = await client.get("/products", params={"limit": 20})
+        statuses[response.status_code] += 1
+        if response.status_code == 200:
+            latencies.append(time.perf_counter() - started)
+
+    tasks = []
+    started = time.perf_counter()
+    for i in range(int(args.rate * args.seconds)):
+        # Open loop: arrivals keep their schedule however slow the responses get
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(request()))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "served": statuses[200],
+        "shed": statuses[503],
+        "other": sum(count for code, count in statuses.items() if code not in (200, 503)),
+        "p50": percentile(latencies, 50) * 1000 if latencies else 0,
+        "p99": percentile(latencies, 99) * 1000 if latencies else 0,
+        "max": latencies[-1] * 1000 if latencies else 0,
+    }
+
+
+async def run(args):
+    import backend
+
+    limit_capacity(backend.db._target, args.capacity)
+    print(f"{args.rate:g} req/s for {args.seconds:g} s to GET /products, store capacity {args.capacity} x {args.latency:g} ms")
+    print(f"{'admission':<11}{'served':>8}{'shed':>7}{'other':>7}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'elapsed s':>11}")
+    async with backend.lifespan(backend.app):
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for enabled in (False, True):
+                backend.ADMISSION_ENABLED = enabled
+                r = await run_mode(client, args)
+                print(f"{'on' if enabled else 'off':<11}{r['served']:>8}{r['shed']:>7}{r['other']:>7}"
+                      f"{r['p50']:>9.1f}{r['p99']:>9.1f}{r['max']:>9.1f}{r['elapsed']:>11.2f}")
+                # Let the backlog drain so the next mode starts from an idle store
+                await asyncio.sleep(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=300, help="requests per second, open loop")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--capacity", type=int, default=8, help="simulated round trips Firestore serves at once")
+    parser.add_argument("--latency", type=float, default=10, help="simulated Firestore RTT in milliseconds")
+    parser.add_argument("--products", type=int, default=1000)
+    args = parser.parse_args()
+
+    os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ["MEMORY_STORE_LATENCY_MS"] = str(args.latency)
+    os.environ["MEMORY_SEED_PRODUCTS"] = str(args.products)
+    # Every request comes from one client and must reach the store
+    os.environ["CACHE_TTL_SECONDS"] = "0"
+    os.environ["RATE_LIMIT_IP_PER_SECOND"] = "0"
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
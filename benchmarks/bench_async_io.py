@@ -0,0 +1,116 @@
+"""
+Concurrency benchmark for the Firestore access path in backend.py.
+
+Runs the real FastAPI app in-process against memory_store/fake_firestore.py and
+compares two modes:
+
+  blocking  every Firestore call sleeps synchronously (the old sync client
+            inside `async def` handlers)
+  async     every Firestore call awaits (the AsyncClient data-access layer)
+
+Usage (from the repository root, needs `pip install httpx`):
+
+    python benchmarks/bench_async_io.py --requests 1000 --rate 500 --latency 0.02
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+# Measure the Firestore path itself, not the read cache in front of it
+os.environ.setdefault("CACHE_TTL_SECONDS", "0")
+# All requests come from one client address
+os.environ.setdefault("RATE_LIMIT_IP_PER_SECOND", "0")
+os.environ.setdefault("RATE_LIMIT_USER_PER_SECOND", "0")
+
+import backend  # noqa: E402
+from memory_store.fake_firestore import FakeFirestore  # noqa: E402
+
+
+def seed_products(client, count):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    store = client._collections.setdefault("products", {})
+    for i in range(count):
+        store[f"product{i:05d}"] = {
+            "name": f"Used part {i}",
+            "category": "GPUs",
+            "subcategory": "NVIDIA",
+            "description": "A lightly used part in working condition.",
+            "price": 100.0 + i,
+            "currency": "BDT",
+            "condition": "Good",
+            "images": ["https://example.com/image.jpg"],
+            "sellerId": "seller0001",
+            "sellerName": "Seller",
+            "location": {"city": "Dhaka", "country": "Bangladesh"},
+            "status": "available",
+            "specifications": "",
+            "yearsUsed": 1,
+            "negotiable": False,
+            "shippingOptions": ["local pickup"],
+            "postedAt": now - datetime.timedelta(minutes=i),
+            "updatedAt": now,
+            "views": 0,
+        }
+    return list(store)
+
+
+async def run_load(product_ids, total, rate):
+    """
+    Open-loop load: request i is due at i / rate seconds. Latency is measured from the
+    due time, so time spent waiting behind a blocked event loop is counted too.
+    """
+    latencies = []
+    transport = httpx.ASGITransport(app=backend.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def one(product_id, due):
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            response = await client.get(f"/products/{product_id}")
+            latencies.append(time.perf_counter() - due)
+            response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            one(product_ids[i % len(product_ids)], started + i / rate) for i in range(total)
+        ))
+        elapsed = time.perf_counter() - started
+    return elapsed, latencies
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--rate", type=float, default=500, help="offered load in requests per second")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated Firestore RTT in seconds")
+    parser.add_argument("--products", type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{args.requests} requests offered at {args.rate:.0f} req/s, simulated RTT {args.latency * 1000:.0f} ms")
+    print(f"{'mode':<10}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for mode in ("blocking", "async"):
+        backend.db = FakeFirestore(latency=args.latency, blocking=mode == "blocking")
+        product_ids = seed_products(backend.db, args.products)
+        elapsed, latencies = asyncio.run(run_load(product_ids, args.requests, args.rate))
+        print(
+            f"{mode:<10}{args.requests / elapsed:>10.1f}"
+            f"{statistics.median(latencies) * 1000:>10.1f}{percentile(latencies, 99) * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Contention benchmark for cart checkout.
+
+Many buyers race for a small set of hot listings. Each buyer checks out a random
+cart from that set, either with one POST /checkout (all items in one transaction)
+or with one POST /orders per item (the old cart flow). Each mode uses its own hot
+listings in the same seeded store. For each mode the script reports carts fully
+ordered, rejected and partially ordered, transaction attempts, latency percentiles,
+and whether any listing was ordered twice (it must never be).
+
+Usage (from the repository root, needs `pip install httpx`):
+
+    python benchmarks/bench_checkout.py --buyers 200 --hot 20 --cart-size 3 --latency 5
+"""
+import argparse
+import asyncio
+import collections
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+ADDRESS = {"street": "12 Road 4", "city": "Dhaka", "zipCode": "1205", "country": "Bangladesh"}
+
+
+def percentile(ordered, pct):
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def checkout_cart(client, buyer, cart, product_data):
+    """
+    One POST /checkout. Returns (items ordered, transaction attempts).
+    """
+    response = await client.post(
+        "/checkout",
+        json={"items": [{"productId": product_id} for product_id in cart], "paymentMethod": "bkash", "shippingAddress": ADDRESS},
+        headers={"Authorization": f"Bearer test:{buyer}"},
+    )
+    if response.status_code not in (201, 409):
+        response.raise_for_status()
+    body = response.json()
+    if "items" not in body:
+        # Retries exhausted: reported as a plain 409 with no per-item results
+        return 0, None
+    return (len(cart) if body["committed"] else 0), body["attempts"]
+
+
+async def order_items(client, buyer, cart, product_data):
+    """
+    One POST /orders per item, in sequence, like the cart page used to. Returns (items ordered, None).
+    """
+    ordered = 0
+    for product_id in cart:
+        product = product_data[product_id]
+        response = await client.post(
+            "/orders",
+            json={
+                "productId": product_id, "buyerId": buyer, "sellerId": product["sellerId"],
+                "productName": product["name"], "productPrice": product["price"], "totalAmount": product["price"],
+                "currency": product["currency"], "paymentMethod": "bkash", "shippingAddress": ADDRESS,
+            },
+            headers={"Authorization": f"Bearer test:{buyer}"},
+        )
+        if response.status_code == 201:
+            ordered += 1
+        elif response.status_code != 409:
+            response.raise_for_status()
+    return ordered, None
+
+
+async def run_mode(client, place, hot, product_data, args, rng):
+    import backend
+
+    carts = [rng.sample(hot, args.cart_size) for _ in range(args.buyers)]
+    latencies = []
+    outcomes = collections.Counter()
+    attempts = collections.Counter()
+
+    async def buyer(i, cart):
+        started = time.perf_counter()
+        ordered, tries = await place(client, f"benchbuyer{i:05d}", cart, product_data)
+        latencies.append(time.perf_counter() - started)
+        outcomes["ordered" if ordered == len(cart) else "partial" if ordered else "rejected"] += 1
+        if tries is not None:
+            attempts[tries] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(buyer(i, cart) for i, cart in enumerate(carts)))
+    elapsed = time.perf_counter() - started
+
+    orders = backend.db._target._collections.get("orders", {}).values()
+    per_listing = collections.Counter(order["productId"] for order in orders if order["buyerId"].startswith("benchbuyer"))
+    double_sold = sum(1 for product_id in hot if per_listing[product_id] > 1)
+    latencies.sort()
+    return {
+        "elapsed": elapsed,
+        "outcomes": outcomes,
+        "attempts": dict(sorted(attempts.items())),
+        "p50": percentile(latencies, 50) * 1000,
+        "p99": percentile(latencies, 99) * 1000,
+        "listings_ordered": sum(1 for product_id in hot if per_listing[product_id]),
+        "double_sold": double_sold,
+    }
+
+
+async def run(args):
+    import backend
+
+    rng = random.Random(args.seed)
+    store = backend.db._target._collections["products"]
+    candidates = [product_id for product_id, data in store.items() if data["status"] == "available"]
+    rng.shuffle(candidates)
+    product_data = {product_id: store[product_id] for product_id in candidates[: args.hot * 2]}
+    modes = (("checkout", checkout_cart, candidates[: args.hot]), ("per-item", order_items, candidates[args.hot: args.hot * 2]))
+
+    print(f"{args.buyers} buyers, carts of {args.cart_size} from {args.hot} hot listings, simulated RTT {args.latency:g} ms")
+    print(f"{'mode':<10}{'ordered':>9}{'partial':>9}{'rejected':>10}{'p50 ms':>9}{'p99 ms':>9}{'listings':>10}{'double':>8}  attempts")
+    async with backend.lifespan(backend.app):
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for name, place, hot in modes:
+                r = await run_mode(client, place, hot, product_data, args, rng)
+                o = r["outcomes"]
+                print(f"{name:<10}{o['ordered']:>9}{o['partial']:>9}{o['rejected']:>10}{r['p50']:>9.1f}{r['p99']:>9.1f}"
+                      f"{r['listings_ordered']:>10}{r['double_sold']:>8}  {r['attempts'] or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--buyers", type=int, default=200, help="concurrent buyers per mode")
+    parser.add_argument("--hot", type=int, default=20, help="listings the buyers compete for")
+    parser.add_argument("--cart-size", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=5, help="simulated Firestore RTT in milliseconds")
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ["MEMORY_STORE_LATENCY_MS"] = str(args.latency)
+    os.environ["MEMORY_SEED_PRODUCTS"] = str(args.products)
+    os.environ["CACHE_TTL_SECONDS"] = "0"
+    # Buyers share one client address and race on purpose, so rate limits and load shedding would only add noise
+    os.environ.setdefault("RATE_LIMIT_IP_PER_SECOND", "0")
+    os.environ.setdefault("RATE_LIMIT_USER_PER_SECOND", "0")
+    os.environ.setdefault("ADMISSION_ENABLED", "0")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
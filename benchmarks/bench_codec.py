@@ -0,0 +1,118 @@
+"""
+Micro-benchmark for decoding Firestore documents into API models.
+
+Compares, per model at N documents:
+
+  legacy     isoformat() every timestamp, then Model(**data) parses it back
+  validated  DocumentCodec validation path (native datetimes, one TypeAdapter call)
+  construct  DocumentCodec trusted path (model_construct, no validation)
+
+The codec column shows which of the two DocumentCodec paths backend.py uses for that model.
+
+Usage (from the repository root):
+
+    python benchmarks/bench_codec.py --documents 10000
+"""
+import argparse
+import datetime
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend  # noqa: E402
+
+
+class Snapshot:
+    """
+    Minimal DocumentSnapshot: to_dict() returns a fresh shallow copy like Firestore does.
+    """
+
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+def make_documents(count):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    product = {
+        "name": "Used RTX 3080", "category": "GPUs", "subcategory": "NVIDIA",
+        "description": "Lightly used graphics card, never overclocked. " * 4,
+        "price": 450.0, "currency": "BDT", "condition": "Good",
+        "images": ["https://example.com/a.jpg", "https://example.com/b.jpg"],
+        "sellerId": "seller0001", "sellerName": "Seller", "location": {"city": "Dhaka", "country": "Bangladesh"},
+        "status": "available", "specifications": "10GB GDDR6X", "yearsUsed": 2, "negotiable": True,
+        "shippingOptions": ["local pickup"], "postedAt": now, "updatedAt": now, "views": 12,
+    }
+    user = {
+        "email": "seller@example.com", "displayName": "Seller", "roles": ["buyer", "seller"],
+        "address": {"city": "Dhaka", "country": "Bangladesh"}, "rating": 4.5, "totalReviews": 10,
+        "isVerifiedSeller": True, "createdAt": now, "lastLoginAt": now,
+    }
+    order = {
+        "productId": "product0001", "buyerId": "buyer0001", "sellerId": "seller0001", "productName": "Used RTX 3080",
+        "productPrice": 450.0, "quantity": 1, "totalAmount": 450.0, "currency": "USD", "orderStatus": "shipped",
+        "paymentMethod": "card", "paymentStatus": "paid",
+        "shippingAddress": {"street": "1 Road", "city": "Dhaka", "zipCode": "1200", "country": "Bangladesh"},
+        "orderedAt": now, "shippedAt": now,
+    }
+    review = {
+        "productId": "product0001", "sellerId": "seller0001", "reviewerId": "buyer0001", "orderId": "order0001",
+        "rating": 5, "comment": "Exactly as described, fast shipping.", "productName": "Used RTX 3080",
+        "sellerName": "Seller", "reviewerName": "Buyer", "isApproved": True, "helpfulVotes": 3, "reviewedAt": now,
+    }
+    return {
+        "Product": (backend.product_codec, [Snapshot(f"p{i}", product) for i in range(count)]),
+        "User": (backend.user_codec, [Snapshot(f"u{i}", user) for i in range(count)]),
+        "Order": (backend.order_codec, [Snapshot(f"o{i}", order) for i in range(count)]),
+        "Review": (backend.review_codec, [Snapshot(f"r{i}", review) for i in range(count)]),
+    }
+
+
+def legacy_decode(codec, docs):
+    models = []
+    for doc in docs:
+        data = doc.to_dict()
+        for field, value in data.items():
+            if hasattr(value, "isoformat"):
+                data[field] = value.isoformat()
+        data[codec.id_field] = doc.id
+        models.append(codec.model(**data))
+    return models
+
+
+def timed(func, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"best of {args.repeat}, {args.documents} documents per model (ms)")
+    print(f"{'model':<10}{'legacy':>10}{'validated':>12}{'construct':>12}{'codec':>12}")
+    for name, (codec, docs) in make_documents(args.documents).items():
+        configured = codec.trusted
+        legacy = timed(lambda: legacy_decode(codec, docs), args.repeat)
+        codec.trusted = False
+        validated = timed(lambda: codec.decode_many(docs), args.repeat)
+        codec.trusted = True
+        constructed = timed(lambda: codec.decode_many(docs), args.repeat)
+        codec.trusted = configured
+        mode = "construct" if configured else "validated"
+        print(f"{name:<10}{legacy * 1000:>10.1f}{validated * 1000:>12.1f}{constructed * 1000:>12.1f}{mode:>12}")
+
+
+if __name__ == "__main__":
+    main()
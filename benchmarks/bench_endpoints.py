@@ -0,0 +1,193 @@
+"""
+Per-endpoint load test for backend.py against the in-memory storage backend.
+
+Seeds a generated marketplace (memory_store/datagen.py) into the Firestore stand-in,
+runs the real app in-process with its lifespan, and drives each scenario with a
+fixed number of concurrent clients. Authenticated requests use "test:<uid>" tokens
+(memory_store/fake_auth.py). Reports throughput and p50/p90/p99 latency per endpoint.
+
+Usage (from the repository root, needs `pip install httpx`):
+
+    python benchmarks/bench_endpoints.py --products 10000 --requests 500 --concurrency 32 --latency 5
+
+For CI, save a baseline with --json and fail on regressions against it:
+
+    python benchmarks/bench_endpoints.py --json > baseline.json
+    python benchmarks/bench_endpoints.py --baseline baseline.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import httpx
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+
+def configure(args):
+    """
+    backend.py picks its storage at import time, so the environment is set before importing it.
+    """
+    os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ["MEMORY_STORE_LATENCY_MS"] = str(args.latency)
+    os.environ["MEMORY_SEED_PRODUCTS"] = str(args.products)
+    os.environ["CACHE_TTL_SECONDS"] = str(args.cache_ttl)
+    # All load comes from one client address and a few uids, which the rate limits would throttle
+    os.environ.setdefault("RATE_LIMIT_IP_PER_SECOND", "0")
+    os.environ.setdefault("RATE_LIMIT_USER_PER_SECOND", "0")
+
+
+def scenarios(scale, rng):
+    """
+    name -> (method, url factory, body factory, authenticated uid factory).
+    Factories draw from the seeded ID space, so the mix of hot and cold keys stays realistic.
+    """
+    from memory_store import datagen
+
+    def product():
+        return datagen.product_id(rng.randrange(scale.products))
+
+    def seller():
+        return datagen.seller_id(rng.randrange(scale.sellers))
+
+    def category():
+        return rng.choice(list(datagen.CATEGORIES))
+
+    def new_product(uid):
+        return {
+            "name": "Benchmark listing", "category": "GPUs", "subcategory": "NVIDIA",
+            "description": "Created by the endpoint benchmark.", "price": 100.0, "condition": "Good",
+            "images": ["https://images.example.com/bench.jpg"], "sellerId": uid, "sellerName": "Bench Seller",
+            "location": {"city": "Dhaka", "country": "Bangladesh"},
+        }
+
+    return {
+        "GET /products": ("GET", lambda: "/products?limit=20", None, None),
+        "GET /products?category": ("GET", lambda: f"/products?limit=20&category={category()}", None, None),
+        "GET /products?fields": ("GET", lambda: "/products?limit=50&fields=productId,name,price,images[0]", None, None),
+        "GET /products/search": ("GET", lambda: f"/products/search?q={rng.choice(['nvidia', 'ddr5', 'tower', 'ssd'])}", None, None),
+        "GET /products/{id}": ("GET", lambda: f"/products/{product()}", None, None),
+        "POST /products:batchGet": ("POST", lambda: "/products:batchGet",
+                                    lambda uid: {"ids": [product() for _ in range(20)]}, None),
+        "GET /products/{id}/reviews": ("GET", lambda: f"/products/{product()}/reviews?limit=10", None, None),
+        "GET /users/{id}/reviews": ("GET", lambda: f"/users/{seller()}/reviews?limit=10", None, None),
+        "GET /orders": ("GET", lambda: "/orders?limit=20", None, seller),
+        "POST /products": ("POST", lambda: "/products", new_product, seller),
+    }
+
+
+def percentile(ordered, pct):
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_scenario(client, scenario, total, concurrency):
+    method, url, body, uid = scenario
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            user = uid() if uid else None
+            headers = {"Authorization": f"Bearer test:{user}"} if user else {}
+            started = time.perf_counter()
+            response = await client.request(method, url(), json=body(user) if body else None, headers=headers)
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": total,
+        "errors": errors,
+        "rps": round(total / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+async def run(args):
+    import backend
+    from memory_store import datagen
+
+    scale = datagen.Scale(args.products)
+    rng = random.Random(args.seed)
+    selected = scenarios(scale, rng)
+    if args.only:
+        selected = {name: s for name, s in selected.items() if any(part in name for part in args.only)}
+
+    results = {}
+    async with backend.lifespan(backend.app):
+        while not backend.search_index.ready:
+            await asyncio.sleep(0.05)
+        transport = httpx.ASGITransport(app=backend.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name, scenario in selected.items():
+                results[name] = await run_scenario(client, scenario, args.requests, args.concurrency)
+                if not args.json:
+                    r = results[name]
+                    print(f"{name:<30}{r['rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p90_ms']:>10.1f}"
+                          f"{r['p99_ms']:>10.1f}{r['errors']:>8}")
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Endpoints whose p99 grew, or whose throughput fell, by more than `tolerance` (a fraction).
+    """
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["p99_ms"] > before["p99_ms"] * (1 + tolerance):
+            found.append(f"{name}: p99 {before['p99_ms']} -> {result['p99_ms']} ms")
+        if result["rps"] < before["rps"] * (1 - tolerance):
+            found.append(f"{name}: throughput {before['rps']} -> {result['rps']} req/s")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1000, help="seeded catalogue size (1k to 1M)")
+    parser.add_argument("--requests", type=int, default=500, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=5, help="simulated Firestore RTT in milliseconds")
+    parser.add_argument("--cache-ttl", type=float, default=0, help="CACHE_TTL_SECONDS for the run (0 measures Firestore paths)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="run scenarios whose name contains any of these")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against; exits 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    configure(args)
+    if not args.json:
+        print(f"{args.products} products, {args.requests} requests x {args.concurrency} clients per endpoint, "
+              f"simulated RTT {args.latency:g} ms")
+        print(f"{'endpoint':<30}{'req/s':>10}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    results = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == "__main__":
+    main()
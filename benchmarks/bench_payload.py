@@ -0,0 +1,103 @@
+"""
+Payload benchmark for product listing responses.
+
+For 1k and 10k products, reports encode time and bytes on the wire for:
+
+  stdlib      model_dump(mode="json") + json.dumps (the old jsonable_encoder path)
+  pydantic    TypeAdapter(List[Product]).dump_json (FastAPI's response_model path)
+  sparse      fields=productId,name,price,images[0],condition through FastJSONResponse
+
+each raw, gzip-compressed (as GZipMiddleware does) and brotli-compressed (as
+BrotliMiddleware does, when the brotli package is installed).
+
+Usage (from the repository root):
+
+    python benchmarks/bench_payload.py --products 1000 10000
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os
+import sys
+import time
+from typing import List
+
+from pydantic import TypeAdapter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend  # noqa: E402
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CARD_FIELDS = "productId,name,price,images[0],condition"
+
+
+def make_products(count):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [
+        backend.Product(
+            productId=f"product{i:06d}",
+            name=f"Used RTX 3080 #{i}",
+            category="GPUs",
+            subcategory="NVIDIA",
+            description="Lightly used graphics card, never overclocked, original box included. " * 8,
+            price=450.0 + i,
+            condition="Good",
+            images=[f"https://example.com/products/{i}/{n}.jpg" for n in range(4)],
+            sellerId="seller0001",
+            sellerName="Seller",
+            location={"city": "Dhaka", "country": "Bangladesh"},
+            specifications="10GB GDDR6X, 320-bit, PCIe 4.0, 3x DisplayPort 1.4a, 1x HDMI 2.1. " * 4,
+            yearsUsed=2,
+            postedAt=now - datetime.timedelta(minutes=i),
+            updatedAt=now,
+            views=i,
+        )
+        for i in range(count)
+    ]
+
+
+def timed(func, repeat):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    adapter = TypeAdapter(List[backend.Product])
+    spec = backend.parse_fields(CARD_FIELDS, backend.Product)
+    encoders = {
+        "stdlib": lambda products: json.dumps([p.model_dump(mode="json") for p in products]).encode(),
+        "pydantic": lambda products: adapter.dump_json(products),
+        "sparse": lambda products: backend.FastJSONResponse([backend.project(p, spec) for p in products]).body,
+    }
+
+    print(f"best of {args.repeat}; sizes in KiB, times in ms")
+    print(f"{'products':>8} {'encoder':<9}{'encode':>9}{'raw':>10}{'gzip':>9}{'gzip ms':>9}{'br':>9}{'br ms':>8}")
+    for count in args.products:
+        products = make_products(count)
+        for name, encode in encoders.items():
+            encode_time, body = timed(lambda: encode(products), args.repeat)
+            gzip_time, gzipped = timed(lambda: gzip.compress(body, compresslevel=9), args.repeat)
+            row = f"{count:>8} {name:<9}{encode_time * 1000:>9.1f}{len(body) / 1024:>10.1f}{len(gzipped) / 1024:>9.1f}{gzip_time * 1000:>9.1f}"
+            if brotli is not None:
+                br_time, compressed = timed(lambda: brotli.compress(body, quality=4), args.repeat)
+                row += f"{len(compressed) / 1024:>9.1f}{br_time * 1000:>8.1f}"
+            print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,8 @@ import { useState, useEffect } from "react";
 import { useParams } from "next/navigation";
 import Link from "next/link";
 import ProductCard from "@/components/ProductCard";
-import { Product, CATEGORIES } from "@/app/lib/types";
-import { getAllProducts } from "@/app/lib/api";
+import { Product, CATEGORIES, CONDITIONS } from "@/app/lib/types";
+import { getAllProducts, getProductFacets, productImageUrl, ProductFacets } from "@/app/lib/api";
 import { FiArrowLeft, FiSearch } from "react-icons/fi";
 
 // Map URL slugs to category names
@@ -32,6 +32,7 @@ export default function CategoryPage() {
   const [searchQuery, setSearchQuery] = useState("");
   const [selectedCondition, setSelectedCondition] = useState<string>("all");
   const [sortBy, setSortBy] = useState<string>("newest");
+  const [facets, setFacets] = useState<ProductFacets | null>(null);
 
   // Get category data
   const categoryData = CATEGORIES.find(
@@ -42,13 +43,14 @@ export default function CategoryPage() {
     const fetchProducts = async () => {
       try {
         setLoading(true);
-        const allProducts = await getAllProducts();
-        // Filter by category
-        const categoryProducts = allProducts.filter(
-          (p) => p.category.toLowerCase() === categoryName.toLowerCase()
-        );
+        // The server filters by category; facet counts come from its aggregate, not a full read
+        const [categoryProducts, categoryFacets] = await Promise.all([
+          getAllProducts({ category: categoryName }),
+          getProductFacets({ category: categoryName }),
+        ]);
         setProducts(categoryProducts);
         setFilteredProducts(categoryProducts);
+        setFacets(categoryFacets);
       } catch (err) {
         console.error("Error fetching products:", err);
         if (err instanceof TypeError && err.message.includes("fetch")) {
@@ -112,13 +114,13 @@ export default function CategoryPage() {
     setFilteredProducts(result);
   }, [products, searchQuery, selectedCondition, sortBy]);
 
+  // Known conditions first, then any others listings in this category use
   const conditions = [
     "all",
-    "Like New",
-    "Excellent",
-    "Good",
-    "Fair",
-    "For Parts",
+    ...CONDITIONS,
+    ...Object.keys(facets?.condition ?? {}).filter(
+      (cond) => !(CONDITIONS as readonly string[]).includes(cond)
+    ),
   ];
 
   if (loading) {
@@ -157,6 +159,7 @@ export default function CategoryPage() {
                   className="px-3 py-1 bg-[#007562]/20 text-[#7ADAA5] rounded-full text-sm"
                 >
                   {sub}
+                  {facets && ` (${facets.subcategory[sub] ?? 0})`}
                 </span>
               ))}
             </div>
@@ -185,6 +188,7 @@ export default function CategoryPage() {
           {conditions.slice(1).map((cond) => (
             <option key={cond} value={cond} className="bg-[#11211c]">
               {cond}
+              {facets && ` (${facets.condition[cond] ?? 0})`}
             </option>
           ))}
         </select>
@@ -257,7 +261,7 @@ export default function CategoryPage() {
                 name={product.name}
                 price={`${product.currency} ${product.price.toLocaleString()}`}
                 condition={product.condition}
-                imageUrl={product.images[0] || "/placeholder.png"}
+                imageUrl={productImageUrl(product)}
               />
             </Link>
           ))}
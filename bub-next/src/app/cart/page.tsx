@@ -8,6 +8,7 @@ import { FaShoppingCart, FaTrash, FaMinus, FaPlus } from "react-icons/fa";
 import { FiArrowLeft, FiArrowRight } from "react-icons/fi";
 import { useAuth } from "../lib/AuthContext";
 import { useCart } from "../lib/CartContext";
+import { checkout, getUserById, productImageUrl } from "../lib/api";
 
 export default function CartPage() {
   const { user, loading: authLoading } = useAuth();
@@ -30,15 +31,61 @@ export default function CartPage() {
   }, [user, authLoading, router]);
 
   const handleCheckout = async () => {
+    if (!user) return;
     setIsCheckingOut(true);
-    // In a real app, this would create orders for each item
-    // For now, we'll just simulate checkout
-    setTimeout(() => {
+    try {
+      const profile = await getUserById(user.uid);
+      const address = profile.address;
+      if (!address?.street || !address.zipCode) {
+        alert(
+          "Please add a full shipping address (street and ZIP code) to your profile before checking out."
+        );
+        router.push("/profile");
+        return;
+      }
+
+      // One request orders the whole cart; either every listing is reserved or none is
+      const result = await checkout({
+        items: cart.map((item) => ({ productId: item.product.productId })),
+        paymentMethod: "cash on delivery",
+        shippingAddress: {
+          street: address.street,
+          city: address.city,
+          zipCode: address.zipCode,
+          country: address.country,
+        },
+      });
+
+      if (result.committed) {
+        clearCart();
+        alert(
+          `Ordered ${result.items.length} ${
+            result.items.length === 1 ? "item" : "items"
+          }. The sellers will contact you to arrange payment and shipping.`
+        );
+        router.push("/profile");
+        return;
+      }
+
+      // Listings that are gone or already reserved leave the cart; the rest can be retried
+      const unavailable = result.items.filter((item) => item.status !== 424);
+      const names = unavailable.map(
+        (item) =>
+          cart.find((c) => c.product.productId === item.productId)?.product
+            .name ?? item.productId
+      );
+      unavailable.forEach((item) => removeFromCart(item.productId));
       alert(
-        "Checkout functionality would be implemented here with payment integration."
+        `Nothing was ordered. These items are no longer available and were removed from your cart:\n${names.join(
+          "\n"
+        )}`
       );
+    } catch (err) {
+      console.error("Checkout failed:", err);
+      alert(err instanceof Error ? err.message : "Checkout failed.");
+    } finally {
       setIsCheckingOut(false);
-    }, 1000);
+    }
   };
 
   if (authLoading) {
@@ -133,7 +180,7 @@ export default function CartPage() {
                   >
                     <div className="w-full sm:w-32 h-32 bg-[#1e293b] rounded-lg overflow-hidden">
                       <Image
-                        src={item.product.images[0] || "/placeholder.png"}
+                        src={productImageUrl(item.product, "thumb")}
                         alt={item.product.name}
                         width={128}
                         height={128}
@@ -8,6 +8,7 @@ import React, {
   ReactNode,
 } from "react";
 import { Product, CartItem, CartContextType } from "./types";
+import { getProductsByIds } from "./api";
 
 const CartContext = createContext<CartContextType | undefined>(undefined);
 
@@ -22,7 +23,19 @@ export function CartProvider({ children }: { children: ReactNode }) {
     try {
       const stored = localStorage.getItem(CART_STORAGE_KEY);
       if (stored) {
-        setCart(JSON.parse(stored));
+        const saved: CartItem[] = JSON.parse(stored);
+        setCart(saved);
+        // Refresh saved listings in one request; drop ones that no longer exist
+        getProductsByIds(saved.map((item) => item.product.productId))
+          .then(({ items }) => {
+            const fresh = new Map(items.map((p) => [p.productId, p]));
+            setCart(
+              saved
+                .filter((item) => fresh.has(item.product.productId))
+                .map((item) => ({ ...item, product: fresh.get(item.product.productId)! }))
+            );
+          })
+          .catch((error) => console.error("Error refreshing cart:", error));
       }
     } catch (error) {
       console.error("Error loading cart from localStorage:", error);
@@ -8,6 +8,7 @@ import React, {
   ReactNode,
 } from "react";
 import { Product, WishlistContextType } from "./types";
+import { getProductsByIds } from "./api";
 
 const WishlistContext = createContext<WishlistContextType | undefined>(
   undefined
@@ -24,7 +25,12 @@ export function WishlistProvider({ children }: { children: ReactNode }) {
     try {
       const stored = localStorage.getItem(WISHLIST_STORAGE_KEY);
       if (stored) {
-        setWishlist(JSON.parse(stored));
+        const saved: Product[] = JSON.parse(stored);
+        setWishlist(saved);
+        // Refresh saved listings in one request; drop ones that no longer exist
+        getProductsByIds(saved.map((p) => p.productId))
+          .then(({ items }) => setWishlist(items))
+          .catch((error) => console.error("Error refreshing wishlist:", error));
       }
     } catch (error) {
       console.error("Error loading wishlist from localStorage:", error);
@@ -7,6 +7,7 @@ import {
   UserCreate,
   Order,
   Review,
+  ShippingAddress,
 } from "./types";
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || "http://localhost:8000";
@@ -47,35 +48,138 @@ async function handleResponse<T>(response: Response): Promise<T> {
 
 // ============ PRODUCT API ============
 
-export async function getAllProducts(): Promise<Product[]> {
-  const response = await fetch(`${API_BASE_URL}/products`);
-  return handleResponse<Product[]>(response);
+// Resized variant of a product's first image, falling back to the original until the
+// backend has rendered it. Variant URLs are relative to the API.
+export function productImageUrl(
+  product: Pick<Product, "images" | "thumbnails">,
+  variant: "thumb" | "card" = "card"
+): string {
+  const thumbnail = product.thumbnails?.[0];
+  if (thumbnail && thumbnail.source === product.images[0]) {
+    const url = thumbnail[variant];
+    return url.startsWith("/") ? `${API_BASE_URL}${url}` : url;
+  }
+  return product.images[0] || "/placeholder.png";
 }
 
+
 export async function getProductById(productId: string): Promise<Product> {
   const response = await fetch(`${API_BASE_URL}/products/${productId}`);
   return handleResponse<Product>(response);
 }
 
+export interface ProductBatch {
+  items: Product[];
+  missing: string[];
+}
+
+// Fetch several products by ID in one request (e.g. to refresh the wishlist or cart)
+export async function getProductsByIds(productIds: string[]): Promise<ProductBatch> {
+  if (productIds.length === 0) return { items: [], missing: [] };
+  const response = await fetch(`${API_BASE_URL}/products:batchGet`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify({ ids: productIds }),
+  });
+  return handleResponse<ProductBatch>(response);
+}
+
+export interface ProductQuery {
+  category?: string;
+  subcategory?: string;
+  condition?: string;
+  status?: string;
+  minPrice?: number;
+  maxPrice?: number;
+  sort?: "newest" | "oldest" | "price-low" | "price-high";
+  limit?: number;
+  startAfter?: string;
+  // Sparse fieldset, e.g. "productId,name,price,images[0],condition" for card views
+  fields?: string;
+}
+
+export interface ProductPage {
+  products: Product[];
+  nextCursor: string | null;
+}
+
+export type ProductFilter = Pick<
+  ProductQuery,
+  "category" | "subcategory" | "condition" | "status" | "minPrice" | "maxPrice"
+>;
+
+function filterParams(query: ProductFilter): URLSearchParams {
+  const params = new URLSearchParams();
+  if (query.category) params.set("category", query.category);
+  if (query.subcategory) params.set("subcategory", query.subcategory);
+  if (query.condition) params.set("condition", query.condition);
+  if (query.status) params.set("status", query.status);
+  if (query.minPrice !== undefined) params.set("min_price", String(query.minPrice));
+  if (query.maxPrice !== undefined) params.set("max_price", String(query.maxPrice));
+  return params;
+}
+
+// Fetch one page of products; filtering and sorting happen on the server
+export async function getProducts(query: ProductQuery = {}): Promise<ProductPage> {
+  const params = filterParams(query);
+  if (query.sort) params.set("sort", query.sort);
+  if (query.limit) params.set("limit", String(query.limit));
+  if (query.startAfter) params.set("start_after", query.startAfter);
+  if (query.fields) params.set("fields", query.fields);
+
+  const response = await fetch(`${API_BASE_URL}/products?${params.toString()}`);
+  const products = await handleResponse<Product[]>(response);
+  return { products, nextCursor: response.headers.get("X-Next-Cursor") };
+}
+
+// Fetch every product matching the filter, following X-Next-Cursor page by page
+export async function getAllProducts(filter: ProductFilter = {}): Promise<Product[]> {
+  const products: Product[] = [];
+  let startAfter: string | undefined;
+  do {
+    const page = await getProducts({ ...filter, limit: 100, startAfter });
+    products.push(...page.products);
+    startAfter = page.nextCursor ?? undefined;
+  } while (startAfter);
+  return products;
+}
+
+export interface PriceBucket {
+  min: number;
+  max: number | null; // exclusive; null for the top bucket
+  count: number;
+}
+
+export interface ProductFacets {
+  total: number;
+  category: Record<string, number>;
+  subcategory: Record<string, number>;
+  condition: Record<string, number>;
+  status: Record<string, number>;
+  price: PriceBucket[];
+}
+
+// Product counts per category, subcategory, condition, status and price range.
+// Each facet ignores its own filter, so it lists the alternatives to the current choice.
+export async function getProductFacets(filter: ProductFilter = {}): Promise<ProductFacets> {
+  const params = filterParams(filter);
+  const response = await fetch(`${API_BASE_URL}/products/facets?${params.toString()}`);
+  return handleResponse<ProductFacets>(response);
+}
+
 export async function getProductsByCategory(
   category: string
 ): Promise<Product[]> {
-  const products = await getAllProducts();
-  return products.filter(
-    (p) => p.category.toLowerCase() === category.toLowerCase()
-  );
+  return getAllProducts({ category });
 }
 
-export async function searchProducts(query: string): Promise<Product[]> {
-  const products = await getAllProducts();
-  const lowercaseQuery = query.toLowerCase();
-  return products.filter(
-    (p) =>
-      p.name.toLowerCase().includes(lowercaseQuery) ||
-      p.description.toLowerCase().includes(lowercaseQuery) ||
-      p.category.toLowerCase().includes(lowercaseQuery) ||
-      p.subcategory.toLowerCase().includes(lowercaseQuery)
-  );
+export async function searchProducts(
+  query: string,
+  limit: number = 20
+): Promise<Product[]> {
+  const params = new URLSearchParams({ q: query, limit: String(limit) });
+  const response = await fetch(`${API_BASE_URL}/products/search?${params.toString()}`);
+  return handleResponse<Product[]>(response);
 }
 
 export async function createProduct(product: ProductCreate): Promise<Product> {
@@ -150,12 +254,21 @@ export async function updateUser(
 
 // ============ ORDER API ============
 
+// Fetch all of the user's orders (as buyer and seller), following X-Next-Cursor page by page
 export async function getOrders(): Promise<Order[]> {
   const headers = await getAuthHeaders();
-  const response = await fetch(`${API_BASE_URL}/orders`, {
-    headers,
-  });
-  return handleResponse<Order[]>(response);
+  const orders: Order[] = [];
+  let startAfter: string | null = null;
+  do {
+    const params = new URLSearchParams({ limit: "100" });
+    if (startAfter) params.set("start_after", startAfter);
+    const response = await fetch(`${API_BASE_URL}/orders?${params.toString()}`, {
+      headers,
+    });
+    orders.push(...(await handleResponse<Order[]>(response)));
+    startAfter = response.headers.get("X-Next-Cursor");
+  } while (startAfter);
+  return orders;
 }
 
 export async function getOrderById(orderId: string): Promise<Order> {
@@ -178,6 +291,42 @@ export async function createOrder(
   return handleResponse<Order>(response);
 }
 
+export interface CheckoutRequest {
+  items: { productId: string; buyerNotes?: string }[];
+  paymentMethod: string;
+  shippingAddress: ShippingAddress;
+}
+
+export interface CheckoutItemResult {
+  productId: string;
+  // 201 ordered, 403 own listing, 404 gone, 409 no longer available, 424 skipped because another item failed
+  status: number;
+  error?: string | null;
+  order?: Order | null;
+}
+
+export interface CheckoutResult {
+  committed: boolean;
+  attempts: number;
+  items: CheckoutItemResult[];
+}
+
+// Order every cart item in one transaction: all items are ordered or none are.
+// A 409 still carries per-item results explaining which listings were unavailable.
+export async function checkout(request: CheckoutRequest): Promise<CheckoutResult> {
+  const headers = await getAuthHeaders();
+  const response = await fetch(`${API_BASE_URL}/checkout`, {
+    method: "POST",
+    headers,
+    body: JSON.stringify(request),
+  });
+  if (response.status === 409) {
+    const body = await response.clone().json().catch(() => ({}));
+    if (Array.isArray(body.items)) return body as CheckoutResult;
+  }
+  return handleResponse<CheckoutResult>(response);
+}
+
 export async function updateOrder(
   orderId: string,
   order: Partial<Order>
@@ -203,16 +352,42 @@ export async function getReviewById(reviewId: string): Promise<Review> {
   return handleResponse<Review>(response);
 }
 
-export async function getReviewsForSeller(sellerId: string): Promise<Review[]> {
-  const reviews = await getAllReviews();
-  return reviews.filter((r) => r.sellerId === sellerId);
+export interface ReviewQuery {
+  sort?: "newest" | "helpful";
+  limit?: number;
+  startAfter?: string;
+}
+
+export interface ReviewPage {
+  reviews: Review[];
+  nextCursor: string | null;
 }
 
+async function getReviewPage(path: string, query: ReviewQuery): Promise<ReviewPage> {
+  const params = new URLSearchParams();
+  if (query.sort) params.set("sort", query.sort);
+  if (query.limit) params.set("limit", String(query.limit));
+  if (query.startAfter) params.set("start_after", query.startAfter);
+
+  const response = await fetch(`${API_BASE_URL}${path}?${params.toString()}`);
+  const reviews = await handleResponse<Review[]>(response);
+  return { reviews, nextCursor: response.headers.get("X-Next-Cursor") };
+}
+
+// One page of approved reviews left for a seller; filtering happens on the server
+export async function getReviewsForSeller(
+  sellerId: string,
+  query: ReviewQuery = {}
+): Promise<ReviewPage> {
+  return getReviewPage(`/users/${sellerId}/reviews`, query);
+}
+
+// One page of approved reviews for a listing
 export async function getReviewsForProduct(
-  productId: string
-): Promise<Review[]> {
-  const reviews = await getAllReviews();
-  return reviews.filter((r) => r.productId === productId);
+  productId: string,
+  query: ReviewQuery = {}
+): Promise<ReviewPage> {
+  return getReviewPage(`/products/${productId}/reviews`, query);
 }
 
 export async function createReview(
@@ -5,6 +5,13 @@ export interface Location {
   country: string;
 }
 
+// Resized copies of one product image; swap .webp for .jpg to get a JPEG
+export interface ImageVariants {
+  source: string;
+  thumb: string;
+  card: string;
+}
+
 export interface Product {
   productId: string;
   name: string;
@@ -26,6 +33,8 @@ export interface Product {
   postedAt: string;
   updatedAt: string;
   views: number;
+  // Filled in by the backend shortly after a write; may be empty or lag behind images
+  thumbnails?: ImageVariants[];
 }
 
 export interface ProductCreate {
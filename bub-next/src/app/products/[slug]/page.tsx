@@ -58,7 +58,7 @@ export default function ProductDetailPage() {
 
         // Also fetch reviews for this product
         try {
-          const productReviews = await getReviewsForProduct(productId);
+          const { reviews: productReviews } = await getReviewsForProduct(productId);
           setReviews(productReviews);
         } catch (err) {
           console.error("Error fetching reviews:", err);
@@ -5,7 +5,7 @@ import { useSearchParams } from "next/navigation";
 import ProductCard from "@/components/ProductCard";
 import Link from "next/link";
 import { Product } from "@/app/lib/types";
-import { getAllProducts } from "@/app/lib/api";
+import { getAllProducts, productImageUrl } from "@/app/lib/api";
 import { FiSearch } from "react-icons/fi";
 
 export default function ProductsPage() {
@@ -247,7 +247,7 @@ export default function ProductsPage() {
                 name={product.name}
                 price={`${product.currency} ${product.price.toLocaleString()}`}
                 condition={product.condition}
-                imageUrl={product.images[0] || "/placeholder.png"}
+                imageUrl={productImageUrl(product)}
               />
             </Link>
           ))}
@@ -9,6 +9,7 @@ import { FiArrowLeft } from "react-icons/fi";
 import { useAuth } from "../lib/AuthContext";
 import { useWishlist } from "../lib/WishlistContext";
 import { useCart } from "../lib/CartContext";
+import { productImageUrl } from "../lib/api";
 
 export default function WishlistPage() {
   const { user, loading: authLoading } = useAuth();
@@ -128,7 +129,7 @@ export default function WishlistPage() {
                 >
                   <div className="w-full sm:w-32 h-32 bg-[#1e293b] rounded-lg overflow-hidden">
                     <Image
-                      src={product.images[0] || "/placeholder.png"}
+                      src={productImageUrl(product, "thumb")}
                       alt={product.name}
                       width={128}
                       height={128}
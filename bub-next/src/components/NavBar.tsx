@@ -13,7 +13,7 @@ import { useRouter } from "next/navigation";
 import { useAuth } from "@/app/lib/AuthContext";
 import { useWishlist } from "@/app/lib/WishlistContext";
 import { useCart } from "@/app/lib/CartContext";
-import { searchProducts } from "@/app/lib/api";
+import { productImageUrl, searchProducts } from "@/app/lib/api";
 import { Product } from "@/app/lib/types";
 
 export default function NavBar() {
@@ -116,7 +116,7 @@ export default function NavBar() {
                         className="w-full px-4 py-3 flex items-center gap-3 hover:bg-[#007562]/20 transition-colors text-left"
                       >
                         <img
-                          src={product.images[0] || "/placeholder.png"}
+                          src={productImageUrl(product, "thumb")}
                           alt={product.name}
                           className="w-10 h-10 object-cover rounded"
                         />
@@ -2,7 +2,7 @@
 
 "use client";
 
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 import Link from "next/link";
 import { usePathname } from "next/navigation";
 
@@ -19,6 +19,7 @@ import { MdOutlinePower } from "react-icons/md";
 import { FaFan } from "react-icons/fa";
 import { HiMenu } from "react-icons/hi";
 import { HiX } from "react-icons/hi";
+import { getProductFacets } from "@/app/lib/api";
 
 const navLinks = [
   { name: "CPUs", icon: IoHardwareChipOutline, href: "/cpus" },
@@ -34,6 +35,14 @@ const navLinks = [
 export default function Sidebar() {
   const pathname = usePathname();
   const [isMobileMenuOpen, setIsMobileMenuOpen] = useState(false);
+  const [categoryCounts, setCategoryCounts] = useState<Record<string, number>>({});
+
+  // Listing counts per category come from the facets endpoint, not a product fetch
+  useEffect(() => {
+    getProductFacets()
+      .then((facets) => setCategoryCounts(facets.category))
+      .catch((err) => console.error("Error fetching category counts:", err));
+  }, []);
 
   const toggleMobileMenu = () => {
     setIsMobileMenuOpen(!isMobileMenuOpen);
@@ -113,6 +122,11 @@ export default function Sidebar() {
                 >
                   <link.icon className="text-xl" />
                   <span className="font-medium">{link.name}</span>
+                  {categoryCounts[link.name] !== undefined && (
+                    <span className="ml-auto text-xs text-gray-400">
+                      {categoryCounts[link.name]}
+                    </span>
+                  )}
                 </Link>
               </li>
             ))}
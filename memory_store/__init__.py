@@ -0,0 +1,4 @@
+"""
+In-memory stand-ins for Firestore and Firebase Auth, used by backend.py when
+STORAGE_BACKEND=memory and by the load scripts in benchmarks/. Never use them in production.
+"""
@@ -0,0 +1,233 @@
+"""
+Deterministic generator of realistic marketplace data for the in-memory Firestore.
+
+Produces users (sellers and buyers), products, orders and reviews shaped like the
+documents backend.py writes, with seller rating aggregates consistent with the
+reviews. Scales from 1k to 1M products; everything is a generator so exporting a
+large data set does not hold it in memory.
+
+Usage (from the repository root), exporting NDJSON to size a deployment:
+
+    python -m memory_store.datagen --products 1000000 --out marketplace.ndjson
+"""
+import argparse
+import datetime
+import json
+import random
+
+CATEGORIES = {
+    "CPUs": ["Intel", "AMD", "ARM"],
+    "GPUs": ["NVIDIA", "AMD", "Intel"],
+    "Motherboards": ["ATX", "Micro-ATX", "Mini-ITX"],
+    "RAM": ["DDR4", "DDR5"],
+    "Storage": ["SSD", "HDD", "NVMe"],
+    "Power Supplies": ["Modular", "Semi-Modular", "Non-Modular"],
+    "Cases": ["Full Tower", "Mid Tower", "Mini Tower"],
+    "Cooling": ["Air Cooler", "AIO", "Custom Loop"],
+}
+CONDITIONS = ["Like New", "Excellent", "Good", "Fair", "For Parts"]
+CITIES = ["Dhaka", "Chittagong", "Sylhet", "Khulna", "Rajshahi"]
+WORDS = ("used tested working boxed warranty fast quiet overclocked stock cooler fan rgb "
+         "gaming workstation budget premium clean upgrade original receipt spare").split()
+
+
+class Scale:
+    """
+    Document counts derived from the product count: one seller per 20 listings,
+    five buyers per seller, an order for every other listing and a review for half the orders.
+    """
+
+    def __init__(self, products: int):
+        self.products = products
+        self.sellers = max(5, products // 20)
+        self.buyers = self.sellers * 5
+        self.orders = products // 2
+        self.reviews = self.orders // 2
+
+
+def seller_id(i):
+    return f"seller{i:07d}"
+
+
+def buyer_id(i):
+    return f"buyer{i:08d}"
+
+
+def product_id(i):
+    return f"product{i:08d}"
+
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def generate_products(scale: Scale, seed: int = 1, now=None):
+    rng = random.Random(seed)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    for i in range(scale.products):
+        category = rng.choice(list(CATEGORIES))
+        subcategory = rng.choice(CATEGORIES[category])
+        seller = rng.randrange(scale.sellers)
+        posted = now - datetime.timedelta(minutes=rng.randrange(60 * 24 * 365))
+        yield product_id(i), {
+            "name": f"{subcategory} {category[:-1] if category.endswith('s') else category} {rng.randrange(100, 9999)}",
+            "category": category,
+            "subcategory": subcategory,
+            "description": " ".join(_sentence(rng, rng.randint(6, 14)) for _ in range(rng.randint(2, 6))),
+            "price": round(rng.lognormvariate(9, 0.8), 2),
+            "currency": "BDT",
+            "condition": rng.choice(CONDITIONS),
+            "images": [f"https://images.example.com/{product_id(i)}/{n}.jpg" for n in range(rng.randint(1, 5))],
+            "sellerId": seller_id(seller),
+            "sellerName": f"Seller {seller}",
+            "location": {"city": rng.choice(CITIES), "country": "Bangladesh"},
+            "status": "sold" if rng.random() < 0.2 else "available",
+            "specifications": _sentence(rng, rng.randint(4, 20)),
+            "yearsUsed": rng.randint(0, 8),
+            "negotiable": rng.random() < 0.5,
+            "shippingOptions": ["local pickup"] + (["courier"] if rng.random() < 0.6 else []),
+            "postedAt": posted,
+            "updatedAt": posted + datetime.timedelta(minutes=rng.randrange(60 * 24)),
+            "views": 0,
+        }
+
+
+def _product_facts(scale: Scale, seed: int):
+    """
+    (product ID, seller ID, seller name, name, price) per product, without holding them all.
+    """
+    for doc_id, data in generate_products(scale, seed):
+        yield doc_id, data["sellerId"], data["sellerName"], data["name"], data["price"]
+
+
+def generate_orders(scale: Scale, seed: int = 1, now=None):
+    rng = random.Random(seed + 1)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    facts = _product_facts(scale, seed)
+    for i in range(scale.orders):
+        # Orders cover every other product, so product i*2 is the one bought
+        doc_id, seller, _, name, price = next(facts)
+        next(facts, None)
+        ordered = now - datetime.timedelta(minutes=rng.randrange(60 * 24 * 180))
+        status = rng.choice(["pending_payment", "processing", "shipped", "delivered", "delivered", "cancelled"])
+        order = {
+            "productId": doc_id,
+            "buyerId": buyer_id(rng.randrange(scale.buyers)),
+            "sellerId": seller,
+            "productName": name,
+            "productPrice": price,
+            "quantity": 1,
+            "totalAmount": price,
+            "currency": "BDT",
+            "orderStatus": status,
+            "paymentMethod": rng.choice(["bkash", "card", "cash on delivery"]),
+            "paymentStatus": "unpaid" if status == "pending_payment" else "paid",
+            "shippingAddress": {"street": f"{rng.randint(1, 200)} Road {rng.randint(1, 40)}", "city": rng.choice(CITIES),
+                                "zipCode": str(rng.randint(1000, 9999)), "country": "Bangladesh"},
+            "orderedAt": ordered,
+        }
+        if status in ("shipped", "delivered"):
+            order["shippedAt"] = ordered + datetime.timedelta(days=1)
+        if status == "delivered":
+            order["deliveredAt"] = ordered + datetime.timedelta(days=3)
+        yield f"order{i:08d}", order
+
+
+def generate_reviews(scale: Scale, seed: int = 1, now=None):
+    rng = random.Random(seed + 2)
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    orders = generate_orders(scale, seed, now)
+    for i in range(scale.reviews):
+        # Every other order gets a review
+        order_id, order = next(orders)
+        next(orders, None)
+        yield f"review{i:08d}", {
+            "productId": order["productId"],
+            "sellerId": order["sellerId"],
+            "reviewerId": order["buyerId"],
+            "orderId": order_id,
+            "rating": rng.choices([1, 2, 3, 4, 5], weights=[1, 1, 3, 8, 12])[0],
+            "comment": _sentence(rng, rng.randint(5, 30)),
+            "productName": order["productName"],
+            "sellerName": "Seller " + str(int(order["sellerId"][6:])),
+            "reviewerName": "Buyer " + str(int(order["buyerId"][5:])),
+            "isApproved": rng.random() < 0.95,
+            "helpfulVotes": int(rng.expovariate(0.3)),
+            "reviewedAt": order["orderedAt"] + datetime.timedelta(days=5),
+        }
+
+
+def generate_users(scale: Scale, seed: int = 1, now=None):
+    """
+    Sellers then buyers. Seller rating aggregates are summed from generate_reviews(),
+    so they match what the review endpoints would have maintained.
+    """
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    totals = {}
+    for _, review in generate_reviews(scale, seed, now):
+        entry = totals.setdefault(review["sellerId"], [0, 0])
+        entry[0] += review["rating"]
+        entry[1] += 1
+    for i in range(scale.sellers + scale.buyers):
+        is_seller = i < scale.sellers
+        doc_id = seller_id(i) if is_seller else buyer_id(i - scale.sellers)
+        rating_sum, total = totals.get(doc_id, (0, 0))
+        yield doc_id, {
+            "email": f"{doc_id}@example.com",
+            "displayName": f"Seller {i}" if is_seller else f"Buyer {i - scale.sellers}",
+            "roles": ["buyer", "seller"] if is_seller else ["buyer"],
+            "address": {"city": CITIES[i % len(CITIES)], "country": "Bangladesh"},
+            "ratingSum": rating_sum,
+            "totalReviews": total,
+            "rating": round(rating_sum / total, 2) if total else 0.0,
+            "isVerifiedSeller": is_seller and i % 3 == 0,
+            "createdAt": now - datetime.timedelta(days=400),
+            "lastLoginAt": now,
+        }
+
+
+def generate(scale: Scale, seed: int = 1):
+    """
+    Yields (collection, document ID, data) for the whole data set.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for collection, documents in (
+        ("users", generate_users(scale, seed, now)),
+        ("products", generate_products(scale, seed, now)),
+        ("orders", generate_orders(scale, seed, now)),
+        ("reviews", generate_reviews(scale, seed, now)),
+    ):
+        for doc_id, data in documents:
+            yield collection, doc_id, data
+
+
+def seed(client, products: int, seed: int = 1) -> Scale:
+    """
+    Loads a generated data set straight into a FakeFirestore, bypassing simulated latency.
+    """
+    scale = Scale(products)
+    for collection, doc_id, data in generate(scale, seed):
+        client._collections.setdefault(collection, {})[doc_id] = data
+        client._update_times[f"{collection}/{doc_id}"] = client._write_time()
+    return scale
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", required=True, help="NDJSON file, one {collection, id, data} per line")
+    args = parser.parse_args()
+
+    scale = Scale(args.products)
+    written = 0
+    with open(args.out, "w") as out:
+        for collection, doc_id, data in generate(scale, args.seed):
+            out.write(json.dumps({"collection": collection, "id": doc_id, "data": data}, default=str) + "\n")
+            written += 1
+    print(f"{written} documents: {scale.sellers + scale.buyers} users, {scale.products} products, "
+          f"{scale.orders} orders, {scale.reviews} reviews -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
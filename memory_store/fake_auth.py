@@ -0,0 +1,29 @@
+"""
+Stand-in for firebase_admin.auth.verify_id_token and delete_user used with STORAGE_BACKEND=memory.
+
+Any token of the form "test:<uid>" is accepted and decodes to {"uid": <uid>, ...}
+with an exp one hour out; anything else is rejected like an invalid Firebase token.
+Deleted accounts are only recorded: like Firebase without check_revoked, their tokens
+keep verifying until they expire.
+"""
+import time
+
+from firebase_admin import auth
+
+deleted_users = set()
+
+
+def token_for(uid: str) -> str:
+    return f"test:{uid}"
+
+
+def verify_id_token(token: str) -> dict:
+    prefix, _, uid = token.partition(":")
+    if prefix != "test" or not uid:
+        raise auth.InvalidIdTokenError("Not a test token")
+    now = int(time.time())
+    return {"uid": uid, "user_id": uid, "iat": now, "exp": now + 3600, "email": f"{uid}@example.com"}
+
+
+def delete_user(uid: str):
+    deleted_users.add(uid)
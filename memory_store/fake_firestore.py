@@ -0,0 +1,414 @@
+"""
+In-memory stand-in for the subset of the Firestore AsyncClient used by backend.py.
+
+Every network call sleeps for `latency` seconds to emulate a Firestore round trip.
+With `blocking=True` the sleep is a time.sleep(), which reproduces what the old
+synchronous client did to the event loop when called inside `async def` handlers.
+"""
+import asyncio
+import copy
+import datetime
+import heapq
+import time
+import uuid
+
+from google.api_core.exceptions import Aborted, AlreadyExists, FailedPrecondition
+from google.cloud.firestore import DELETE_FIELD, Increment
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = copy.deepcopy(data) if data is not None else None
+        self.exists = data is not None
+        # Time of the last write, like Firestore's; write_option(last_update_time=...) is checked against it
+        self.update_time = reference._client._update_times.get(reference._path) if self.exists else None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in field.split("."):
+            value = value[part]
+        return value
+
+
+class FakeDocumentReference:
+    def __init__(self, client, collection_name, doc_id):
+        self._client = client
+        self._collection = collection_name
+        self.id = doc_id
+
+    @property
+    def _store(self):
+        return self._client._collections.setdefault(self._collection, {})
+
+    @property
+    def _path(self):
+        return f"{self._collection}/{self.id}"
+
+    def _touch(self):
+        """
+        Bumps the document's version, which is what transactions validate their reads against,
+        and records its update time, which write preconditions are checked against.
+        """
+        self._client._versions[self._path] = self._client._versions.get(self._path, 0) + 1
+        if self.id in self._store:
+            self._client._update_times[self._path] = self._client._write_time()
+        else:
+            self._client._update_times.pop(self._path, None)
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, f"{self._collection}/{self.id}/{name}")
+
+    async def get(self, transaction=None):
+        await self._client._round_trip()
+        if transaction is not None:
+            transaction._record_read(self)
+        return FakeDocumentSnapshot(self, self._store.get(self.id))
+
+    async def set(self, data):
+        await self._client._round_trip()
+        self._store[self.id] = copy.deepcopy(data)
+        self._touch()
+
+    async def create(self, data):
+        await self._client._round_trip()
+        if self.id in self._store:
+            raise AlreadyExists(f"Document already exists: {self._collection}/{self.id}")
+        self._store[self.id] = copy.deepcopy(data)
+        self._touch()
+
+    async def update(self, data):
+        await self._client._round_trip()
+        self._apply_update(data)
+
+    def _apply_update(self, data):
+        if self.id not in self._store:
+            raise KeyError(f"No document to update: {self._collection}/{self.id}")
+        stored = self._store[self.id]
+        for field, value in data.items():
+            if value is DELETE_FIELD:
+                stored.pop(field, None)
+            elif isinstance(value, Increment):
+                stored[field] = stored.get(field, 0) + value.value
+            else:
+                stored[field] = copy.deepcopy(value)
+        self._touch()
+
+    async def delete(self):
+        await self._client._round_trip()
+        self._store.pop(self.id, None)
+        self._touch()
+
+
+_OPERATORS = {
+    "==": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<": lambda a, b: a is not None and a < b,
+    "<=": lambda a, b: a is not None and a <= b,
+    ">": lambda a, b: a is not None and a > b,
+    ">=": lambda a, b: a is not None and a >= b,
+    "in": lambda a, b: a in b,
+    "array_contains": lambda a, b: b in (a or []),
+}
+
+
+class _FieldCondition:
+    def __init__(self, field_path, op_string, value):
+        self.field_path = field_path
+        self.op_string = op_string
+        self.value = value
+
+
+def _evaluate(condition, data):
+    """
+    Evaluates a FieldFilter-like (field_path/op_string/value) or And/Or-like (operator/filters) condition.
+    """
+    nested = getattr(condition, "filters", None)
+    if nested is not None:
+        results = (_evaluate(child, data) for child in nested)
+        return any(results) if getattr(condition.operator, "name", "AND") == "OR" else all(results)
+    return _OPERATORS[condition.op_string](data.get(condition.field_path), condition.value)
+
+
+class FakeQuery:
+    def __init__(self, client, collection_name, filters=(), orders=(), cursor=None, limit_to=None):
+        self._client = client
+        self._collection = collection_name
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._cursor = cursor
+        self._limit = limit_to
+
+    def _copy(self, **changes):
+        fields = dict(filters=self._filters, orders=self._orders, cursor=self._cursor, limit_to=self._limit)
+        fields.update(changes)
+        return FakeQuery(self._client, self._collection, **fields)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        """
+        Accepts both the positional form and `filter=` with FieldFilter / And / Or objects.
+        """
+        if filter is None:
+            filter = _FieldCondition(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def start_after(self, values):
+        return self._copy(cursor=values)
+
+    def limit(self, count):
+        return self._copy(limit_to=count)
+
+    def select(self, field_paths):
+        return self
+
+    def _matches(self, doc_id, data):
+        return all(_evaluate(condition, data) for condition in self._filters)
+
+    def _sort_key(self, doc_id, data, field):
+        return doc_id if field == "__name__" else data.get(field)
+
+    def _after_cursor(self, doc_id, data, cursor):
+        for (field, direction), bound in zip(self._orders, cursor):
+            value = self._sort_key(doc_id, data, field)
+            if value != bound:
+                return value > bound if direction == "ASCENDING" else value < bound
+        return False
+
+    def _results(self):
+        """
+        Filters (and applies the cursor) before ordering, and selects a limited page
+        with a heap instead of sorting the whole collection, so large seeded data
+        sets stay cheap to page through.
+        """
+        store = self._client._collections.get(self._collection, {})
+        cursor = None if self._cursor is None else [self._cursor[field] for field, _ in self._orders]
+        # list() copies the items atomically, so a FakeBulkWriter applying writes on another thread can't break the scan
+        rows = [
+            (doc_id, data) for doc_id, data in list(store.items())
+            if self._matches(doc_id, data) and (cursor is None or self._after_cursor(doc_id, data, cursor))
+        ]
+        directions = {direction for _, direction in self._orders}
+        if self._limit is not None and len(directions) == 1:
+            fields = [field for field, _ in self._orders]
+            select = heapq.nlargest if directions == {"DESCENDING"} else heapq.nsmallest
+            return select(self._limit, rows, key=lambda row: [self._sort_key(row[0], row[1], f) for f in fields])
+        for field, direction in reversed(self._orders):
+            rows.sort(key=lambda row: self._sort_key(row[0], row[1], field), reverse=direction == "DESCENDING")
+        if self._limit is not None:
+            rows = rows[: self._limit]
+        return rows
+
+    async def stream(self):
+        await self._client._round_trip()
+        for doc_id, data in self._results():
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._client, self._collection, doc_id), data)
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, name):
+        super().__init__(client, name)
+        self.id = name
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self._client, self._collection, doc_id or uuid.uuid4().hex[:20])
+
+    async def add(self, data):
+        doc_ref = self.document()
+        await doc_ref.set(data)
+        return self._client._update_times[doc_ref._path], doc_ref
+
+
+class FakeWriteBatch:
+    """
+    Buffers create/update/delete and applies them on commit in one round trip.
+    A write_option(last_update_time=...) precondition that no longer matches the document
+    fails the whole commit with FailedPrecondition, before anything is applied.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def create(self, doc_ref, data):
+        self._writes.append(("create", doc_ref, data, None))
+
+    def set(self, doc_ref, data, merge=False):
+        self._writes.append(("merge" if merge else "create", doc_ref, data, None))
+
+    def update(self, doc_ref, data, option=None):
+        self._writes.append(("update", doc_ref, data, option))
+
+    def delete(self, doc_ref, option=None):
+        self._writes.append(("delete", doc_ref, None, option))
+
+    async def commit(self):
+        await self._client._round_trip()
+        self._apply()
+        return []
+
+    def _apply(self):
+        update_times = self._client._update_times
+        for _, doc_ref, _, option in self._writes:
+            if option and "last_update_time" in option and update_times.get(doc_ref._path) != option["last_update_time"]:
+                raise FailedPrecondition(f"Document was updated since {option['last_update_time']}: {doc_ref._path}")
+        for kind, doc_ref, data, _ in self._writes:
+            if kind == "create":
+                doc_ref._store[doc_ref.id] = copy.deepcopy(data)
+                doc_ref._touch()
+            elif kind == "merge":
+                doc_ref._store.setdefault(doc_ref.id, {})
+                doc_ref._apply_update(data)
+            elif kind == "update":
+                doc_ref._apply_update(data)
+            else:
+                doc_ref._store.pop(doc_ref.id, None)
+                doc_ref._touch()
+
+
+class FakeTransaction(FakeWriteBatch):
+    """
+    Enough of AsyncTransaction for @async_transactional: writes are buffered like a
+    batch and applied on commit. Concurrency control is optimistic: the commit raises
+    Aborted (which @async_transactional retries) if any document read in the
+    transaction has been written since, so racing transactions behave like Firestore's.
+    """
+
+    _read_only = False
+
+    def __init__(self, client, max_attempts=5):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._id = None
+        self._reads = {}
+
+    def _clean_up(self):
+        self._writes = []
+        self._reads = {}
+        self._id = None
+
+    def _record_read(self, doc_ref):
+        self._reads.setdefault(doc_ref._path, self._client._versions.get(doc_ref._path, 0))
+
+    async def _begin(self, retry_id=None):
+        self._id = uuid.uuid4().bytes
+
+    async def _commit(self):
+        await self._client._round_trip()
+        versions = self._client._versions
+        stale = [path for path, version in self._reads.items() if versions.get(path, 0) != version]
+        if stale:
+            raise Aborted(f"Transaction contention on {', '.join(stale)}")
+        self._apply()
+        self._clean_up()
+        return []
+
+    async def _rollback(self):
+        self._clean_up()
+
+
+class FakeBulkWriter:
+    """
+    Synchronous like the real BulkWriter, which the backend drives from a worker thread.
+    Writes are applied in batches of 20, throttled to `max_ops_per_second`; they never fail,
+    so the on_write_error callback is accepted and never called.
+    """
+
+    batch_size = 20
+
+    def __init__(self, client, options=None):
+        self._client = client
+        self._max_ops_per_second = getattr(options, "max_ops_per_second", 500)
+        self._batch = FakeWriteBatch(client)
+
+    def on_write_error(self, callback):
+        pass
+
+    def set(self, reference, document_data, merge=False):
+        self._batch.set(reference, document_data, merge=merge)
+        self._maybe_send()
+
+    def update(self, reference, field_updates, option=None):
+        self._batch.update(reference, field_updates)
+        self._maybe_send()
+
+    def delete(self, reference, option=None):
+        self._batch.delete(reference)
+        self._maybe_send()
+
+    def _maybe_send(self):
+        if len(self._batch._writes) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._batch._writes:
+            return
+        time.sleep(self._client.latency + len(self._batch._writes) / self._max_ops_per_second)
+        self._batch._apply()
+        self._batch = FakeWriteBatch(self._client)
+
+    def close(self):
+        self.flush()
+
+
+class FakeFirestore:
+    """
+    Drop-in for backend.db. `latency` is the simulated round trip in seconds.
+    """
+
+    def __init__(self, latency=0.0, blocking=False):
+        self.latency = latency
+        self.blocking = blocking
+        self._collections = {}
+        self._versions = {}  # "collection/id" -> write count, for transaction validation
+        self._update_times = {}  # "collection/id" -> time of the last write, for write preconditions
+        self._last_write_time = None
+
+    def _write_time(self):
+        # Strictly increasing, so two writes in the same microsecond still get different update times
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self._last_write_time is not None and now <= self._last_write_time:
+            now = self._last_write_time + datetime.timedelta(microseconds=1)
+        self._last_write_time = now
+        return now
+
+    async def _round_trip(self):
+        if not self.latency:
+            return
+        if self.blocking:
+            time.sleep(self.latency)
+        else:
+            await asyncio.sleep(self.latency)
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def transaction(self, max_attempts=5):
+        return FakeTransaction(self, max_attempts)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def bulk_writer(self, options=None):
+        return FakeBulkWriter(self, options)
+
+    def document(self, path):
+        collection_name, doc_id = path.rsplit("/", 1)
+        return FakeDocumentReference(self, collection_name, doc_id)
+
+    @staticmethod
+    def write_option(**kwargs):
+        return kwargs
+
+    async def get_all(self, references, transaction=None):
+        await self._round_trip()
+        for doc_ref in references:
+            if transaction is not None:
+                transaction._record_read(doc_ref)
+            yield FakeDocumentSnapshot(doc_ref, doc_ref._store.get(doc_ref.id))
@@ -0,0 +1,56 @@
+"""
+Renders missing thumbnails for every product whose `thumbnails` do not cover its `images`.
+
+The API renders thumbnails after each product write; run this once to backfill listings
+created before the image pipeline existed, or that were skipped while its queue was full.
+Requires Pillow. Variants are written to IMAGE_CACHE_DIR on this machine, and any API node
+missing them renders them again from the source recorded in the 'images' collection.
+
+Usage (from the repository root, with serviceAccountKey.json in place):
+
+    python scripts/backfill_thumbnails.py --dry-run
+    python scripts/backfill_thumbnails.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend  # noqa: E402
+
+
+async def backfill(dry_run: bool) -> dict:
+    stale = []
+    total = 0
+    async for doc in backend.db.collection('products').stream():
+        total += 1
+        data = doc.to_dict()
+        if [thumbnail.get('source') for thumbnail in data.get('thumbnails') or []] != (data.get('images') or []):
+            stale.append(doc.id)
+    updated = 0
+    if not dry_run:
+        for product_id in stale:
+            updated += await backend.refresh_thumbnails(product_id)
+    return {"products": total, "stale": len(stale), "updated": updated}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="count products missing thumbnails without rendering")
+    args = parser.parse_args()
+
+    if backend.db is None:
+        sys.exit("Firestore is not initialized; see the error above.")
+    if backend.image_executor is None:
+        sys.exit("Pillow is not installed; install it to render thumbnails.")
+    try:
+        result = asyncio.run(backfill(args.dry_run))
+    finally:
+        backend.image_executor.shutdown()
+    print(f"{result['products']} products, {result['stale']} missing thumbnails; updated {result['updated']}")
+
+
+if __name__ == "__main__":
+    main()
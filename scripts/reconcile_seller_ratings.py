@@ -0,0 +1,37 @@
+"""
+Recomputes seller rating aggregates (rating, totalReviews, ratingSum on users documents)
+from the reviews collection and fixes any that have drifted.
+
+Review writes keep the aggregates up to date on their own; run this once to backfill
+existing data, or after editing reviews directly in Firestore. Stop writes while it
+runs, since reviews created during the pass may be missed.
+
+Usage (from the repository root, with serviceAccountKey.json in place):
+
+    python scripts/reconcile_seller_ratings.py --dry-run
+    python scripts/reconcile_seller_ratings.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import backend  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="report drifted sellers without writing")
+    args = parser.parse_args()
+
+    if backend.db is None:
+        sys.exit("Firestore is not initialized; see the error above.")
+    result = asyncio.run(backend.reconcile_seller_ratings(dry_run=args.dry_run))
+    action = "would correct" if args.dry_run else "corrected"
+    print(f"{result['reviews']} reviews across {result['sellers']} sellers; {action} {result['corrected']} users")
+
+
+if __name__ == "__main__":
+    main()